@@ -0,0 +1,370 @@
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+# first, so that it chooses the backend of matplotlib without a display
+from Postprocessor import Postprocessor
+
+from ElectronicSystems import ElectronicSystem, ElectronicSystemEnsemble
+from Fitting import fitSweep, lorentzian
+from Geometry import createGeometry
+from LaserProfiles import createLaserBeams
+from ResultSink import ResultSink, resultDirectoryName
+from ResultStore import ResultStore
+from Simulator import SolidStateStedEnsembleSimulator, SolidStateStedSimulator
+
+import numpy as np
+
+
+# parameters of main.py, the lattice keeps the spacing of its traps
+# and grows with the number of traps
+latticeSpacing = 1E-6/49
+electronTravelRange = 101E-9
+crossSections = [0.2, 2.0, 10.0, 5.0, 1.0]
+pumpAmplitude = 0.05
+stedAmplitude = 10.0
+laserRange = 2.5E-7
+
+latticeSizes = [10, 50, 100, 200, 500]
+laserPositions = [1, 8, 64]
+
+
+#------------------------------------------------------------------------------
+def lattice(size):
+	"""Returns the coordinates of a single rare earth in the centre and of
+	size x size electron traps around it."""
+	coordinates = latticeSpacing*(np.arange(size) - 0.5*(size - 1))
+	ETx, ETy = [c.ravel() for c in np.meshgrid(coordinates, coordinates, indexing='ij')]
+	return dict(REx=np.array([0.0]), REy=np.array([0.0]), ETx=ETx, ETy=ETy)
+
+#------------------------------------------------------------------------------
+def laserCoordinates(numberLaserPositions):
+	"""Returns the laser positions of a line scan like the one of main.py."""
+	laserXpos = np.linspace(-laserRange, laserRange, numberLaserPositions) if numberLaserPositions > 1 else np.zeros(1)
+	return laserXpos, np.zeros(numberLaserPositions)
+
+#------------------------------------------------------------------------------
+def createSimulator(size, numberLaserPositions, steps=1, geometry=None):
+	"""Returns a simulator, which is set up but not run. A single laser
+	position is simulated by the SolidStateStedSimulator, several ones by
+	the SolidStateStedEnsembleSimulator."""
+	laserXpos, laserYpos = laserCoordinates(numberLaserPositions)
+	if numberLaserPositions == 1:
+		simulator = SolidStateStedSimulator(steps)
+		laserXpos, laserYpos = laserXpos[0], laserYpos[0]
+	else:
+		simulator = SolidStateStedEnsembleSimulator(steps)
+
+	simulator.setupSimulation(pumpAmpl=pumpAmplitude, stedAmpl=stedAmplitude, laserXpos=laserXpos, laserYpos=laserYpos,
+							  cs=crossSections, eTR=electronTravelRange, seed=0, geometry=geometry, **lattice(size))
+	return simulator
+
+#------------------------------------------------------------------------------
+def createResultStore(directory, numberLaserPositions, numberStedAmplitudes=20):
+	"""Writes the results of a pump amplitude x numberStedAmplitudes sweep
+	of Lorentzian point spread functions to directory."""
+	laserXpos, laserYpos = laserCoordinates(numberLaserPositions)
+	for sa in np.linspace(1.0, 20.0, numberStedAmplitudes):
+		sink = ResultSink(resultDirectoryName(directory, pumpAmplitude, sa))
+		psf = lorentzian(laserXpos[np.newaxis], np.array([[0.0, 100.0, 1E-7/np.sqrt(sa), 1.0]]))[0]
+		for x, y, excited in zip(laserXpos, laserYpos, psf):
+			sink.append(dict(laserXpos=x, laserYpos=y, pumpAmplitude=pumpAmplitude, stedAmplitude=sa,
+							 crossSections=np.array(crossSections), excitedStateAverage=excited))
+
+
+#==============================================================================
+class BenchmarkSuite(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, latticeSizes=latticeSizes, laserPositions=laserPositions, repeat=3, steps=200, calls=1000):
+		"""
+		Benchmarks of the hot paths of the simulators and the postprocessing
+		at all combinations of lattice sizes and numbers of laser positions.
+		Every benchmark is timed repeat times after an untimed setup and the
+		fastest time is kept. Benchmarks, which don't depend on the lattice
+		(the postprocessing) or on the laser positions (the neighbours), are
+		run only once for all of them.
+
+		Parameters
+		----------
+		latticeSizes : list of int
+			Numbers of electron traps per side of the square lattice
+		laserPositions : list of int
+			Numbers of laser positions simulated together
+		repeat : int
+			Number of timed runs of every benchmark
+		steps : int
+			Number of simulation steps of the run benchmark
+		calls : int
+			Maximum number of calls of the single function benchmarks
+		"""
+		self.latticeSizes = latticeSizes
+		self.laserPositions = laserPositions
+		self.repeat = repeat
+		self.steps = steps
+		self.calls = calls
+
+		# name, function, unit of the rate, depends on the lattice size,
+		# depends on the laser positions
+		self.benchmarks = [('createNeighbours', self.benchmarkCreateNeighbours, 'sites/s', True, False),
+						   ('setupTransitionProbabilities', self.benchmarkSetupTransitionProbabilities, 'sites/s', True, True),
+						   ('run', self.benchmarkRun, 'steps/s', True, True),
+						   ('handleRecombination', self.benchmarkHandleRecombination, 'calls/s', True, True),
+						   ('recordREstates', self.benchmarkRecordREstates, 'calls/s', True, True),
+						   ('getData', self.benchmarkGetData, 'results/s', False, True),
+						   ('fit', self.benchmarkFit, 'points/s', False, True)]
+
+	#--------------------------------------------------------------------------
+	def measure(self, setup, function):
+		"""Returns the fastest time of function(setup()) in seconds, only the
+		call of function is timed."""
+		times = list()
+		for cnt in range(self.repeat):
+			state = setup()
+			start = timeit.default_timer()
+			function(state)
+			times.append(timeit.default_timer() - start)
+
+		return min(times)
+
+	#--------------------------------------------------------------------------
+	def run(self, names=None, output=sys.stdout):
+		"""
+		Runs all benchmarks, or the ones in names, and returns a list of
+		result dicts with the keys benchmark, latticeSize, laserPositions,
+		seconds, count, rate and unit. The rate is the number of items
+		processed (count) per second.
+		"""
+		self.directory = tempfile.mkdtemp(prefix='benchmark_')
+		self.geometries = dict()
+
+		results = list()
+		try:
+			for name, function, unit, latticeDependent, positionDependent in self.benchmarks:
+				if names and name not in names:
+					continue
+
+				for size in (self.latticeSizes if latticeDependent else [None]):
+					for numberLaserPositions in (self.laserPositions if positionDependent else [None]):
+						seconds, count = function(size, numberLaserPositions)
+						results.append(dict(benchmark=name, latticeSize=size, laserPositions=numberLaserPositions,
+											seconds=seconds, count=count, rate=count/seconds, unit=unit))
+
+						if output is not None:
+							output.write('%s\n'%formatResult(results[-1]))
+							output.flush()
+
+		finally:
+			shutil.rmtree(self.directory, ignore_errors=True)
+
+		return results
+
+	#--------------------------------------------------------------------------
+	def geometry(self, size):
+		"""Returns the directory of a Geometry of the lattice, which is created
+		only once, so that the run benchmark doesn't time the neighbours."""
+		if size not in self.geometries:
+			self.geometries[size] = os.path.join(self.directory, 'geometry_%d'%size)
+			coordinates = lattice(size)
+			createGeometry(self.geometries[size], coordinates['REx'], coordinates['REy'], coordinates['ETx'], coordinates['ETy'], electronTravelRange)
+
+		return self.geometries[size]
+
+	#--------------------------------------------------------------------------
+	def benchmarkCreateNeighbours(self, size, numberLaserPositions):
+		def setup():
+			coordinates = lattice(size)
+			pumpBeam, stedBeam = createLaserBeams(0.0, 0.0, pumpAmplitude, stedAmplitude)
+			return ElectronicSystem(coordinates['REx'], coordinates['REy'], coordinates['ETx'], coordinates['ETy'], pumpBeam, stedBeam)
+
+		return self.measure(setup, lambda es: es.createNeighbours(electronTravelRange)), size**2 + 1
+
+	#--------------------------------------------------------------------------
+	def benchmarkSetupTransitionProbabilities(self, size, numberLaserPositions):
+		def setup():
+			coordinates = lattice(size)
+			laserXpos, laserYpos = laserCoordinates(numberLaserPositions)
+			pumpBeam, stedBeam = createLaserBeams(laserXpos, laserYpos, pumpAmplitude, stedAmplitude)
+			systemClass = ElectronicSystem if numberLaserPositions == 1 else ElectronicSystemEnsemble
+			return systemClass(coordinates['REx'], coordinates['REy'], coordinates['ETx'], coordinates['ETy'], pumpBeam, stedBeam)
+
+		return self.measure(setup, lambda es: es.setupTransitionProbabilities(*crossSections)), (size**2 + 1)*numberLaserPositions
+
+	#--------------------------------------------------------------------------
+	def benchmarkRun(self, size, numberLaserPositions):
+		geometry = self.geometry(size)
+		seconds = self.measure(lambda: createSimulator(size, numberLaserPositions, self.steps, geometry), lambda simulator: simulator.run())
+		return seconds, (self.steps + 1)*numberLaserPositions
+
+	#--------------------------------------------------------------------------
+	def benchmarkHandleRecombination(self, size, numberLaserPositions):
+		# at most a quarter of the traps is populated by the recombinations,
+		# so that there are free neighbours left
+		calls = max(min(self.calls, size**2//4), 1)
+
+		def setup():
+			simulator = createSimulator(size, numberLaserPositions, geometry=self.geometry(size))
+			simulator.createNeighbours()
+			random = np.random.RandomState(0)
+			return simulator, random.randint(numberLaserPositions, size=calls), random.randint(size**2, size=calls)
+
+		def handleRecombinations(state):
+			simulator, positions, indices = state
+			if numberLaserPositions == 1:
+				for index in indices:
+					simulator.handleRecombination(index)
+			else:
+				for position, index in zip(positions, indices):
+					simulator.handleRecombination(position, index)
+
+		return self.measure(setup, handleRecombinations), calls
+
+	#--------------------------------------------------------------------------
+	def benchmarkRecordREstates(self, size, numberLaserPositions):
+		def setup():
+			es = createSimulator(size, numberLaserPositions, geometry=self.geometry(size)).electronSystems
+			es.resetRareEarthEvolutionCounters()
+			return es
+
+		def recordREstates(es):
+			for cnt in xrange(self.calls):
+				es.recordREstates()
+
+		return self.measure(setup, recordREstates), self.calls
+
+	#--------------------------------------------------------------------------
+	def benchmarkGetData(self, size, numberLaserPositions):
+		directory = os.path.join(self.directory, 'results_%d/'%numberLaserPositions)
+		createResultStore(directory, numberLaserPositions)
+
+		def setup():
+			postprocessor = Postprocessor(directory)
+			postprocessor.store = ResultStore(directory)
+			return postprocessor
+
+		postprocessor = setup()
+		return self.measure(setup, lambda postprocessor: postprocessor.getData()), postprocessor.store.index.size
+
+	#--------------------------------------------------------------------------
+	def benchmarkFit(self, size, numberLaserPositions):
+		directory = os.path.join(self.directory, 'results_%d/'%numberLaserPositions)
+		if not os.path.isdir(directory):
+			createResultStore(directory, numberLaserPositions)
+
+		postprocessor = Postprocessor(directory)
+		postprocessor.getAllResultFiles()
+
+		# a single laser position can't be fitted, it is timed anyway
+		with np.errstate(divide='ignore', invalid='ignore'):
+			seconds = self.measure(lambda: postprocessor.data, fitSweep)
+		return seconds, postprocessor.store.index.size
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def resultKey(result):
+	return (result['benchmark'], result['latticeSize'], result['laserPositions'])
+
+#------------------------------------------------------------------------------
+def formatResult(result, baseline=None, threshold=None):
+	"""Returns a line of the report for a result dict, with the change
+	of the rate against the baseline result, if given."""
+	line = '%-30s %8s %6s %12.4g %-10s %10.4g s'%(result['benchmark'], result['latticeSize'] or '-', result['laserPositions'] or '-',
+													result['rate'], result['unit'], result['seconds'])
+	if baseline is not None:
+		change = result['rate']/baseline['rate'] - 1.0
+		line += ' %+7.1f %%'%(100.0*change)
+		if isRegression(result, baseline, threshold):
+			line += '  REGRESSION'
+
+	return line
+
+#------------------------------------------------------------------------------
+def isRegression(result, baseline, threshold):
+	"""Returns True if the rate of result is more than the fraction threshold
+	below the rate of the baseline result."""
+	return result['rate'] < baseline['rate']/(1.0 + threshold)
+
+#------------------------------------------------------------------------------
+def compareResults(results, baselineResults, threshold):
+	"""Returns the pairs of results and baseline results, whose rate
+	regressed by more than the fraction threshold."""
+	baselines = dict((resultKey(b), b) for b in baselineResults)
+	return [(r, baselines[resultKey(r)]) for r in results
+			if resultKey(r) in baselines and isRegression(r, baselines[resultKey(r)], threshold)]
+
+#------------------------------------------------------------------------------
+def environment():
+	"""Returns the description of the machine and the code, which is stored
+	with every run in the history."""
+	try:
+		commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+										 stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+
+	return dict(date=datetime.datetime.now().isoformat(), commit=commit, host=platform.node(),
+				machine=platform.machine(), python=platform.python_version(), numpy=np.__version__)
+
+#------------------------------------------------------------------------------
+def appendHistory(path, run):
+	"""Appends a run, i.e. its environment and its results, as a single
+	line of JSON to the history file."""
+	with open(path, 'a') as f:
+		f.write(json.dumps(run) + '\n')
+
+#------------------------------------------------------------------------------
+def readHistory(path):
+	"""Returns the list of all runs in the history file."""
+	if not os.path.exists(path):
+		return list()
+
+	with open(path, 'r') as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks of the simulator hot paths. Every run is appended to the '
+									 'history and compared to the baseline, the exit status is 1 for regressions.')
+	parser.add_argument('--sizes', type=int, nargs='+', default=latticeSizes, help='electron traps per side of the lattice')
+	parser.add_argument('--positions', type=int, nargs='+', default=laserPositions, help='numbers of laser positions')
+	parser.add_argument('--benchmarks', nargs='+', help='run only these benchmarks')
+	parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark, the fastest one counts')
+	parser.add_argument('--steps', type=int, default=200, help='simulation steps of the run benchmark')
+	parser.add_argument('--history', default='benchmark_history.jsonl', help='file the runs are appended to')
+	parser.add_argument('--baseline', default='benchmark_baseline.json', help='run the results are compared to')
+	parser.add_argument('--save-baseline', action='store_true', help='save this run as the baseline')
+	parser.add_argument('--threshold', type=float, default=0.2, help='fraction the rate may drop before it is a regression')
+	arguments = parser.parse_args()
+
+	suite = BenchmarkSuite(arguments.sizes, arguments.positions, arguments.repeat, arguments.steps)
+	run = environment()
+	run['results'] = suite.run(arguments.benchmarks)
+	appendHistory(arguments.history, run)
+
+	regressions = list()
+	if os.path.exists(arguments.baseline):
+		with open(arguments.baseline, 'r') as f:
+			baseline = json.load(f)
+
+		print '\ncompared to %s (commit %s):'%(baseline['date'], baseline['commit'])
+		baselines = dict((resultKey(b), b) for b in baseline['results'])
+		for result in run['results']:
+			print formatResult(result, baselines.get(resultKey(result)), arguments.threshold)
+
+		regressions = compareResults(run['results'], baseline['results'], arguments.threshold)
+
+	if arguments.save_baseline:
+		with open(arguments.baseline, 'w') as f:
+			json.dump(run, f, indent=1)
+
+	sys.exit(1 if regressions else 0)
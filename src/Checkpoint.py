@@ -0,0 +1,109 @@
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def writeFileAtomically(path, data):
+	"""Writes data to a temporary file first and replaces path with it, so
+	that path always holds either the old or the new content."""
+	temporaryPath = path + '.tmp'
+	with open(temporaryPath, 'wb') as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+
+	# os.rename doesn't replace existing files on Windows
+	if os.name == 'nt' and os.path.exists(path):
+		os.remove(path)
+	os.rename(temporaryPath, path)
+
+#------------------------------------------------------------------------------
+def writeCheckpoint(path, state):
+	"""Saves the state dict of a simulator to path."""
+	writeFileAtomically(path, pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+#------------------------------------------------------------------------------
+def readCheckpoint(path):
+	"""Returns the state dict saved to path, or None if there is none."""
+	if not os.path.exists(path):
+		return None
+
+	with open(path, 'rb') as f:
+		return pickle.load(f)
+
+#------------------------------------------------------------------------------
+def arrayDigest(array):
+	"""Returns a short hash of the content of an array."""
+	return hashlib.sha1(np.ascontiguousarray(array, dtype=float).tostring()).hexdigest()[:16]
+
+
+#==============================================================================
+class SweepManifest(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, path, parameters):
+		"""
+		Keeps track of the completed tasks of every point spread function of
+		a sweep in a JSON file, together with the number of rows of its
+		ResultSink after the last completed task.
+
+		Parameters
+		----------
+		path : str
+			File of the manifest
+		parameters : dict
+			Parameters shared by all point spread functions of the sweep.
+			A manifest of a sweep with other parameters can't be continued.
+		"""
+		self.path = path
+		self.parameters = json.loads(json.dumps(parameters))
+		self.psfs = dict()
+
+		if os.path.exists(path):
+			with open(path, 'r') as f:
+				manifest = json.load(f)
+
+			if manifest['parameters'] != self.parameters:
+				raise ValueError('%s belongs to a sweep with different parameters'%path)
+
+			self.psfs = manifest['psfs']
+
+	#--------------------------------------------------------------------------
+	def completedTasks(self, psfName):
+		"""Returns the list of the completed tasks of a point spread function."""
+		return self.psfs.get(psfName, dict()).get('completed', list())
+
+	#--------------------------------------------------------------------------
+	def numberOfRows(self, psfName):
+		"""Returns the number of result rows of the completed tasks."""
+		return self.psfs.get(psfName, dict()).get('rows', 0)
+
+	#--------------------------------------------------------------------------
+	def complete(self, psfName, task, rows):
+		"""
+		Marks a task as completed and saves the manifest.
+
+		Parameters
+		----------
+		psfName : str
+			Name of the point spread function
+		task : int
+			Index of the task within the point spread function
+		rows : int
+			Number of rows of the ResultSink including the results of task
+		"""
+		psf = self.psfs.setdefault(psfName, dict(completed=list(), rows=0))
+		psf['completed'].append(task)
+		psf['rows'] = rows
+		self.save()
+
+	#--------------------------------------------------------------------------
+	def save(self):
+		writeFileAtomically(self.path, json.dumps(dict(parameters=self.parameters, psfs=self.psfs), indent=1))
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
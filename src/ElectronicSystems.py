@@ -1,14 +1,252 @@
 
+import itertools
 import timeit
 import numpy as np
 
+from Lattice import RegularLattice, trapCoordinates
+
+#==============================================================================
+def transitionProbabilities(pumpIntensityET, stedIntensityET, pumpIntensityRE, stedIntensityRE,
+							gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE):
+	"""
+	Calculates the normalized transition probabilities of electron traps
+	and rare earths from the laser intensities at their positions.
+
+	All normalizations are done along the last axis (the electronic systems),
+	so leading axes, e.g. for several laser positions, are kept.
+
+	Parameters
+	----------
+	pumpIntensityET, stedIntensityET : array-like
+		Pump and STED laser intensities at the electron trap positions
+	pumpIntensityRE, stedIntensityRE : array-like
+		Pump and STED laser intensities at the rare earth positions
+	gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE : float
+		Cross-sections of the rare earth, see
+		ElectronicSystem.setupTransitionProbabilities()
+
+	Returns
+	-------
+	pIonizeET : array
+		Ionization probability of the electron traps
+	probRE : array
+		Cumulative transition thresholds of the rare earths with the
+		order [decay, ionize, excite, repump, deplete] along the last axis
+	"""
+	# probability for ionizing the electron traps
+	pIonizeET = pumpIntensityET + stedIntensityET
+	pIonizeET /= np.max(pIonizeET, axis=-1, keepdims=True)
+
+	return pIonizeET, rareEarthTransitionThresholds(pumpIntensityRE, stedIntensityRE,
+													gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE)
+
+#==============================================================================
+def rareEarthTransitionThresholds(pumpIntensityRE, stedIntensityRE, gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE):
+	"""Calculates the cumulative transition thresholds of the rare earths
+	with the order [decay, ionize, excite, repump, deplete] along the last
+	axis, see transitionProbabilities()."""
+	probExciteRE  = pumpIntensityRE * sigPumpRE
+	probIonizeRE  = (pumpIntensityRE + stedIntensityRE) * sigIonizeRE
+	probRepumpRE  = pumpIntensityRE * sigRepumpRE
+	probDecayRE   = np.full_like(pumpIntensityRE, gammaRE)
+	probDepleteRE = stedIntensityRE * sigStedRE
+
+	totProbRE = probExciteRE + probIonizeRE + probRepumpRE + probDecayRE + probDepleteRE
+
+	maxTotProbRE   = np.max(totProbRE, axis=-1, keepdims=True)
+	totProbRE     /= maxTotProbRE
+	probExciteRE  /= maxTotProbRE
+	probIonizeRE  /= maxTotProbRE
+	probRepumpRE  /= maxTotProbRE
+	probDecayRE   /= maxTotProbRE
+	probDepleteRE /= maxTotProbRE
+
+	probIonizeRE  = probDecayRE  + probIonizeRE
+	probExciteRE  = probIonizeRE + probExciteRE
+	probRepumpRE  = probExciteRE + probRepumpRE
+	probDepleteRE = probRepumpRE + probDepleteRE
+
+	totProbREval   = 10.0 * (probExciteRE + probIonizeRE + probRepumpRE + probDecayRE + probDepleteRE)
+	probExciteRE  /= totProbREval
+	probIonizeRE  /= totProbREval
+	probRepumpRE  /= totProbREval
+	probDecayRE   /= totProbREval
+	probDepleteRE /= totProbREval
+
+	return np.stack((probDecayRE, probIonizeRE, probExciteRE, probRepumpRE, probDepleteRE), axis=-1)
+
+
+#==============================================================================
+def sitePositions(RExPos, REyPos, ETxPos, ETyPos, REzPos=None, ETzPos=None):
+	"""Returns the positions of all electron traps followed by all rare
+	earths as (N x 3) array of [x, y, z]. The z coordinates are zero in a
+	two-dimensional crystal, i.e. if they are None. The electron traps may
+	be given by a RegularLattice as ETxPos."""
+	ETxPos, ETyPos, ETzPos = trapCoordinates(ETxPos, ETyPos, ETzPos)
+	numberElectronTraps = np.size(ETxPos)
+
+	positions = np.zeros((numberElectronTraps + np.size(RExPos), 3))
+	positions[:numberElectronTraps, 0] = np.ravel(ETxPos)
+	positions[:numberElectronTraps, 1] = np.ravel(ETyPos)
+	positions[numberElectronTraps:, 0] = np.ravel(RExPos)
+	positions[numberElectronTraps:, 1] = np.ravel(REyPos)
+
+	if ETzPos is not None:
+		positions[:numberElectronTraps, 2] = np.ravel(ETzPos)
+	if REzPos is not None:
+		positions[numberElectronTraps:, 2] = np.ravel(REzPos)
+
+	return positions
+
+#==============================================================================
+def neighbourList(positions, travelRange, maxCandidates=2**22):
+	"""
+	Finds all pairs of points, which are not further apart than travelRange,
+	using a cell list. The points are sorted into cells with an edge length
+	of travelRange, so that only points in adjacent cells must be compared.
+
+	The candidate pairs are evaluated in chunks of points with at most
+	about maxCandidates candidates, so the memory needed besides the
+	result doesn't depend on the number of points or on the density of
+	the crystal, e.g. of a three-dimensional one.
+
+	Parameters
+	----------
+	positions : array-like
+		(N x dimensions) array of point coordinates
+	travelRange : float
+		Maximum distance of two neighbouring points
+	maxCandidates : int
+		Number of candidate pairs evaluated at once
+
+	Returns
+	-------
+	offsets : array of int
+		The neighbours of point i are indices[offsets[i]:offsets[i+1]]
+	indices : array of int
+		Neighbour indices of all points in compressed sparse row order,
+		each row is sorted and contains the point itself
+	"""
+	positions = np.asarray(positions, dtype=float)
+	numberPoints, dimensions = positions.shape
+	indexType = np.int32 if numberPoints < np.iinfo(np.int32).max else np.int64
+
+	cellSize = travelRange if travelRange > 0.0 else 1.0
+	cells = np.floor((positions - positions.min(axis=0))/cellSize).astype(np.int64)
+	gridShape = cells.max(axis=0) + 1
+
+	cellIds = np.ravel_multi_index(cells.T, gridShape)
+	order = np.argsort(cellIds, kind='mergesort')
+	sortedCellIds = cellIds[order]
+
+	# the number of candidates of every occupied cell, i.e. of the points
+	# in it, bounds the chunks
+	occupiedCells, cellIndex = np.unique(cellIds, return_inverse=True)
+	occupiedCoordinates = np.array(np.unravel_index(occupiedCells, gridShape)).T
+	cellCandidates = np.zeros(occupiedCells.size, dtype=np.int64)
+	for cellOffset in itertools.product((-1, 0, 1), repeat=dimensions):
+		neighbourCells = occupiedCoordinates + cellOffset
+		valid = np.all((neighbourCells >= 0) & (neighbourCells < gridShape), axis=1)
+		neighbourCellIds = np.ravel_multi_index(neighbourCells[valid].T, gridShape)
+		cellCandidates[valid] += np.searchsorted(sortedCellIds, neighbourCellIds, side='right') - np.searchsorted(sortedCellIds, neighbourCellIds, side='left')
+
+	candidates = np.cumsum(cellCandidates[cellIndex])
+	chunkEnds = np.searchsorted(candidates, np.arange(maxCandidates, candidates[-1], maxCandidates))
+	chunkEnds = np.unique(np.append(chunkEnds[chunkEnds > 0], numberPoints))
+	del cellIndex, candidates
+
+	# handle the points in chunks to bound the memory for the candidate pairs
+	counts = np.zeros(numberPoints, dtype=np.int64)
+	indices = list()
+	for chunkStart, chunkEnd in zip(np.concatenate(([0], chunkEnds[:-1])), chunkEnds):
+		chunk = np.arange(chunkStart, chunkEnd)
+
+		sources = list()
+		targets = list()
+		for cellOffset in itertools.product((-1, 0, 1), repeat=dimensions):
+			neighbourCells = cells[chunk] + cellOffset
+			valid = np.all((neighbourCells >= 0) & (neighbourCells < gridShape), axis=1)
+			neighbourCellIds = np.ravel_multi_index(neighbourCells[valid].T, gridShape)
+
+			# all points in the neighbouring cell are candidates
+			start = np.searchsorted(sortedCellIds, neighbourCellIds, side='left')
+			cellCounts = np.searchsorted(sortedCellIds, neighbourCellIds, side='right') - start
+			source = np.repeat(chunk[valid], cellCounts)
+			target = order[np.arange(cellCounts.sum()) - np.repeat(np.cumsum(cellCounts) - cellCounts - start, cellCounts)]
+
+			distance = np.sqrt(np.sum(np.square(positions[source] - positions[target]), axis=1))
+			isNeighbour = distance <= travelRange
+			sources.append(source[isNeighbour])
+			targets.append(target[isNeighbour])
+
+		sources = np.concatenate(sources)
+		targets = np.concatenate(targets)
+		counts[chunk] = np.bincount(sources - chunkStart, minlength=chunk.size)
+
+		# sort the pairs by source and target at once
+		keys = (sources - chunkStart)*numberPoints + targets
+		keys.sort()
+		indices.append((keys % numberPoints).astype(indexType))
+
+	offsets = np.zeros(numberPoints + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum(counts)
+
+	# the pages of the result are only allocated when written, so the
+	# chunks are released while they are copied instead of concatenated
+	neighbourIndices = np.empty(offsets[-1], dtype=indexType)
+	for cnt, chunkStart in enumerate(np.concatenate(([0], chunkEnds[:-1]))):
+		neighbourIndices[offsets[chunkStart]:offsets[chunkStart] + indices[cnt].size] = indices[cnt]
+		indices[cnt] = None
+
+	return offsets, neighbourIndices
+
+
 #==============================================================================
 class ElectronicSystem(object):
+	# every electronic system is described by a set of typed arrays
+	# (electron traps first, followed by the rare earths), which are
+	# accessed directly in the vectorized kernels
+	__slots__ = ('positions', 'rareEarthMask', 'populated', 'numberElectronTraps',
+				 'pIonize', 'rareEarthThresholds', 'rareEarthState',
+				 'groundStateCounter', 'excitedStateCounter',
+				 '_rareEarthIndices', '_electronTrapIndices',
+				 '_pumpBeam', '_stedBeam',
+				 'neighbourOffsets', 'neighbourIndices',
+				 'lattice', 'electronTravelRange', '_stencil', '_rareEarthNeighbours', '_trapRareEarths',
+				 '_freeSlots', '_freeSlotPosition', '_numberFreeSlots', 'freeNeighbourCount')
+
+	# encodings for the electronic states in a rare earth
+	GROUND  = 1
+	EXCITED = 2
+	IONIZED = 3
+
+	# columns of the cumulative rare earth transition thresholds
+	DECAY   = 0
+	IONIZE  = 1
+	EXCITE  = 2
+	REPUMP  = 3
+	DEPLETE = 4
+
+	# lookup tables for the vectorized rare earth kernel, indexed by
+	# [action, state] with the actions 0 decay, 1 ionize, 2 excite,
+	# 3 repump, 4 deplete and 5 nothing (see actOnRareEarth())
+	_reTransitions = np.tile(np.arange(4, dtype=np.int8), (6, 1))
+	_reTransitions[DECAY, EXCITED]   = GROUND
+	_reTransitions[IONIZE, EXCITED]  = IONIZED
+	_reTransitions[EXCITE, GROUND]   = EXCITED
+	_reTransitions[REPUMP, IONIZED]  = GROUND
+	_reTransitions[DEPLETE, EXCITED] = GROUND
+
+	_reResults = np.zeros((6, 4), dtype=np.int8)
+	_reResults[IONIZE, EXCITED] = 1
+	_reResults[REPUMP, IONIZED] = 2
+
 	#--------------------------------------------------------------------------
-	def __init__(self, RExPos, REyPos, ETxPos, ETyPos, pumpBeam, stedBeam):
+	def __init__(self, RExPos, REyPos, ETxPos, ETyPos, pumpBeam, stedBeam, REzPos=None, ETzPos=None):
 		"""
 		Construct a collection of electronic systems, which can consist of
-		rare earth ions and electron traps.
+		rare earth ions and electron traps. The crystal is two-dimensional
+		in the focal plane z = 0, unless z coordinates are given.
 
 		Parameters
 		----------
@@ -16,68 +254,64 @@ class ElectronicSystem(object):
 			Represents the x-coordinates of the rare earths
 		REyPos : array-like
 			Represents the y-coordinates of the rare earths
-		ETxPos : array-like
-			Represents the x-coordinates of the electron traps
+		ETxPos : array-like or Lattice.RegularLattice
+			Represents the x-coordinates of the electron traps, or the
+			lattice of all electron traps, whose positions and neighbours
+			are computed instead of stored. ETyPos and ETzPos are ignored then.
 		ETyPos : array-like
 			Represents the y-coordinates of the electron traps
 		pumpBeam : Object of type LaserProfiles.PumpBeam()
 			Represents the impact of the Gaussian-shaped excitation laser to the electronic systems
 		stedBeam : Object of type LaserProfiles.StedBeam()
 			Represents the impave of the donut-shaped STED laser
+		REzPos : array-like or None
+			Represents the z-coordinates of the rare earths
+		ETzPos : array-like or None
+			Represents the z-coordinates of the electron traps
 		"""
-		
-		if ETxPos.size != ETyPos.size:
-			raise ValueError("x and y position array for ET must be of same size.")
-
-		if RExPos.size != REyPos.size:
-			raise ValueError("x and y position array for RE must be of same size.")
-
-		# access indices for an electronic system (for both ET and RE)
-		self.idx = dict()
-		self.idx['x']           = 0
-		self.idx['y']           = 1
-		self.idx['z']           = 2
-		self.idx['isRE']        = 3
-		self.idx['isPopulated'] = 4
-		self.idx['pDecay']      = 5
-		self.idx['pIonize']     = 6
-		self.idx['pExcite']     = 7
-		self.idx['pRepump']     = 8
-		self.idx['pDeplete']    = 9
-		self.idx['reState']     = 10
-		self.idx['groundStateCounter']  = 11
-		self.idx['excitedStateCounter'] = 12
-
-		# encodings for the electronic states in a rare earth
-		self._states = dict()
-		self._states['ground']  = 1.0
-		self._states['excited'] = 2.0
-		self._states['ionized'] = 3.0
-
-		# setup and initialize electron traps
-		self.electronTraps = np.zeros((ETxPos.size, len(self.idx.keys())))
-		self.electronTraps[:, self.idx['x']] = np.array(ETxPos)
-		self.electronTraps[:, self.idx['y']] = np.array(ETyPos)
-		self.electronTraps[:, self.idx['z']] = np.zeros(ETxPos.size)
-
-		# setup and initialize rare earths
-		self.rareEarths = np.zeros((RExPos.size, len(self.idx.keys())))
-		self.rareEarths[:, self.idx['x']] = np.array(RExPos)
-		self.rareEarths[:, self.idx['y']] = np.array(REyPos)
-		self.rareEarths[:, self.idx['z']] = np.zeros(self.rareEarths.shape[0])
-		self.rareEarths[:, self.idx['isRE']] = np.ones(self.rareEarths.shape[0])
-		self.rareEarths[:, self.idx['isPopulated']] = np.ones(self.rareEarths.shape[0])
-		self.rareEarths[:, self.idx['reState']] = np.full(self.rareEarths.shape[0], self._states['ground'])
+		self.lattice = ETxPos if isinstance(ETxPos, RegularLattice) else None
+
+		if self.lattice is None and (ETxPos.size != ETyPos.size or (ETzPos is not None and np.size(ETzPos) != ETxPos.size)):
+			raise ValueError("x, y and z position array for ET must be of same size.")
+
+		if RExPos.size != REyPos.size or (REzPos is not None and np.size(REzPos) != RExPos.size):
+			raise ValueError("x, y and z position array for RE must be of same size.")
+
+		numberRareEarths = RExPos.size
+		self.numberElectronTraps = ETxPos.size
+
+		# positions of all electron traps and rare earths as [x, y, z],
+		# only those of the rare earths for a lattice of electron traps
+		if self.lattice is None:
+			self.positions = sitePositions(RExPos, REyPos, ETxPos, ETyPos, REzPos, ETzPos)
+		else:
+			self.positions = sitePositions(RExPos, REyPos, [], [], REzPos)
+
+		self.rareEarthMask = np.zeros(self.numberElectronTraps + numberRareEarths, dtype=bool)
+		self.rareEarthMask[self.numberElectronTraps:] = True
+		self._rareEarthIndices = np.nonzero(self.rareEarthMask)[0]
+		self._electronTrapIndices = np.nonzero(~self.rareEarthMask)[0]
+
+		# electron traps start empty, rare earths populated in ground state
+		self.populated = np.zeros(self.N, dtype=np.uint8)
+		self.populated[self.numberElectronTraps:] = 1
+		self.rareEarthState = np.full(numberRareEarths, self.GROUND, dtype=np.int8)
+
+		# transition probabilities, set up by setupTransitionProbabilities()
+		self.pIonize = np.zeros(self.numberElectronTraps)
+		self.rareEarthThresholds = np.zeros((numberRareEarths, 5))
 
 		# keep laser beams
 		self._pumpBeam = pumpBeam
 		self._stedBeam = stedBeam
 
+		# free-slot index, built together with the neighbours
+		self._freeSlots = None
+
 	#--------------------------------------------------------------------------
 	def setupTransitionProbabilities(self, gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE):
 		"""
-		Builds and finalizes the collection of electronic systems and calculates
-		the transition probabilities of each system depending on its position and
+		Calculates the transition probabilities of each system depending on its position and
 		assigned cross-section.
 
 		Parameters
@@ -94,185 +328,307 @@ class ElectronicSystem(object):
 			Cross-section of the rare earth for depletion (STED laser)
 		"""
 
+		# the axial profile is only evaluated in a three-dimensional crystal
+		z = self.z if np.any(self.z) else None
+		sites = slice(0, self.numberElectronTraps)
+		rareEarths = slice(self.numberElectronTraps, None)
+
 		# calculate pump and STED laser intensities at each electron trap position
-		pumpIntensityET = self._pumpBeam.profile(self.electronTraps[:, self.idx['x']], self.electronTraps[:, self.idx['y']])
-		stedIntensityET = self._stedBeam.profile(self.electronTraps[:, self.idx['x']], self.electronTraps[:, self.idx['y']])
+		pumpIntensityET = self._pumpBeam.profile(self.x[sites], self.y[sites], None if z is None else z[sites])
+		stedIntensityET = self._stedBeam.profile(self.x[sites], self.y[sites], None if z is None else z[sites])
 
 		# calculate pump and STED laser intensities at each rare earth position
-		pumpIntensityRE = self._pumpBeam.profile(self.rareEarths[:, self.idx['x']], self.rareEarths[:, self.idx['y']])
-		stedIntensityRE = self._stedBeam.profile(self.rareEarths[:, self.idx['x']], self.rareEarths[:, self.idx['y']])
-
-		# probability for ionizing the electron traps
-		pIonizeET = pumpIntensityET + stedIntensityET
-		pIonizeET /= np.max(pIonizeET)
-		self.electronTraps[:, self.idx['pIonize']] = pIonizeET
-
-		# for rare earth
-		probExciteRE  = pumpIntensityRE * sigPumpRE
-		probIonizeRE  = (pumpIntensityRE + stedIntensityRE) * sigIonizeRE
-		probRepumpRE  = pumpIntensityRE * sigRepumpRE
-		probDecayRE   = np.full(self.rareEarths.shape[0], gammaRE)
-		probDepleteRE = stedIntensityRE * sigStedRE
-
-		totProbRE = probExciteRE + probIonizeRE + probRepumpRE + probDecayRE + probDepleteRE
-
-		maxTotProbRE   = np.max(totProbRE)
-		totProbRE     /= maxTotProbRE
-		probExciteRE  /= maxTotProbRE
-		probIonizeRE  /= maxTotProbRE
-		probRepumpRE  /= maxTotProbRE
-		probDecayRE   /= maxTotProbRE
-		probDepleteRE /= maxTotProbRE
-
-		#self._probDecayRE   = self._probDecayRE[self._rareEarthIndex]
-		probIonizeRE  = probDecayRE  + probIonizeRE
-		probExciteRE  = probIonizeRE + probExciteRE
-		probRepumpRE  = probExciteRE + probRepumpRE
-		probDepleteRE = probRepumpRE + probDepleteRE
-
-		totProbREval   = 10.0 * (probExciteRE + probIonizeRE + probRepumpRE + probDecayRE + probDepleteRE)
-		probExciteRE  /= totProbREval
-		probIonizeRE  /= totProbREval
-		probRepumpRE  /= totProbREval
-		probDecayRE   /= totProbREval
-		probDepleteRE /= totProbREval
-
-		self.rareEarths[:, self.idx['pDecay']]   = probDecayRE
-		self.rareEarths[:, self.idx['pIonize']]  = probIonizeRE
-		self.rareEarths[:, self.idx['pExcite']]  = probExciteRE
-		self.rareEarths[:, self.idx['pRepump']]  = probRepumpRE
-		self.rareEarths[:, self.idx['pDeplete']] = probDepleteRE
-
-		#self._normProbability = pIonizeET
-		#self._normProbability[self._rareEarthIndex] = totProbRE[self._rareEarthIndex]
-
-		# concatenate electron traps and rare earths to a single array system
-		self.electronicSystem = np.vstack((self.electronTraps, self.rareEarths))
+		pumpIntensityRE = self._pumpBeam.profile(self.x[rareEarths], self.y[rareEarths], None if z is None else z[rareEarths])
+		stedIntensityRE = self._stedBeam.profile(self.x[rareEarths], self.y[rareEarths], None if z is None else z[rareEarths])
+
+		self.setTransitionProbabilities(*transitionProbabilities(pumpIntensityET, stedIntensityET,
+																 pumpIntensityRE, stedIntensityRE,
+																 gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE))
+
+	#--------------------------------------------------------------------------
+	def setTransitionProbabilities(self, pIonize, rareEarthThresholds):
+		"""
+		Sets transition probabilities, which were calculated beforehand, e.g.
+		taken from a TransitionTable, instead of calculating them from the
+		laser beams.
+
+		Parameters
+		----------
+		pIonize : array
+			Ionization probability of the electron traps
+		rareEarthThresholds : array
+			Cumulative transition thresholds of the rare earths,
+			see transitionProbabilities()
+		"""
+		self.pIonize = pIonize
+		self.rareEarthThresholds = rareEarthThresholds
 
 		self.resetRareEarthEvolutionCounters()
 
 	#--------------------------------------------------------------------------
 	def createNeighbours(self, electronTravelRange):
-		"""creates a collection of neighbour-indices to a certain index
-		depending on the given electron travel range."""
-		self.neighbours = dict()
-		for index in range(self.N):
-			indexNeighbours = list()
-			pos1 = self.getPosition(index)
-			for i in range(self.N):
-				pos2 = self.getPosition(i)
-				dist = np.linalg.norm(pos1 - pos2)
-				if dist <= electronTravelRange:
-					indexNeighbours.append(i)
-			self.neighbours[index] = np.array(indexNeighbours)
+		"""Creates a collection of neighbour-indices to a certain index
+		depending on the given electron travel range. The neighbours are
+		stored in compressed sparse row format, see neighbourList(), or
+		computed from the stencil of a lattice, see createLatticeNeighbours()."""
+		self.electronTravelRange = electronTravelRange
+
+		if self.lattice is None:
+			self.neighbourOffsets, self.neighbourIndices = neighbourList(self.positions, electronTravelRange)
+		else:
+			self.createLatticeNeighbours(electronTravelRange)
+
+		self.buildFreeSlotIndex()
+
+	#--------------------------------------------------------------------------
+	def createLatticeNeighbours(self, electronTravelRange):
+		"""Creates the neighbours of a lattice of electron traps. Only the
+		stencil of the lattice and the neighbours of the few rare earths are
+		stored: the electron traps within the travel range of every rare
+		earth and the other way round."""
+		self.neighbourOffsets = None
+		self.neighbourIndices = None
+		self._stencil = self.lattice.stencil(electronTravelRange)
+
+		self._rareEarthNeighbours = list()
+		rareEarthTraps = dict()
+		for cnt, position in enumerate(self.positions):
+			traps = self.lattice.pointsWithin(position, electronTravelRange)
+			distance = np.sqrt(np.sum(np.square(self.positions - position), axis=1))
+			rareEarths = self.numberElectronTraps + np.flatnonzero(distance <= electronTravelRange)
+			self._rareEarthNeighbours.append(np.concatenate((traps, rareEarths)))
+
+			for trap in traps:
+				rareEarthTraps.setdefault(int(trap), list()).append(self.numberElectronTraps + cnt)
+
+		self._trapRareEarths = dict((trap, np.array(rareEarths, dtype=np.int64)) for trap, rareEarths in rareEarthTraps.items())
+
+	#--------------------------------------------------------------------------
+	def neighbourArrays(self):
+		"""Returns the neighbours of all electronic systems in compressed
+		sparse row format, see neighbourList(). They are only built here
+		for a lattice of electron traps."""
+		if self.lattice is None:
+			return self.neighbourOffsets, self.neighbourIndices
+
+		return neighbourList(np.column_stack((self.x, self.y, self.z)), self.electronTravelRange)
+
+	#--------------------------------------------------------------------------
+	def shareGeometry(self, positions, neighbourOffsets, neighbourIndices):
+		"""
+		Replaces the positions and the neighbours by read-only arrays, e.g.
+		of a Geometry shared by all workers of a sweep. Only the states of
+		the electronic systems are kept privately. The free-slot index is
+		not touched, see buildFreeSlotIndex().
+
+		Parameters
+		----------
+		positions : array
+			(N x 3) positions of the electronic systems, see sitePositions()
+		neighbourOffsets, neighbourIndices : array
+			Neighbours in compressed sparse row format, see neighbourList()
+		"""
+		if self.lattice is not None:
+			raise ValueError("a lattice of electron traps doesn't use a shared geometry.")
+
+		if positions.shape != self.positions.shape:
+			raise ValueError("shared geometry has %d instead of %d electronic systems."%(positions.shape[0], self.N))
+
+		self.positions = positions
+		self.neighbourOffsets = neighbourOffsets
+		self.neighbourIndices = neighbourIndices
+
+	#--------------------------------------------------------------------------
+	def buildFreeSlotIndex(self):
+		"""Builds the occupancy structure, which keeps track of the non-populated
+		electronic systems. It consists of an index list of all free systems,
+		from which entries are removed by swapping with the last one, and the
+		number of free neighbours of every system. All state changes keep it
+		up to date, so that recombinations don't need to scan the whole crystal.
+		The free neighbours in a lattice of electron traps are counted when
+		needed instead, see numberFreeNeighbours()."""
+		isFree = self.populated == 0
+		indexType = np.int32 if self.N < np.iinfo(np.int32).max else np.int64
+
+		self._freeSlots = np.zeros(self.N, dtype=indexType)
+		self._freeSlotPosition = np.full(self.N, -1, dtype=indexType)
+		self._numberFreeSlots = np.count_nonzero(isFree)
+		self._freeSlots[:self._numberFreeSlots] = np.nonzero(isFree)[0]
+		self._freeSlotPosition[self._freeSlots[:self._numberFreeSlots]] = np.arange(self._numberFreeSlots)
+
+		if self.lattice is not None:
+			self.freeNeighbourCount = None
+			return
+
+		# every system is its own neighbour, so no row of the neighbours
+		# is empty and they can be summed up row by row
+		self.freeNeighbourCount = np.add.reduceat(isFree[self.neighbourIndices], self.neighbourOffsets[:-1], dtype=indexType)
+
+	#--------------------------------------------------------------------------
+	def _occupySlot(self, idx):
+		"""Removes the electronic system with index idx from the free-slot index."""
+		if self._freeSlots is None or self._freeSlotPosition[idx] < 0:
+			return
+
+		position = self._freeSlotPosition[idx]
+		last = self._freeSlots[self._numberFreeSlots - 1]
+		self._freeSlots[position] = last
+		self._freeSlotPosition[last] = position
+		self._freeSlotPosition[idx] = -1
+		self._numberFreeSlots -= 1
+
+		# the neighbourhood is symmetric
+		if self.freeNeighbourCount is not None:
+			self.freeNeighbourCount[self.getNeighbours(idx)] -= 1
+
+	#--------------------------------------------------------------------------
+	def _releaseSlot(self, idx):
+		"""Adds the electronic system with index idx to the free-slot index."""
+		if self._freeSlots is None or self._freeSlotPosition[idx] >= 0:
+			return
+
+		self._freeSlots[self._numberFreeSlots] = idx
+		self._freeSlotPosition[idx] = self._numberFreeSlots
+		self._numberFreeSlots += 1
+
+		if self.freeNeighbourCount is not None:
+			self.freeNeighbourCount[self.getNeighbours(idx)] += 1
 
 	#--------------------------------------------------------------------------
 	def getNeighbours(self, index):
 		"""Retruns an array of indices, which are neighbouring to index
-		depending on the electron travel range."""
-		return self.neighbours[index]
+		depending on the electron travel range. This is a view into the
+		neighbour structure and must not be modified."""
+		if self.lattice is None:
+			return self.neighbourIndices[self.neighbourOffsets[index]:self.neighbourOffsets[index + 1]]
+
+		if index >= self.numberElectronTraps:
+			return self._rareEarthNeighbours[index - self.numberElectronTraps]
+
+		# the rare earths follow the electron traps, so the row stays sorted
+		neighbours = self.lattice.neighbours(index, self._stencil)
+		rareEarths = self._trapRareEarths.get(index)
+		return neighbours if rareEarths is None else np.concatenate((neighbours, rareEarths))
 
 	#--------------------------------------------------------------------------
 	def getFreeNeighbours(self, index):
-		return np.intersect1d(self.potentialRecombinationIndices, self.getNeighbours(index))
+		"""Returns an array of indices of all electronic systems which are
+		neighbouring to index and not populated."""
+		neighbours = self.getNeighbours(index)
+		return neighbours[self.populated[neighbours] == 0]
+
+	#--------------------------------------------------------------------------
+	def numberFreeNeighbours(self, index):
+		"""Returns the number of neighbours of index, which are not populated."""
+		if self.freeNeighbourCount is None:
+			return np.count_nonzero(self.populated[self.getNeighbours(index)] == 0)
+
+		return self.freeNeighbourCount[index]
 
 	#--------------------------------------------------------------------------
 	@property
 	def x(self):
 		"""Returns an array of floats, which represents the x coordinates of
 		all present electronic systems."""
-		return self.electronicSystem[:, self.idx['x']]
+		return self.siteCoordinates(0)
 
 	#--------------------------------------------------------------------------
 	@property
 	def y(self):
 		"""Returns an array of floats, which represents the y coordinates of
 		all present electronic systems."""
-		return self.electronicSystem[:, self.idx['y']]
+		return self.siteCoordinates(1)
 
 	#--------------------------------------------------------------------------
 	@property
 	def z(self):
 		"""Returns an array of floats, which represents the z coordinates of
 		all present electronic systems."""
-		return self.electronicSystem[:, self.idx['z']]
+		return self.siteCoordinates(2)
+
+	#--------------------------------------------------------------------------
+	def siteCoordinates(self, axis):
+		"""Returns the coordinates of all electronic systems along axis
+		(0, 1 or 2), which are computed for a lattice of electron traps."""
+		if self.lattice is None:
+			return self.positions[:, axis]
+
+		return np.concatenate((self.lattice.axisCoordinates(axis), self.positions[:, axis]))
 
 	#--------------------------------------------------------------------------
 	@property
 	def N(self):
 		"""Returns the total number of electronic systems.
 		That means electron traps and rare earths."""
-		return self.electronicSystem.shape[0]
+		return self.rareEarthMask.size
 
 	#--------------------------------------------------------------------------
 	@property
 	def rareEarthIndices(self):
 		"""Returns an array of integers, which represent the
 		indices of the rare earths in the electronic systems."""
-		return np.where(self.electronicSystem[:, self.idx['isRE']] == 1.0)[0]
+		return self._rareEarthIndices
 
 	#--------------------------------------------------------------------------
 	@property
 	def electronTrapIndices(self):
 		"""Returns an array of integers, which represent the
 		indices of the electron traps in the electronic systems."""
-		return np.where(self.electronicSystem[:, self.idx['isRE']] == 0.0)[0]
+		return self._electronTrapIndices
 
 	#--------------------------------------------------------------------------
 	@property
 	def population(self):
-		"""Retruns an array of floats, which represents the current
+		"""Retruns an array of integers, which represents the current
 		population of all present electronic systems. A populated system
-		is represented by 1.0, a non-populated system is represented by 0.0."""
-		return self.electronicSystem[:, self.idx['isPopulated']]
+		is represented by 1, a non-populated system is represented by 0."""
+		return self.populated
 
 	#--------------------------------------------------------------------------
 	def rareEarthGroundStateCounter(self, idx):
-		"""Returns a single float, which represents how often the electronic system
+		"""Returns a single integer, which represents how often the electronic system
 		with index idx (which must be a rare earth) has been in ground state since
 		the last counter reset."""
-		return self.electronicSystem[idx][self.idx['groundStateCounter']]
+		return self.groundStateCounter[idx - self.numberElectronTraps]
 
 	#--------------------------------------------------------------------------
 	def rareEarthExcitedStateCounter(self, idx):
-		"""Returns a single float, which represents how often the electronic system
+		"""Returns a single integer, which represents how often the electronic system
 		with index idx (which must be a rare earth) has been in excited state since
 		the last counter reset."""
-		return self.electronicSystem[idx][self.idx['excitedStateCounter']]
+		return self.excitedStateCounter[idx - self.numberElectronTraps]
 
 	#--------------------------------------------------------------------------
 	def resetRareEarthEvolutionCounters(self):
 		"""Resets both the ground and excited state counter for all rare earths
 		in the electronic system."""
-		for idx in self.rareEarthIndices:
-			self.electronicSystem[idx][self.idx['groundStateCounter']] = 0.0
-			self.electronicSystem[idx][self.idx['excitedStateCounter']] = 0.0
+		self.groundStateCounter = np.zeros(self.rareEarthState.size, dtype=np.int64)
+		self.excitedStateCounter = np.zeros(self.rareEarthState.size, dtype=np.int64)
 
 	#--------------------------------------------------------------------------
 	def recordREstates(self):
 		"""Updates either the ground or excited state counter for all rare earths
 		present in the system depending on their current electronic states."""
-		for idx in self.rareEarthIndices:
-			if self.electronicSystem[idx][self.idx['reState']] == self._states['ground']:
-				self.electronicSystem[idx][self.idx['groundStateCounter']] += 1.0
-
-			elif self.electronicSystem[idx][self.idx['reState']] == self._states['excited']:
-				self.electronicSystem[idx][self.idx['excitedStateCounter']] += 1.0
-
-			else:
-				pass
+		self.groundStateCounter += self.rareEarthState == self.GROUND
+		self.excitedStateCounter += self.rareEarthState == self.EXCITED
 
 	#--------------------------------------------------------------------------
 	def getPosition(self, idx):
 		"""Returns an array of floats, which represents the absolute position
 		of the electronic system with index idx. The position is read as [x, y, z]."""
-		return self.electronicSystem[idx][:self.idx['z'] + 1]
+		if self.lattice is None:
+			return self.positions[idx]
+
+		if idx < self.numberElectronTraps:
+			return self.lattice.coordinates(idx)
+
+		return self.positions[idx - self.numberElectronTraps]
 
 	#--------------------------------------------------------------------------
 	def isPopulated(self, idx):
-		"""Returns a single float, which indicated whether the electronic system
-		with index idx is populated (1.0) or not populated (0.0)."""
-		return self.electronicSystem[idx][self.idx['isPopulated']]
+		"""Returns a single integer, which indicated whether the electronic system
+		with index idx is populated (1) or not populated (0)."""
+		return self.populated[idx]
 
 	#--------------------------------------------------------------------------
 	def populate(self, idx):
@@ -280,29 +636,42 @@ class ElectronicSystem(object):
 		doesn't take care whether this is physically possible or not, nor
 		does it take care if the system to be populated is a rare earth or
 		and must be put into some electronic state."""
-		self.electronicSystem[idx][self.idx['isPopulated']] = 1.0
+		self.populated[idx] = 1
+		self._occupySlot(idx)
+
+	#--------------------------------------------------------------------------
+	def depopulate(self, idx):
+		"""Removes the electron from the electronic system with index idx.
+		Like populate(), this doesn't take care of any electronic state."""
+		self.populated[idx] = 0
+		self._releaseSlot(idx)
 
 	#--------------------------------------------------------------------------
 	def isRareEarth(self, idx):
-		"""Returns a float representing whether the electronic system
-		with index idx is a rare earth (1.0) or an electron trap (0.0)."""
-		return self.electronicSystem[idx][self.idx['isRE']]
+		"""Returns a boolean representing whether the electronic system
+		with index idx is a rare earth (True) or an electron trap (False)."""
+		return self.rareEarthMask[idx]
 
 	#--------------------------------------------------------------------------
 	@property
 	def potentialRecombinationIndices(self):
 		"""Retruns an array of integers representing the indices of all
-		electronic systems which are not populated."""
-		return np.where(self.electronicSystem[:, self.idx['isPopulated']] == 0.0)[0]
+		electronic systems which are not populated. Once the free-slot index
+		is built, this is a view into it and the indices are not sorted."""
+		if self._freeSlots is None:
+			return np.where(self.populated == 0)[0]
+
+		return self._freeSlots[:self._numberFreeSlots]
 
 	#--------------------------------------------------------------------------
 	def restore(self, idx):
 		"""Populates a rare earth with index idx if it is currently ionized
 		and puts its electron to ground state. Here, the electron comes from
 		the valence band."""
-		if self.electronicSystem[idx][self.idx['reState']] == self._states['ionized']:
+		reCnt = idx - self.numberElectronTraps
+		if self.rareEarthState[reCnt] == self.IONIZED:
 			self.populate(idx)
-			self.electronicSystem[idx][self.idx['reState']] = self._states['ground']
+			self.rareEarthState[reCnt] = self.GROUND
 			return 2
 
 		else:
@@ -312,18 +681,20 @@ class ElectronicSystem(object):
 	def excite(self, idx):
 		"""Puts the electron of the rare earth with index idx to excited state
 		if it currently is in ground state."""
-		if self.electronicSystem[idx][self.idx['reState']] == self._states['ground']:
-			self.electronicSystem[idx][self.idx['reState']] = self._states['excited']
+		reCnt = idx - self.numberElectronTraps
+		if self.rareEarthState[reCnt] == self.GROUND:
+			self.rareEarthState[reCnt] = self.EXCITED
 	
 		return 0
 
 	#--------------------------------------------------------------------------
 	def ionizeRE(self, idx):
 		"""Ionizes the rare earth with index idx if it currently is in excited state."""
-		if self.electronicSystem[idx][self.idx['isPopulated']]:
-			if self.electronicSystem[idx][self.idx['reState']] == self._states['excited']:
-				self.electronicSystem[idx][self.idx['reState']] = self._states['ionized']
-				self.electronicSystem[idx][self.idx['isPopulated']] = 0.0
+		reCnt = idx - self.numberElectronTraps
+		if self.populated[idx]:
+			if self.rareEarthState[reCnt] == self.EXCITED:
+				self.rareEarthState[reCnt] = self.IONIZED
+				self.depopulate(idx)
 				return 1
 
 			else:
@@ -335,8 +706,8 @@ class ElectronicSystem(object):
 	#--------------------------------------------------------------------------
 	def ionizeET(self, idx):
 		"""Ionizes an electron trap with index idx."""
-		if self.electronicSystem[idx][self.idx['isPopulated']]:
-			self.electronicSystem[idx][self.idx['isPopulated']] = 0.0
+		if self.populated[idx]:
+			self.depopulate(idx)
 			return 1
 
 		else:
@@ -346,8 +717,9 @@ class ElectronicSystem(object):
 	def decay(self, idx):
 		"""Puts the electron of a rare earth with index idx to ground state
 		if it currently is in excited state."""
-		if self.electronicSystem[idx][self.idx['reState']] == self._states['excited']:
-			self.electronicSystem[idx][self.idx['reState']] = self._states['ground']
+		reCnt = idx - self.numberElectronTraps
+		if self.rareEarthState[reCnt] == self.EXCITED:
+			self.rareEarthState[reCnt] = self.GROUND
 
 		return 0
 
@@ -365,7 +737,7 @@ class ElectronicSystem(object):
 		self.populate(idx)
 
 		if self.isRareEarth(idx):
-			self.electronicSystem[idx][self.idx['reState']] = self._states['excited']
+			self.rareEarthState[idx - self.numberElectronTraps] = self.EXCITED
 
 		return 0
 
@@ -373,7 +745,7 @@ class ElectronicSystem(object):
 	def actOnElectronTrap(self, idx, probability):
 		"""Decides whether an operation is perfomed on an electron trap
 		depending on its transition probability."""
-		if probability <= self.electronicSystem[idx][self.idx['pIonize']]:
+		if probability <= self.pIonize[idx]:
 			return self.ionizeET(idx)
 
 		else:
@@ -383,21 +755,194 @@ class ElectronicSystem(object):
 	def actOnRareEarth(self, idx, probability):
 		"""Decides whether and which operation is performed on a rare earth
 		depending on the corresponding transition probabilities."""
-		if probability <= self.electronicSystem[idx][self.idx['pDecay']]:
+		thresholds = self.rareEarthThresholds[idx - self.numberElectronTraps]
+
+		if probability <= thresholds[self.DECAY]:
 			return self.decay(idx)
 
-		elif probability <= self.electronicSystem[idx][self.idx['pIonize']]:
+		elif probability <= thresholds[self.IONIZE]:
 			return self.ionizeRE(idx)
 
-		elif probability <= self.electronicSystem[idx][self.idx['pExcite']]:
+		elif probability <= thresholds[self.EXCITE]:
 			return self.excite(idx)
 
-		elif probability <= self.electronicSystem[idx][self.idx['pRepump']]:
+		elif probability <= thresholds[self.REPUMP]:
 			return self.restore(idx)
 
-		elif probability <= self.electronicSystem[idx][self.idx['pDeplete']]:
+		elif probability <= thresholds[self.DEPLETE]:
 			return self.deplete(idx)
 
 		else:
 			return 0
 
+	#--------------------------------------------------------------------------
+	def actOnElectronTraps(self, indices, probabilities):
+		"""Vectorized version of actOnElectronTrap(). Ionizes all populated
+		electron traps in indices whose ionization probability is not smaller
+		than the corresponding random number. Returns an array of result codes
+		in the same order as indices (1 for ionized, 0 otherwise)."""
+		ionize = (self.populated[indices] == 1) & (probabilities <= self.pIonize[indices])
+
+		for idx in indices[ionize]:
+			self.depopulate(idx)
+
+		return ionize.astype(np.int8)
+
+	#--------------------------------------------------------------------------
+	def actOnRareEarths(self, indices, probabilities):
+		"""Vectorized version of actOnRareEarth(). Applies the decay, ionize,
+		excite, repump and deplete thresholds to all rare earths in indices at
+		once. Returns an array of result codes in the same order as indices
+		(1 for ionized, 2 for restored, 0 otherwise)."""
+		reCnt = indices - self.numberElectronTraps
+
+		# the thresholds are cumulative, so counting the exceeded
+		# ones yields the action to perform
+		action = np.sum(probabilities[:, np.newaxis] > self.rareEarthThresholds[reCnt], axis=1)
+		state = self.rareEarthState[reCnt]
+
+		self.rareEarthState[reCnt] = self._reTransitions[action, state]
+
+		result = self._reResults[action, state]
+		for idx in indices[result == 1]:
+			self.depopulate(idx)
+
+		for idx in indices[result == 2]:
+			self.populate(idx)
+
+		return result
+
+
+#==============================================================================
+class ElectronicSystemEnsemble(ElectronicSystem):
+	__slots__ = ('laserXpos', 'laserYpos', 'populations', 'rareEarthStates',
+				 'groundStateCounters', 'excitedStateCounters')
+
+	#--------------------------------------------------------------------------
+	def __init__(self, RExPos, REyPos, ETxPos, ETyPos, pumpBeam, stedBeam, REzPos=None, ETzPos=None):
+		"""
+		Construct an ensemble of electronic systems, which share the same
+		geometry, but are illuminated from different laser positions. All
+		populations, rare earth states and transition probabilities are
+		stored as (laser positions x electronic systems) arrays, so that
+		a whole scan can be advanced by one vectorized update.
+
+		Parameters
+		----------
+		RExPos, REyPos, ETxPos, ETyPos, REzPos, ETzPos : array-like
+			See ElectronicSystem()
+		pumpBeam : Object of type LaserProfiles.PumpBeam()
+			Excitation laser, its x and y coordinates are arrays
+			holding all laser positions of the ensemble
+		stedBeam : Object of type LaserProfiles.StedBeam()
+			STED laser, its x and y coordinates are arrays
+			holding all laser positions of the ensemble
+		"""
+		super(ElectronicSystemEnsemble, self).__init__(RExPos, REyPos, ETxPos, ETyPos, pumpBeam, stedBeam, REzPos, ETzPos)
+
+		laserXpos, laserYpos = np.broadcast_arrays(np.ravel(pumpBeam.x), np.ravel(pumpBeam.y))
+		self.laserXpos = laserXpos
+		self.laserYpos = laserYpos
+
+		# let the beam profiles broadcast over (laser positions x electronic systems)
+		for beam in (self._pumpBeam, self._stedBeam):
+			beam.x = laserXpos[:, np.newaxis]
+			beam.y = laserYpos[:, np.newaxis]
+
+	#--------------------------------------------------------------------------
+	def setTransitionProbabilities(self, pIonize, rareEarthThresholds):
+		"""
+		Sets the transition probabilities of each electronic system for every
+		laser position of the ensemble and sets up the initial state. The
+		probabilities are (laser positions x electron traps) and (laser
+		positions x rare earths x thresholds) arrays, they are calculated
+		by ElectronicSystem.setupTransitionProbabilities() with the beams
+		broadcasting over all laser positions.
+		"""
+		self.pIonize = pIonize
+		self.rareEarthThresholds = rareEarthThresholds
+
+		# every laser position starts from the same initial state
+		self.populations = np.tile(self.populated, (self.numberLaserPositions, 1))
+		self.rareEarthStates = np.tile(self.rareEarthState, (self.numberLaserPositions, 1))
+
+		self.resetRareEarthEvolutionCounters()
+
+	#--------------------------------------------------------------------------
+	@property
+	def numberLaserPositions(self):
+		"""Returns the number of laser positions in the ensemble."""
+		return self.laserXpos.size
+
+	#--------------------------------------------------------------------------
+	@property
+	def population(self):
+		"""Returns a (laser positions x electronic systems) array of integers,
+		which represents the current population of all electronic systems."""
+		return self.populations
+
+	#--------------------------------------------------------------------------
+	def buildFreeSlotIndex(self):
+		"""The ensemble looks up the free neighbours of every laser position
+		directly in its populations, see getFreeNeighbours()."""
+		pass
+
+	#--------------------------------------------------------------------------
+	def getFreeNeighbours(self, position, index):
+		"""Returns an array of indices of all electronic systems which are
+		neighbouring to index and not populated for the given laser position."""
+		neighbours = self.getNeighbours(index)
+		return neighbours[self.populations[position, neighbours] == 0]
+
+	#--------------------------------------------------------------------------
+	def resetRareEarthEvolutionCounters(self):
+		"""Resets both the ground and excited state counter for all rare earths
+		at all laser positions."""
+		self.groundStateCounters = np.zeros(self.rareEarthStates.shape, dtype=np.int64)
+		self.excitedStateCounters = np.zeros(self.rareEarthStates.shape, dtype=np.int64)
+
+	#--------------------------------------------------------------------------
+	def recordREstates(self):
+		"""Updates either the ground or excited state counter for all rare earths
+		at all laser positions depending on their current electronic states."""
+		self.groundStateCounters += self.rareEarthStates == self.GROUND
+		self.excitedStateCounters += self.rareEarthStates == self.EXCITED
+
+	#--------------------------------------------------------------------------
+	def recombine(self, position, idx):
+		"""Populates the electronic system with index idx for the given laser
+		position. If this system is a rare earth, its state is set to excited
+		state. Here, the electron comes from the conduction band."""
+		self.populations[position, idx] = 1
+
+		if self.rareEarthMask[idx]:
+			self.rareEarthStates[position, idx - self.numberElectronTraps] = self.EXCITED
+
+		return 0
+
+	#--------------------------------------------------------------------------
+	def actOnElectronTraps(self, positions, indices, probabilities):
+		"""Vectorized version of actOnElectronTrap() for pairs of laser
+		positions and electron trap indices. Returns an array of result
+		codes (1 for ionized, 0 otherwise)."""
+		ionize = (self.populations[positions, indices] == 1) & (probabilities <= self.pIonize[positions, indices])
+
+		self.populations[positions[ionize], indices[ionize]] = 0
+
+		return ionize.astype(np.int8)
+
+	#--------------------------------------------------------------------------
+	def actOnRareEarths(self, probabilities):
+		"""Vectorized version of actOnRareEarth() for all rare earths at all
+		laser positions. probabilities is a (laser positions x rare earths)
+		array. Returns an array of result codes of the same shape
+		(1 for ionized, 2 for restored, 0 otherwise)."""
+		action = np.sum(probabilities[..., np.newaxis] > self.rareEarthThresholds, axis=-1)
+		state = self.rareEarthStates
+
+		newState = self._reTransitions[action, state]
+		self.rareEarthStates = newState
+		self.populations[:, self.numberElectronTraps:] = newState != self.IONIZED
+
+		return self._reResults[action, state]
+
@@ -0,0 +1,329 @@
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def lorentzian(x, parameters):
+	"""
+	Lorentzian profile with constant offset, parametrized like the
+	LorentzianModel + ConstantModel of lmfit, for a batch of curves.
+
+	Parameters
+	----------
+	x : numpy.ndarray
+		(number of curves x number of points) array of positions
+	parameters : numpy.ndarray
+		(number of curves x 4) array of [amplitude, center, sigma, c],
+		the FWHM is 2*sigma
+	"""
+	amplitude, center, sigma, c = [p[:, np.newaxis] for p in parameters.T]
+	return amplitude/np.pi * sigma/((x - center)**2 + sigma**2) + c
+
+#------------------------------------------------------------------------------
+def lorentzianJacobian(x, parameters):
+	"""Returns the derivatives of lorentzian() by its parameters as
+	(number of curves x number of points x 4) array."""
+	amplitude, center, sigma, c = [p[:, np.newaxis] for p in parameters.T]
+	distance = x - center
+	denominator = distance**2 + sigma**2
+
+	jacobian = np.empty(x.shape + (4,))
+	jacobian[..., 0] = sigma/(np.pi*denominator)
+	jacobian[..., 1] = amplitude/np.pi * 2.0*sigma*distance/denominator**2
+	jacobian[..., 2] = amplitude/np.pi * (distance**2 - sigma**2)/denominator**2
+	jacobian[..., 3] = 1.0
+	return jacobian
+
+#------------------------------------------------------------------------------
+def guessLorentzian(x, y):
+	"""Returns initial parameters for lorentzian() from the peak of every
+	curve, missing points are NaN."""
+	valid = np.isfinite(x) & np.isfinite(y)
+	yValid = np.where(valid, y, np.nan)
+
+	c = np.maximum(np.nanmin(yValid, axis=1), 0.0)
+	height = np.nanmax(yValid, axis=1) - c
+	center = x[np.arange(x.shape[0]), np.nanargmax(yValid, axis=1)]
+
+	# half of the range of the positions above half of the height
+	aboveHalf = valid & (np.where(valid, y, -np.inf) - c[:, np.newaxis] >= 0.5*height[:, np.newaxis])
+	width = np.where(aboveHalf, x, -np.inf).max(axis=1) - np.where(aboveHalf, x, np.inf).min(axis=1)
+	spacing = np.nanmax(np.where(valid, x, np.nan), axis=1) - np.nanmin(np.where(valid, x, np.nan), axis=1)
+	sigma = np.maximum(0.5*width, spacing/(4.0*np.maximum(valid.sum(axis=1), 1)))
+
+	return np.column_stack((height*np.pi*sigma, center, sigma, c))
+
+#------------------------------------------------------------------------------
+def powerLaw(x, parameters):
+	"""
+	Power law with constant offset, amplitude * x**exponent + c, for a
+	batch of curves.
+
+	Parameters
+	----------
+	x : numpy.ndarray
+		(number of curves x number of points) array of positive values
+	parameters : numpy.ndarray
+		(number of curves x 3) array of [amplitude, exponent, c]
+	"""
+	amplitude, exponent, c = [p[:, np.newaxis] for p in parameters.T]
+	return amplitude * x**exponent + c
+
+#------------------------------------------------------------------------------
+def powerLawJacobian(x, parameters):
+	"""Returns the derivatives of powerLaw() by its parameters as
+	(number of curves x number of points x 3) array."""
+	amplitude, exponent, c = [p[:, np.newaxis] for p in parameters.T]
+	power = x**exponent
+
+	jacobian = np.empty(x.shape + (3,))
+	jacobian[..., 0] = power
+	jacobian[..., 1] = amplitude * power * np.log(x)
+	jacobian[..., 2] = 1.0
+	return jacobian
+
+#------------------------------------------------------------------------------
+def guessPowerLaw(x, y):
+	"""Returns initial parameters for powerLaw() from a linear fit of the
+	logarithms of every curve without offset."""
+	valid = np.isfinite(x) & np.isfinite(y) & (x > 0.0) & (y > 0.0)
+	logX = np.where(valid, np.log(np.where(valid, x, 1.0)), 0.0)
+	logY = np.where(valid, np.log(np.where(valid, y, 1.0)), 0.0)
+
+	number = np.maximum(valid.sum(axis=1), 1)
+	meanX = logX.sum(axis=1)/number
+	meanY = logY.sum(axis=1)/number
+	varianceX = (valid*(logX - meanX[:, np.newaxis])**2).sum(axis=1)
+	covariance = (valid*(logX - meanX[:, np.newaxis])*(logY - meanY[:, np.newaxis])).sum(axis=1)
+
+	exponent = np.where(varianceX > 0.0, covariance/np.where(varianceX > 0.0, varianceX, 1.0), 0.0)
+	amplitude = np.exp(meanY - exponent*meanX)
+	return np.column_stack((amplitude, exponent, np.zeros_like(amplitude)))
+
+#------------------------------------------------------------------------------
+def levenbergMarquardt(function, jacobian, x, y, parameters, lower=None, upper=None, maxIterations=200, tolerance=1E-10, weights=None):
+	"""
+	Fits a model to a batch of curves at once with the Levenberg-Marquardt
+	algorithm, every curve with its own damping. Box constraints are kept
+	by projecting the steps onto the bounds. Missing points are NaN.
+
+	Parameters
+	----------
+	function : callable
+		function(x, parameters) returns the model of all curves
+	jacobian : callable
+		jacobian(x, parameters) returns its derivatives by the parameters
+	x : numpy.ndarray
+		(number of curves x number of points) array of positions
+	y : numpy.ndarray
+		(number of curves x number of points) array of data
+	parameters : numpy.ndarray
+		(number of curves x number of parameters) array of initial values
+	lower, upper : array-like or None
+		Bounds of the parameters
+	maxIterations : int
+		Maximum number of iterations
+	tolerance : float
+		Relative decrease of the sum of squares at convergence
+	weights : numpy.ndarray or None
+		(number of curves x number of points) array of weights of the
+		residuals, e.g. the inverse standard errors of the data
+
+	Returns
+	-------
+	parameters : numpy.ndarray
+		Best fit parameters
+	chiSquare : numpy.ndarray
+		Sum of squared (weighted) residuals of every curve
+	"""
+	lower = -np.inf if lower is None else np.asarray(lower, dtype=float)
+	upper = np.inf if upper is None else np.asarray(upper, dtype=float)
+
+	valid = np.isfinite(x) & np.isfinite(y)
+	x = np.where(valid, x, 1.0)
+	y = np.where(valid, y, 0.0)
+	weights = np.ones(x.shape) if weights is None else np.where(valid, weights, 0.0)
+
+	def residuals(curves, p):
+		return np.where(valid[curves], weights[curves]*(function(x[curves], p) - y[curves]), 0.0)
+
+	parameters = np.clip(np.array(parameters, dtype=float), lower, upper)
+	chiSquare = (residuals(slice(None), parameters)**2).sum(axis=1)
+	damping = 1E-3*np.ones(parameters.shape[0])
+	active = np.ones(parameters.shape[0], dtype=bool)
+	identity = np.eye(parameters.shape[1])
+
+	for iteration in xrange(maxIterations):
+		if not np.any(active):
+			break
+
+		p = parameters[active]
+		J = jacobian(x[active], p) * (valid[active]*weights[active])[..., np.newaxis]
+		r = residuals(active, p)
+
+		JTJ = np.einsum('bni,bnj->bij', J, J)
+		gradient = np.einsum('bni,bn->bi', J, r)
+
+		# parameters at a bound, which would be pushed beyond it, are fixed
+		fixed = ((p <= lower) & (gradient > 0.0)) | ((p >= upper) & (gradient < 0.0))
+		free = ~fixed
+		JTJ = JTJ * (free[:, :, np.newaxis] & free[:, np.newaxis, :]) + fixed[:, :, np.newaxis]*identity
+		gradient = gradient * free
+		diagonal = JTJ[:, np.arange(p.shape[1]), np.arange(p.shape[1])]
+		lhs = JTJ + damping[active][:, np.newaxis, np.newaxis] * (diagonal[:, :, np.newaxis]*identity + 1E-12*identity)
+
+		step = np.linalg.solve(lhs, -gradient[..., np.newaxis])[..., 0]
+		trial = np.clip(p + step, lower, upper)
+		trialChiSquare = (residuals(active, trial)**2).sum(axis=1)
+
+		improved = np.isfinite(trialChiSquare) & (trialChiSquare < chiSquare[active])
+		converged = improved & (chiSquare[active] - trialChiSquare <= tolerance*chiSquare[active])
+		converged |= ~improved & (damping[active] > 1E10)
+
+		indices = np.flatnonzero(active)
+		parameters[indices[improved]] = trial[improved]
+		chiSquare[indices[improved]] = trialChiSquare[improved]
+		damping[indices] = np.where(improved, damping[indices]/3.0, damping[indices]*2.0)
+		active[indices[converged]] = False
+
+	return parameters, chiSquare
+
+#------------------------------------------------------------------------------
+def fitLorentzians(x, y):
+	"""
+	Fits a Lorentzian with constant offset c >= 0 to every curve and
+	returns the (number of curves x 4) array of parameters (see
+	lorentzian()) and the FWHM of every curve.
+
+	Parameters
+	----------
+	x, y : array-like
+		(number of curves x number of points) arrays, missing points are NaN
+	"""
+	x = np.atleast_2d(np.asarray(x, dtype=float))
+	y = np.atleast_2d(np.asarray(y, dtype=float))
+
+	parameters, chiSquare = levenbergMarquardt(lorentzian, lorentzianJacobian, x, y, guessLorentzian(x, y),
+											   lower=[-np.inf, -np.inf, 0.0, 0.0])
+	return parameters, 2.0*parameters[:, 2]
+
+#------------------------------------------------------------------------------
+def fitLorentziansWithErrors(x, y, error=None):
+	"""
+	Fits a Lorentzian with constant offset c >= 0 to every curve like
+	fitLorentzians(), but weights the points by their standard errors and
+	estimates the errors of the parameters as well.
+
+	The covariance of the parameters is taken from the Jacobian at the fit.
+	It is scaled up by the reduced chi-square, if the points scatter more
+	than their errors, but never down, so that a fit of a few points
+	doesn't look precise by chance. Curves with no more points than
+	parameters have an infinite FWHM error.
+
+	Parameters
+	----------
+	x, y : array-like
+		(number of curves x number of points) arrays, missing points are NaN
+	error : array-like or None
+		Standard errors of y. Points without a positive error, e.g. of
+		simulations without fluctuations, get the median error of their
+		curve.
+
+	Returns
+	-------
+	parameters : numpy.ndarray
+		(number of curves x 4) array of parameters, see lorentzian()
+	fwhm, fwhmError : numpy.ndarray
+		FWHM of every curve and its standard error
+	covariance : numpy.ndarray
+		(number of curves x 4 x 4) covariance matrices of the parameters
+	"""
+	x = np.atleast_2d(np.asarray(x, dtype=float))
+	y = np.atleast_2d(np.asarray(y, dtype=float))
+	error = np.ones(y.shape) if error is None else np.atleast_2d(np.asarray(error, dtype=float))
+
+	valid = np.isfinite(x) & np.isfinite(y)
+	known = valid & np.isfinite(error) & (error > 0.0)
+	typical = np.array([np.median(e[k]) if np.any(k) else 1.0 for e, k in zip(error, known)])
+	weights = 1.0/np.where(known, error, typical[:, np.newaxis])
+
+	parameters, chiSquare = levenbergMarquardt(lorentzian, lorentzianJacobian, x, y, guessLorentzian(x, y),
+											   lower=[-np.inf, -np.inf, 0.0, 0.0], weights=weights)
+
+	J = lorentzianJacobian(np.where(valid, x, 0.0), parameters) * (valid*weights)[..., np.newaxis]
+	covariance = np.array([np.linalg.pinv(m) for m in np.einsum('bni,bnj->bij', J, J)])
+
+	degreesOfFreedom = valid.sum(axis=1) - parameters.shape[1]
+	covariance *= np.maximum(chiSquare/np.maximum(degreesOfFreedom, 1), 1.0)[:, np.newaxis, np.newaxis]
+	fwhmError = np.where(degreesOfFreedom > 0, 2.0*np.sqrt(np.abs(covariance[:, 2, 2])), np.inf)
+
+	return parameters, 2.0*parameters[:, 2], fwhmError, covariance
+
+#------------------------------------------------------------------------------
+def fitPowerLaws(x, y):
+	"""
+	Fits a power law with constant offset c >= 0 and an exponent between
+	-10 and 0 to every curve and returns the (number of curves x 3) array
+	of parameters (see powerLaw()).
+
+	Parameters
+	----------
+	x, y : array-like
+		(number of curves x number of points) arrays, missing points are NaN
+	"""
+	x = np.atleast_2d(np.asarray(x, dtype=float))
+	y = np.atleast_2d(np.asarray(y, dtype=float))
+
+	parameters, chiSquare = levenbergMarquardt(powerLaw, powerLawJacobian, x, y, np.clip(guessPowerLaw(x, y), [-np.inf, -10.0, 0.0], [np.inf, 0.0, np.inf]),
+											   lower=[-np.inf, -10.0, 0.0], upper=[np.inf, 0.0, np.inf])
+	return parameters
+
+#------------------------------------------------------------------------------
+def fitSweep(data):
+	"""
+	Fits all point spread functions of a pump x STED amplitude sweep at once:
+	a Lorentzian with offset to every normalized point spread function and a
+	power law with offset to the FWHM over the STED amplitude of every pump
+	amplitude.
+
+	Parameters
+	----------
+	data : dict
+		data[pumpAmplitude][stedAmplitude] = [laserXpos, excitedStateAverage]
+		as built by Postprocessor.getData()
+
+	Returns
+	-------
+	dict
+		pumpAmplitudes (P), stedAmplitudes (S), fwhm (P x S), lorentzians
+		(P x S x 4, see lorentzian()), powerLaws (P x 3, see powerLaw()),
+		powerLawGuesses (P x 3) and exponents (P). Missing point spread
+		functions are NaN.
+	"""
+	pumpAmplitudes = np.array(sorted(data.keys()))
+	stedAmplitudes = np.array(sorted(set(sa for pa in data.keys() for sa in data[pa].keys())))
+	curves = [(i, j) for i, pa in enumerate(pumpAmplitudes) for j, sa in enumerate(stedAmplitudes)
+			  if sa in data[pa] and len(data[pa][sa][0]) and np.max(data[pa][sa][1]) > 0.0]
+
+	numberPoints = max([len(data[pumpAmplitudes[i]][stedAmplitudes[j]][0]) for i, j in curves] + [1])
+	x = np.nan*np.ones((len(curves), numberPoints))
+	y = np.nan*np.ones((len(curves), numberPoints))
+	for cnt, (i, j) in enumerate(curves):
+		laserXpos, excitedStateAverage = data[pumpAmplitudes[i]][stedAmplitudes[j]]
+		x[cnt, :len(laserXpos)] = laserXpos
+		y[cnt, :len(laserXpos)] = np.asarray(excitedStateAverage, dtype=float)/np.max(excitedStateAverage)
+
+	lorentzians = np.nan*np.ones((pumpAmplitudes.size, stedAmplitudes.size, 4))
+	if curves:
+		rows, columns = np.array(curves).T
+		lorentzians[rows, columns] = fitLorentzians(x, y)[0]
+	fwhm = 2.0*lorentzians[..., 2]
+
+	sted = np.tile(stedAmplitudes.astype(float), (pumpAmplitudes.size, 1))
+	powerLawGuesses = np.clip(guessPowerLaw(sted, fwhm), [-np.inf, -10.0, 0.0], [np.inf, 0.0, np.inf])
+	powerLaws = fitPowerLaws(sted, fwhm) if pumpAmplitudes.size else np.zeros((0, 3))
+	powerLaws[~np.any(np.isfinite(fwhm), axis=1)] = np.nan
+
+	return dict(pumpAmplitudes=pumpAmplitudes, stedAmplitudes=stedAmplitudes, fwhm=fwhm,
+				lorentzians=lorentzians, powerLaws=powerLaws, powerLawGuesses=powerLawGuesses,
+				exponents=powerLaws[:, 1])
@@ -0,0 +1,128 @@
+
+import json
+import os
+import shutil
+
+from ElectronicSystems import neighbourList, sitePositions
+from Lattice import RegularLattice
+from Utility import openReadOnly
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def openGeometry(directory):
+	"""Returns the Geometry in directory. Every worker opens a geometry only
+	once for all of its simulations, unless it was replaced."""
+	return openReadOnly(Geometry, directory, 'geometry.json')
+
+#------------------------------------------------------------------------------
+def crystalCoordinates(REcoord, ETcoord):
+	"""
+	Returns the coordinates of the rare earths and the electron traps as
+	keyword arguments of setupSimulation(). The z coordinates are only
+	returned for a three-dimensional crystal, i.e. if either of them has
+	a third coordinate, the other one is in the focal plane then.
+
+	Parameters
+	----------
+	REcoord : array-like
+		[x, y] or [x, y, z] of the rare earths, scalars or arrays
+	ETcoord : array-like or Lattice.RegularLattice
+		(electron traps x 2) or (electron traps x 3) coordinates, or the
+		lattice of the electron traps, which is passed on as ETx
+	"""
+	if isinstance(ETcoord, RegularLattice):
+		coordinates = dict(REx=REcoord[0], REy=REcoord[1], ETx=ETcoord, ETy=None)
+		if len(REcoord) > 2 or ETcoord.dimensions > 2:
+			coordinates['REz'] = REcoord[2] if len(REcoord) > 2 else np.zeros(np.size(REcoord[0]))
+		return coordinates
+
+	ETcoord = np.asarray(ETcoord)
+	coordinates = dict(REx=REcoord[0], REy=REcoord[1], ETx=ETcoord[:,0], ETy=ETcoord[:,1])
+
+	if len(REcoord) > 2 or ETcoord.shape[1] > 2:
+		coordinates['REz'] = REcoord[2] if len(REcoord) > 2 else np.zeros(np.size(REcoord[0]))
+		coordinates['ETz'] = ETcoord[:,2] if ETcoord.shape[1] > 2 else np.zeros(ETcoord.shape[0])
+
+	return coordinates
+
+#------------------------------------------------------------------------------
+def createGeometry(directory, REx, REy, ETx, ETy, eTR, REz=None, ETz=None):
+	"""
+	Saves the positions of all electronic systems of a crystal and their
+	neighbours within the electron travel range as a Geometry to directory,
+	replacing an existing one.
+
+	Parameters
+	----------
+	directory : str
+		Directory of the geometry
+	REx, REy, ETx, ETy : array-like
+		Coordinates of the rare earths and the electron traps
+	eTR : float
+		Electron travel range
+	REz, ETz : array-like or None
+		z coordinates of a three-dimensional crystal
+	"""
+	positions = sitePositions(REx, REy, ETx, ETy, REz, ETz)
+	neighbourOffsets, neighbourIndices = neighbourList(positions, eTR)
+
+	# the geometry appears only after it is complete
+	temporaryDirectory = os.path.normpath(directory) + '.tmp'
+	shutil.rmtree(temporaryDirectory, ignore_errors=True)
+	os.makedirs(temporaryDirectory)
+
+	for name, array in (('positions', positions), ('neighbourOffsets', neighbourOffsets), ('neighbourIndices', neighbourIndices)):
+		np.save(os.path.join(temporaryDirectory, name + '.npy'), array)
+
+	with open(os.path.join(temporaryDirectory, 'geometry.json'), 'w') as f:
+		json.dump(dict(numberElectronTraps=int(positions.shape[0] - np.size(REx)), electronTravelRange=float(eTR)), f, indent=1)
+
+	shutil.rmtree(directory, ignore_errors=True)
+	os.rename(temporaryDirectory, directory)
+
+
+#==============================================================================
+class Geometry(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, directory):
+		"""
+		Positions and neighbours of the electronic systems of a crystal,
+		created by createGeometry(). They don't change during a sweep, so
+		they are memory-mapped read-only and shared by all workers, while
+		every simulator keeps only the states of the electronic systems.
+
+		Parameters
+		----------
+		directory : str
+			Directory of the geometry
+		"""
+		self.directory = directory
+
+		with open(os.path.join(directory, 'geometry.json'), 'r') as f:
+			description = json.load(f)
+
+		self.numberElectronTraps = description['numberElectronTraps']
+		self.electronTravelRange = description['electronTravelRange']
+
+		# plain arrays on top of the memory maps, so they are pickled
+		# like any other array
+		for name in ('positions', 'neighbourOffsets', 'neighbourIndices'):
+			setattr(self, name, np.asarray(np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')))
+
+	#--------------------------------------------------------------------------
+	def coordinates(self):
+		"""Returns the coordinates of the rare earths and the electron traps
+		as keyword arguments of setupSimulation(), including the z
+		coordinates of a three-dimensional crystal."""
+		coordinates = dict(REx=self.positions[self.numberElectronTraps:, 0], REy=self.positions[self.numberElectronTraps:, 1],
+						   ETx=self.positions[:self.numberElectronTraps, 0], ETy=self.positions[:self.numberElectronTraps, 1])
+
+		if np.any(self.positions[:, 2]):
+			coordinates.update(REz=self.positions[self.numberElectronTraps:, 2], ETz=self.positions[:self.numberElectronTraps, 2])
+
+		return coordinates
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
@@ -5,12 +5,14 @@ import numpy as np
 #==============================================================================
 class LaserBeamGaussian(object):
 	#--------------------------------------------------------------------------
-	def __init__(self, x=0.0, y=0.0, amplitude=1.0, wavelength=1E-6, numAperture=1.3):
+	def __init__(self, x=0.0, y=0.0, amplitude=1.0, wavelength=1E-6, numAperture=1.3, z=0.0, refractiveIndex=1.518):
 		self._xPos = x
 		self._yPos = y
+		self._zPos = z
 		self._amplitude = amplitude
 		self._wavelength = wavelength
 		self._numAperture = numAperture
+		self._refractiveIndex = refractiveIndex
 
 	#--------------------------------------------------------------------------
 	def __del__(self):
@@ -34,6 +36,16 @@ class LaserBeamGaussian(object):
 	def y(self, value):
 		self._yPos = value
 
+	#--------------------------------------------------------------------------
+	@property
+	def z(self):
+		"""Axial position of the focal plane."""
+		return self._zPos
+
+	@z.setter
+	def z(self, value):
+		self._zPos = value
+
 	#--------------------------------------------------------------------------
 	@property
 	def amplitude(self):
@@ -61,6 +73,15 @@ class LaserBeamGaussian(object):
 	def numericalAperture(self, value):
 		self._numAperture = value
 
+	#--------------------------------------------------------------------------
+	@property
+	def refractiveIndex(self):
+		return self._refractiveIndex
+
+	@refractiveIndex.setter
+	def refractiveIndex(self, value):
+		self._refractiveIndex = value
+
 	#--------------------------------------------------------------------------
 	@property
 	def fwhm(self):
@@ -71,11 +92,27 @@ class LaserBeamGaussian(object):
 	def sigma(self):
 		return self.fwhm/2.0
 
+	#--------------------------------------------------------------------------
+	@property
+	def rayleighRange(self):
+		"""Returns the distance from the focal plane, at which the area of
+		the beam has doubled, pi*w0^2*n/wavelength with the 1/e^2 radius w0
+		of the focus."""
+		waist = self.fwhm/np.sqrt(2.0*np.log(2.0))
+		return np.pi*np.square(waist)*self.refractiveIndex/self.wavelength
+
 	#--------------------------------------------------------------------------
 	def getExponent(self, xVals, yVals):
 		#yVals = yVals[:, np.newaxis]
 		return 4.0*np.log(2.0) * ((np.square(xVals - self.x) + np.square(yVals - self.y))/np.square(self.fwhm))
 
+	#--------------------------------------------------------------------------
+	def getWidening(self, zVals):
+		"""Returns the area of the beam at the axial positions zVals relative
+		to the focus, 1 + (dz/zR)^2 with the Rayleigh range zR. The lateral
+		exponent is divided by it and the intensity falls off with it."""
+		return 1.0 + np.square((zVals - self.z)/self.rayleighRange)
+
 	#--------------------------------------------------------------------------
 	def _getFWHM(self):
 		return self.wavelength/self.numericalAperture
@@ -83,12 +120,33 @@ class LaserBeamGaussian(object):
 
 #==============================================================================
 class PumpBeam(LaserBeamGaussian):
-	def profile(self, xVals, yVals):
+	def profile(self, xVals, yVals, zVals=None):
 		exponent = self.getExponent(xVals, yVals)
-		return self.amplitude*np.exp(-exponent)
+		if zVals is None:
+			return self.amplitude*np.exp(-exponent)
+
+		widening = self.getWidening(zVals)
+		return self.amplitude*(np.exp(-exponent/widening)/widening)
 
 #==============================================================================
 class StedBeam(LaserBeamGaussian):
-	def profile(self, xVals, yVals):
+	def profile(self, xVals, yVals, zVals=None):
 		exponent = self.getExponent(xVals, yVals)
-		return self.amplitude*exponent*np.exp(-exponent + 1.0)
+		# the amplitude is applied last, so that profiles of amplitude 1
+		# scale to exactly the same intensities, see TransitionTable
+		if zVals is None:
+			return self.amplitude*(exponent*np.exp(-exponent + 1.0))
+
+		# the donut widens like the pump beam off the focal plane
+		widening = self.getWidening(zVals)
+		exponent = exponent/widening
+		return self.amplitude*(exponent*np.exp(-exponent + 1.0)/widening)
+
+#------------------------------------------------------------------------------
+def createLaserBeams(x, y, pumpAmplitude, stedAmplitude):
+	"""Returns the pump and the STED beam of the simulations centered at the
+	laser position x, y, which may be arrays of several laser positions."""
+	pumpBeam = PumpBeam(x=x, y=y, amplitude=pumpAmplitude, wavelength=470E-9, numAperture=1.3)
+	stedBeam = StedBeam(x=x, y=y, amplitude=stedAmplitude, wavelength=600E-9, numAperture=1.3)
+
+	return pumpBeam, stedBeam
@@ -0,0 +1,190 @@
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def trapCoordinates(ETx, ETy, ETz=None):
+	"""Returns the x, y and z coordinates of the electron traps as arrays.
+	They are computed if ETx is a RegularLattice, ETy and ETz are ignored
+	then and z is None for a two-dimensional lattice."""
+	if not isinstance(ETx, RegularLattice):
+		return ETx, ETy, ETz
+
+	return ETx.x, ETx.y, ETx.z if ETx.dimensions > 2 else None
+
+
+#==============================================================================
+class RegularLattice(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, origin, spacing, shape):
+		"""
+		Regular two- or three-dimensional lattice of electron traps, which is
+		described by its origin, spacing and shape only. The traps are
+		numbered by their raveled grid index in C order, i.e. the last axis
+		varies fastest, like the list of all [x, y] pairs of an x and a y grid.
+
+		The positions and the neighbours of the traps are computed from
+		their index instead of being stored, so the lattice needs the same
+		memory for any number of traps. It can be used in place of the
+		electron trap coordinates of ElectronicSystem, setupSimulation() and
+		the schedulers. As an array (numpy.asarray()) it is the (traps x
+		dimensions) array of all coordinates, which is only built then.
+
+		Parameters
+		----------
+		origin : array-like
+			Coordinates of the lattice point with the grid index 0
+		spacing : float or array-like
+			Distance of neighbouring lattice points along every axis
+		shape : tuple of int
+			Number of lattice points along every axis
+		"""
+		self.shape = tuple(int(n) for n in shape)
+		if len(self.shape) not in (2, 3) or min(self.shape) < 1:
+			raise ValueError("a lattice has two or three axes of at least one point.")
+
+		self.origin = np.zeros(self.dimensions) + np.asarray(origin, dtype=float)
+		self.spacing = np.zeros(self.dimensions) + np.asarray(spacing, dtype=float)
+		if self.origin.shape != (self.dimensions,) or np.any(self.spacing <= 0.0):
+			raise ValueError("origin and spacing must match the shape of the lattice.")
+
+		self.strides = np.array([np.prod(self.shape[axis + 1:], dtype=np.int64) for axis in range(self.dimensions)], dtype=np.int64)
+		self._strides = tuple(int(stride) for stride in self.strides)
+
+	#--------------------------------------------------------------------------
+	def __repr__(self):
+		return "RegularLattice(origin=%s, spacing=%s, shape=%s)"%(list(self.origin), list(self.spacing), self.shape)
+
+	#--------------------------------------------------------------------------
+	def __array__(self, dtype=None):
+		"""Returns the (traps x dimensions) array of the coordinates of all
+		lattice points."""
+		coordinates = np.column_stack([self.axisCoordinates(axis) for axis in range(self.dimensions)])
+		return coordinates if dtype is None else coordinates.astype(dtype)
+
+	#--------------------------------------------------------------------------
+	@property
+	def dimensions(self):
+		"""Returns the number of axes of the lattice."""
+		return len(self.shape)
+
+	#--------------------------------------------------------------------------
+	@property
+	def size(self):
+		"""Returns the number of lattice points."""
+		return int(np.prod(self.shape, dtype=np.int64))
+
+	#--------------------------------------------------------------------------
+	@property
+	def x(self):
+		"""Returns the x coordinates of all lattice points."""
+		return self.axisCoordinates(0)
+
+	#--------------------------------------------------------------------------
+	@property
+	def y(self):
+		"""Returns the y coordinates of all lattice points."""
+		return self.axisCoordinates(1)
+
+	#--------------------------------------------------------------------------
+	@property
+	def z(self):
+		"""Returns the z coordinates of all lattice points, which are zero
+		for a two-dimensional lattice."""
+		return self.axisCoordinates(2)
+
+	#--------------------------------------------------------------------------
+	def description(self):
+		"""Returns the origin, the spacing and the shape of the lattice as a
+		single array, e.g. to identify it in a cache key."""
+		return np.concatenate((self.origin, self.spacing, self.shape)).astype(float)
+
+	#--------------------------------------------------------------------------
+	def axisCoordinates(self, axis):
+		"""Returns the coordinates of all lattice points along axis (0, 1
+		or 2), zero along an axis the lattice doesn't have."""
+		if axis >= self.dimensions:
+			return np.zeros(self.size)
+
+		values = self.origin[axis] + self.spacing[axis]*np.arange(self.shape[axis])
+		return np.tile(np.repeat(values, self.strides[axis]), self.size//(self.shape[axis]*self.strides[axis]))
+
+	#--------------------------------------------------------------------------
+	def gridIndices(self, indices):
+		"""Returns the grid indices of the lattice points with the given
+		(raveled) indices as (... x dimensions) array."""
+		return (np.asarray(indices, dtype=np.int64)[..., np.newaxis]//self.strides) % self.shape
+
+	#--------------------------------------------------------------------------
+	def coordinates(self, indices):
+		"""Returns the positions of the lattice points with the given indices
+		as (... x 3) array of [x, y, z]."""
+		gridIndices = self.gridIndices(indices)
+		positions = np.zeros(gridIndices.shape[:-1] + (3,))
+		positions[..., :self.dimensions] = self.origin + self.spacing*gridIndices
+
+		return positions
+
+	#--------------------------------------------------------------------------
+	def stencil(self, travelRange):
+		"""
+		Returns the offsets from a lattice point to all lattice points, which
+		are not further away than travelRange, including the point itself.
+
+		Returns
+		-------
+		gridOffsets : numpy.ndarray
+			(offsets x dimensions) offsets of the grid indices
+		indexOffsets : numpy.ndarray
+			Offsets of the raveled indices in ascending order
+		reach : tuple of int
+			Largest grid offset along every axis
+		"""
+		reach = np.floor(travelRange/self.spacing).astype(np.int64) + 1
+		gridOffsets = np.indices(2*reach + 1).reshape(self.dimensions, -1).T - reach
+
+		isNeighbour = np.sqrt(np.sum(np.square(gridOffsets*self.spacing), axis=1)) <= travelRange
+		gridOffsets = gridOffsets[isNeighbour]
+		indexOffsets = gridOffsets.dot(self.strides)
+
+		order = np.argsort(indexOffsets)
+		return gridOffsets[order], indexOffsets[order], tuple(int(r) for r in np.abs(gridOffsets).max(axis=0))
+
+	#--------------------------------------------------------------------------
+	def neighbours(self, index, stencil):
+		"""Returns the sorted indices of all lattice points within the
+		stencil (see stencil()) around the lattice point index."""
+		gridOffsets, indexOffsets, reach = stencil
+		gridIndex = [(int(index)//stride) % size for stride, size in zip(self._strides, self.shape)]
+
+		# the stencil lies completely inside the lattice for most points
+		if all(reach[axis] <= gridIndex[axis] < self.shape[axis] - reach[axis] for axis in range(self.dimensions)):
+			return index + indexOffsets
+
+		neighbours = np.array(gridIndex) + gridOffsets
+		inside = np.all((neighbours >= 0) & (neighbours < self.shape), axis=1)
+		return index + indexOffsets[inside]
+
+	#--------------------------------------------------------------------------
+	def pointsWithin(self, position, travelRange):
+		"""Returns the sorted indices of all lattice points, which are not
+		further away than travelRange from position [x, y, z], which need
+		not be a lattice point."""
+		position = np.asarray(position, dtype=float)
+
+		# the box around position, widened against rounding
+		lower = np.floor((position[:self.dimensions] - self.origin - travelRange)/self.spacing).astype(np.int64)
+		upper = np.ceil((position[:self.dimensions] - self.origin + travelRange)/self.spacing).astype(np.int64)
+		lower = np.maximum(lower, 0)
+		upper = np.minimum(upper, np.array(self.shape) - 1)
+		if np.any(upper < lower):
+			return np.zeros(0, dtype=np.int64)
+
+		gridIndices = np.indices(upper - lower + 1).reshape(self.dimensions, -1).T + lower
+		indices = gridIndices.dot(self.strides)
+
+		distance = np.sqrt(np.sum(np.square(self.coordinates(indices) - position), axis=1))
+		return np.sort(indices[distance <= travelRange])
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
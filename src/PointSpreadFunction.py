@@ -1,16 +1,184 @@
 
-from multiprocessing import Manager
+from multiprocessing import Lock
 from threading import Thread
 
-from Simulator import SolidStateStedSimulator
+from Fitting import fitLorentziansWithErrors, lorentzian, lorentzianJacobian
+from Geometry import crystalCoordinates
+from ResultSink import ResultSink, readColumn, readSchema, resultDirectoryName
+from Simulator import SolidStateStedSimulator, SolidStateStedEnsembleSimulator
 
-import pickle
+import json
+import os
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def aggregateProfile(directory):
+	"""
+	Returns the total time of every phase and the total number of every
+	event of all simulations of a point spread function, i.e. the sums of
+	the profile_* results (see PhaseProfiler), together with the total
+	number of simulation steps. They are saved to profile.json in the
+	directory of the point spread function.
+
+	Parameters
+	----------
+	directory : str
+		Directory of the ResultSink of the point spread function
+	"""
+	schema = readSchema(directory)
+	names = [str(c['name']) for c in schema or [] if c['name'].startswith('profile_') or c['name'] == 'simulationSteps']
+
+	profile = dict((name, np.sum(readColumn(directory, name)).item()) for name in names)
+	with open(os.path.join(directory, 'profile.json'), 'w') as f:
+		json.dump(profile, f, indent=1, sort_keys=True)
+
+	return profile
+
+#------------------------------------------------------------------------------
+def printProfile(profile):
+	"""Prints the share of every phase of the total time and the number of
+	every event per simulation step."""
+	times = sorted((value, name[len('profile_time_'):]) for name, value in profile.items() if name.startswith('profile_time_'))
+	total = sum(value for value, name in times)
+	for value, name in reversed(times):
+		print "   %-42s %10.2f s %6.1f %%"%(name, value, 100.0*value/total if total > 0.0 else 0.0)
+
+	steps = max(profile.get('simulationSteps', 0), 1)
+	for name in sorted(profile.keys()):
+		if name.startswith('profile_count_'):
+			print "   %-42s %10d   %6.3g per step"%(name[len('profile_count_'):], profile[name], float(profile[name])/steps)
+
+#------------------------------------------------------------------------------
+def refinedCoordinates(laserCoord, refinement):
+	"""Returns the laser coordinates with refinement - 1 equally spaced
+	positions inserted between every two consecutive ones."""
+	laserCoord = np.asarray(laserCoord, dtype=float)
+	steps = np.arange(refinement)/float(refinement)
+	inserted = laserCoord[:-1, np.newaxis] + steps[:, np.newaxis]*np.diff(laserCoord, axis=0)[:, np.newaxis]
+	return np.vstack((inserted.reshape(-1, laserCoord.shape[1]), laserCoord[-1:]))
+
+#------------------------------------------------------------------------------
+def isResolved(laserXpos, center, fwhm, minPositions=5):
+	"""Returns True if at least minPositions laser positions are closer to
+	the center of the point spread function than its FWHM, so that a fit
+	doesn't rely on the flanks of a peak it has hardly sampled."""
+	return np.sum(np.abs(np.asarray(laserXpos) - center) <= fwhm) >= minPositions
+
+#------------------------------------------------------------------------------
+def refinementIndices(laserXpos, scanned, excitedStateAverage, excitedStateError, number):
+	"""
+	Returns the indices of up to number laser positions, which are not
+	scanned yet, whose simulation reduces the error of the FWHM of the
+	point spread function most.
+
+	The positions are chosen one after another from the Lorentzian fit of
+	the scanned positions: the one, whose point reduces the variance of the
+	FWHM most, is taken and the covariance of the parameters is updated as
+	if it was measured with the error expected from its neighbours. Without
+	a fit, e.g. of too few positions, the gaps between scanned positions,
+	where the profile is curved most, are halved instead.
+
+	Parameters
+	----------
+	laserXpos : array-like
+		x-coordinates of all laser positions of the scan in their order
+		along the scan line
+	scanned : array of bool
+		Mask of the scanned laser positions
+	excitedStateAverage, excitedStateError : array-like
+		Results of the scanned laser positions, in their order in laserXpos
+	number : int
+		Maximum number of laser positions to return
+	"""
+	laserXpos = np.asarray(laserXpos, dtype=float)
+	x = laserXpos[scanned]
+	order = np.argsort(x)
+	x, y, error = x[order], np.asarray(excitedStateAverage, dtype=float)[order], np.asarray(excitedStateError, dtype=float)[order]
+	candidates = np.flatnonzero(~scanned)
+
+	parameters, fwhm, fwhmError, covariance = fitLorentziansWithErrors(x, y, error)
+	if np.isfinite(fwhmError[0]) and fwhm[0] > 0.0:
+		# the expected error of a new point, scaled like the covariance
+		known = np.isfinite(error) & (error > 0.0)
+		typicalError = np.median(error[known]) if np.any(known) else 1.0
+		error = np.where(known, error, typicalError)
+		reducedChiSquare = max(np.sum(((lorentzian(x[np.newaxis], parameters)[0] - y)/error)**2)/(x.size - parameters.shape[1]), 1.0)
+		variance = np.interp(laserXpos[candidates], x, error)**2 * reducedChiSquare
+
+		C = covariance[0]
+		J = lorentzianJacobian(laserXpos[candidates][np.newaxis], parameters)[0]
+		fwhmGradient = np.array([0.0, 0.0, 2.0, 0.0])
+
+		chosen = list()
+		available = np.ones(candidates.size, dtype=bool)
+		for cnt in range(min(number, candidates.size)):
+			CJ = J.dot(C)
+			reduction = np.where(available, CJ.dot(fwhmGradient)**2/(variance + np.einsum('ci,ci->c', CJ, J)), -1.0)
+
+			best = np.argmax(reduction)
+			if reduction[best] <= 0.0:
+				break
+
+			chosen.append(candidates[best])
+			available[best] = False
+			C = C - np.outer(CJ[best], CJ[best])/(variance[best] + CJ[best].dot(J[best]))
+
+		if chosen:
+			return np.array(chosen)
+
+	# halve the gaps with the largest curvature times width squared, which
+	# is the error of interpolating the profile linearly
+	scannedIndices = np.flatnonzero(scanned)[order]
+	curvature = np.zeros(x.size)
+	if x.size > 2:
+		slopes = np.diff(y)/np.diff(x)
+		curvature[1:-1] = np.abs(np.diff(slopes))/(0.5*(x[2:] - x[:-2]))
+		curvature[0], curvature[-1] = curvature[1], curvature[-2]
+
+	gaps = [(max(curvature[i], curvature[i + 1])*(x[i + 1] - x[i])**2, i) for i in range(x.size - 1)
+			if scannedIndices[i + 1] - scannedIndices[i] > 1]
+	gaps.sort(reverse=True)
+
+	chosen = [(scannedIndices[i] + scannedIndices[i + 1])//2 for score, i in gaps[:number]]
+	return np.array(chosen if chosen else candidates[:number], dtype=int)
 
 
 class PointSpreadFunction(Thread):
 	#--------------------------------------------------------------------------
-	def __init__(self, N, REcoord, ETcoord, pumpAmpl, stedAmpl, laserCoord, cs, eTR, savePath):
+	def __init__(self, N, REcoord, ETcoord, pumpAmpl, stedAmpl, laserCoord, cs, eTR, savePath, ensembleSize=None, profile=False, fwhmTolerance=None, initialPositions=9, positionsPerRound=8, refinement=4, maxPositions=None, stallRounds=2):
+		"""
+		Simulates all laser positions of a point spread function. By default
+		every laser position is simulated in its own process. If ensembleSize
+		is given, the laser positions are split into chunks of at most
+		ensembleSize positions and every chunk is advanced together by a
+		single SolidStateStedEnsembleSimulator process.
 
+		The simulators append their results to a ResultSink in the
+		directory of the point spread function as soon as they finish.
+
+		If profile is set, the simulators measure the time of their phases
+		and count their events. The totals of the point spread function
+		are kept in the profileTotals attribute and saved to profile.json,
+		see aggregateProfile().
+
+		If fwhmTolerance is given, the laser positions are scanned
+		adaptively along the line of laserCoord: first initialPositions
+		equally spaced ones, then in every round up to positionsPerRound
+		more, which reduce the error of the FWHM of the Lorentzian fit most
+		(see refinementIndices()). The scan stops when the relative error
+		of the FWHM is below fwhmTolerance and the peak is resolved (see
+		isResolved()). The positions are chosen from laserCoord refined by
+		the factor refinement, so the flanks can be sampled more densely
+		than by laserCoord. The last fit is kept in the attributes fwhm and
+		fwhmError.
+
+		The scan gives up without reaching fwhmTolerance, if maxPositions
+		positions (by default as many as laserCoord has) are scanned, the
+		relative error of the FWHM didn't shrink below its best value for
+		stallRounds rounds or all positions are scanned. The attribute
+		fwhmToleranceReached tells, whether the tolerance was reached.
+		"""
 		super(PointSpreadFunction, self).__init__()
 
 		self.N = N
@@ -22,37 +190,133 @@ class PointSpreadFunction(Thread):
 		self.crossSections = cs
 		self.electronTravelRange = eTR
 		self.savePath = savePath
+		self.ensembleSize = ensembleSize
+		self.profile = profile
+		self.profileTotals = None
+		self.fwhmTolerance = fwhmTolerance
+		self.initialPositions = initialPositions
+		self.positionsPerRound = positionsPerRound
+		self.refinement = refinement
+		self.maxPositions = maxPositions if maxPositions is not None else len(laserCoord)
+		self.fwhm = None
+		self.fwhmError = None
+		self.stallRounds = stallRounds
+		self.fwhmToleranceReached = None
 
-		self.manager = Manager()
-		self.resultContainer = self.manager.Queue(maxsize=0)
+		self.resultContainer = ResultSink(resultDirectoryName(self.savePath, self.pumpAmpl, self.stedAmpl), lock=Lock())
 		self.processList = list()
-		self._result = list()
 
 	#--------------------------------------------------------------------------
 	def run(self):
-		for laserPosition in self.laserCoord:
-			print laserPosition
-			sim = SolidStateStedSimulator(nSimSteps=self.N, resultContainer=self.resultContainer)
-			sim.setupSimulation(REx=self.REcoord[0], REy=self.REcoord[1],
-								ETx=self.ETcoord[:,0], ETy=self.ETcoord[:,1],
-								pumpAmpl=self.pumpAmpl, stedAmpl=self.stedAmpl,
-								laserXpos=laserPosition[0], laserYpos=laserPosition[1],
-								cs=self.crossSections, eTR=self.electronTravelRange)
-			sim.start()
-			self.processList.append(sim)
+		if self.fwhmTolerance is None:
+			self.simulate(self.laserCoord)
+		else:
+			self.scanAdaptively()
+
+		if self.profile:
+			self.profileTotals = aggregateProfile(self.resultContainer.directory)
+			printProfile(self.profileTotals)
+
+	#--------------------------------------------------------------------------
+	def simulate(self, laserCoord):
+		"""Simulates the given laser positions and waits for the results."""
+		if self.ensembleSize is None:
+			self.startSimulators(laserCoord)
+		else:
+			self.startEnsembleSimulators(laserCoord)
 
 		for p in self.processList:
 			p.join()
 
-		self.saveResult()
+		self.processList = list()
 
 	#--------------------------------------------------------------------------
-	def saveResult(self):
-		while not self.resultContainer.empty():
-			self._result.append(self.resultContainer.get())
+	def scanAdaptively(self):
+		laserCoord = refinedCoordinates(self.laserCoord, self.refinement)
+		indices = np.unique(np.linspace(0, len(laserCoord) - 1, min(self.initialPositions, len(laserCoord))).round().astype(int))
+
+		# the relative error of the FWHM of the best round so far and the
+		# number of rounds since then
+		bestError = np.inf
+		roundsWithoutProgress = 0
+
+		while True:
+			# positions simulated before, e.g. by an interrupted scan, are not
+			# simulated again, nor more than the budget of positions
+			results = self.scannedResults(laserCoord)
+			indices = np.array([idx for idx in indices if idx not in results], dtype=int)
+			indices = indices[:max(self.maxPositions - len(results), 0)]
+			if indices.size:
+				self.simulate(laserCoord[indices])
+				results = self.scannedResults(laserCoord)
 
-		with open("%sPSF_pump_%.3f_sted_%.3f.pys"%(self.savePath, self.pumpAmpl, self.stedAmpl), "wb") as f:
-			pickle.dump(self._result, f)
+			scanned = np.zeros(len(laserCoord), dtype=bool)
+			scanned[results.keys()] = True
+			excitedStateAverage, excitedStateError = np.array([results[idx] for idx in np.flatnonzero(scanned)]).T
+
+			parameters, fwhm, fwhmError, covariance = fitLorentziansWithErrors(laserCoord[scanned,0], excitedStateAverage, excitedStateError)
+			self.fwhm, self.fwhmError = fwhm[0], fwhmError[0]
+			print "%d laser positions, FWHM=%.4g +- %.2g"%(scanned.sum(), self.fwhm, self.fwhmError)
+
+			resolved = isResolved(laserCoord[scanned,0], parameters[0,1], self.fwhm)
+			self.fwhmToleranceReached = bool(self.fwhmError <= self.fwhmTolerance*self.fwhm and resolved)
+			if self.fwhmToleranceReached:
+				break
+
+			relativeError = self.fwhmError/abs(self.fwhm)
+			if relativeError < bestError:
+				bestError = relativeError
+				roundsWithoutProgress = 0
+			else:
+				roundsWithoutProgress += 1
+
+			stalled = roundsWithoutProgress >= self.stallRounds
+			if stalled or scanned.sum() >= self.maxPositions or scanned.all():
+				print "FWHM tolerance %g not reached after %d laser positions%s"%(self.fwhmTolerance, scanned.sum(), ", the error stopped shrinking" if stalled else "")
+				break
+
+			indices = refinementIndices(laserCoord[:,0], scanned, excitedStateAverage, excitedStateError, self.positionsPerRound)
 
 	#--------------------------------------------------------------------------
+	def scannedResults(self, laserCoord):
+		"""Returns the excitedStateAverage and excitedStateError of all laser
+		positions in the result directory by their index in laserCoord."""
+		directory = self.resultContainer.directory
+		if readSchema(directory) is None:
+			return dict()
+
+		results = dict()
+		for x, y, average, error in zip(*[readColumn(directory, name) for name in ('laserXpos', 'laserYpos', 'excitedStateAverage', 'excitedStateError')]):
+			matches = np.flatnonzero((laserCoord[:,0] == x) & (laserCoord[:,1] == y))
+			if matches.size:
+				results[matches[0]] = (average, error)
+
+		return results
+
+	#--------------------------------------------------------------------------
+	def startSimulators(self, laserCoord):
+		for laserPosition in laserCoord:
+			print laserPosition
+			sim = SolidStateStedSimulator(nSimSteps=self.N, resultContainer=self.resultContainer, profile=self.profile)
+			sim.setupSimulation(pumpAmpl=self.pumpAmpl, stedAmpl=self.stedAmpl,
+								laserXpos=laserPosition[0], laserYpos=laserPosition[1],
+								cs=self.crossSections, eTR=self.electronTravelRange,
+								**crystalCoordinates(self.REcoord, self.ETcoord))
+			sim.start()
+			self.processList.append(sim)
+
 	#--------------------------------------------------------------------------
+	def startEnsembleSimulators(self, laserCoord):
+		numberEnsembles = int(np.ceil(len(laserCoord)/float(self.ensembleSize)))
+		for laserPositions in np.array_split(np.asarray(laserCoord), numberEnsembles):
+			sim = SolidStateStedEnsembleSimulator(nSimSteps=self.N, resultContainer=self.resultContainer, profile=self.profile)
+			sim.setupSimulation(pumpAmpl=self.pumpAmpl, stedAmpl=self.stedAmpl,
+								laserXpos=laserPositions[:,0], laserYpos=laserPositions[:,1],
+								cs=self.crossSections, eTR=self.electronTravelRange,
+								**crystalCoordinates(self.REcoord, self.ETcoord))
+			sim.start()
+			self.processList.append(sim)
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
@@ -1,10 +1,16 @@
 
 
-import glob
 import os
-import pickle
+import sys
 import numpy as np
 
+from Fitting import fitSweep, powerLaw
+from ResultStore import ResultStore
+
+import matplotlib as mpl
+# without a display, e.g. on a server, nothing can be shown
+if os.name != 'nt' and not os.environ.get('DISPLAY'):
+	mpl.use('Agg')
 
 from mpl_toolkits.axes_grid1 import host_subplot
 import mpl_toolkits.axisartist as AA
@@ -12,12 +18,9 @@ from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.colors import LogNorm
 
 import matplotlib.pyplot as plt
-import matplotlib as mpl
 #mpl.rcParams['savefig.directory'] = os.chdir(os.path.dirname(__file__))
 mpl.rcParams['font.size'] = 16
 
-from lmfit.models import LorentzianModel, PowerLawModel, ConstantModel, ExpressionModel
-
 
 #from mpl_toolkits.axes_grid1 import host_subplot
 #import mpl_toolkits.axisartist as AA
@@ -31,8 +34,8 @@ from lmfit.models import LorentzianModel, PowerLawModel, ConstantModel, Expressi
 #--------------------------------------------------------------------------
 def saveRareEarthPopulationEvolution(self):
 	ax = plt.subplot(111)
-	plt.plot(self.evolutionRecoders[0]._t, self.evolutionRecoders[0]._g, label="ground")
-	plt.plot(self.evolutionRecoders[0]._t, self.evolutionRecoders[0]._e, label="excited")
+	plt.plot(self.evolutionRecorder.times, self.evolutionRecorder.groundStates[:, 0], label="ground")
+	plt.plot(self.evolutionRecorder.times, self.evolutionRecorder.excitedStates[:, 0], label="excited")
 	plt.xlabel("Time [sim steps]")
 	plt.ylabel("N [1]")
 	plt.legend(loc='best')
@@ -88,113 +91,66 @@ class Postprocessor(object):
 
 	#--------------------------------------------------------------------------
 	def getAllResultFiles(self):
-		files = glob.glob(self.directory + '/' + '*.pys')
-		self.resultfiles = list()
-		for f in files:
-			self.resultfiles.append(os.path.abspath(f))
+		# the index of the scalar results, new results are added on opening
+		self.store = ResultStore(self.directory)
 
 		self.getData()
 
 	#--------------------------------------------------------------------------
 	def getData(self):
 		self.data = dict()
-		self.pumpAmplitudes = list()
-		self.stedAmplitudes = list()
+		self.fitResults = None
+		index = self.store.index
 
-		for f in self.resultfiles:
-			print f
-			with open(f, 'rb') as fil:
-				data = pickle.load(fil) # thats a list of dicts
+		# nothing was indexed yet
+		if index is None:
+			self.pumpAmplitudes = np.zeros(0)
+			self.stedAmplitudes = np.zeros(0)
+			return
 
-			for i in range(len(data)):
-				self.pumpAmplitudes.append(data[i]['pumpAmplitude'])
-				self.stedAmplitudes.append(data[i]['stedAmplitude'])
+		self.pumpAmplitudes = np.unique(index['pumpAmplitude'])
+		self.stedAmplitudes = np.unique(index['stedAmplitude'])
 
-		self.pumpAmplitudes = np.unique(self.pumpAmplitudes)
-		self.stedAmplitudes = np.unique(self.stedAmplitudes)
-
-		# build up data structure
+		# build up data structure, sorted by laserXpos. The line profiles
+		# are scanned along laserYpos = 0, other rows belong to raster maps.
 		for pa in self.pumpAmplitudes:
 			self.data[pa] = dict()
 			for sa in self.stedAmplitudes:
-				self.data[pa][sa] = [[],[]]
-
-		# insert data to structure
-		for f in self.resultfiles:
-			with open(f, 'rb') as fil:
-				data = pickle.load(fil) # thats a list of dicts
-
-			for i in range(len(data)):
-				pa = data[i]['pumpAmplitude']
-				sa = data[i]['stedAmplitude']
-				laserXpos = data[i]['laserXpos']
-				esa = data[i]['excitedStateAverage']
-				self.data[pa][sa][0].append(laserXpos)
-				self.data[pa][sa][1].append(esa)
-
-		# sort by laserXpos
-		for pak in self.data.keys():
-			for sak in self.data[pak].keys():
-				laserXpos = np.array(self.data[pak][sak][0])
-				esa = np.array(self.data[pak][sak][1])
-				inds = laserXpos.argsort()
-				self.data[pak][sak][0] = laserXpos[inds]
-				self.data[pak][sak][1] = esa[inds]
+				entries = self.store.select(pumpAmplitude=pa, stedAmplitude=sa, laserYpos=0.0)
+				if entries.size:
+					self.data[pa][sa] = [entries['laserXpos'], entries['excitedStateAverage']]
 
 
 	#--------------------------------------------------------------------------
-	def fit(self, pa):
-
-		self.stedPowers = list()
-		self.fwhm = list()
+	def fitAll(self):
+		"""Fits all point spread functions and the power laws of their FWHM
+		at once without plotting, see Fitting.fitSweep() for the tables."""
+		self.fitResults = fitSweep(self.data)
+		return self.fitResults
 
-		for sa in sorted(self.data[pa].keys()):	# ensure starting with lowest stedAmplitude
-			x = self.data[pa][sa][0]
-			y = self.data[pa][sa][1]/np.max(self.data[pa][sa][1])
-
-			lorentzian = LorentzianModel(prefix='l1_')
-			constant   = ConstantModel(prefix='const_')
-			pars = lorentzian.guess(y, x=x)
-			pars.update(constant.make_params())
-			pars['const_c'].set(min=0.0)
-
-			model = lorentzian + constant
-			fitInit = model.eval(pars, x=x)
-			out = model.fit(y, pars, x=x)
-
-			#print "%.3g, %.5g"%(out.params['l1_center'].value, out.params['l1_fwhm'].value)
-
-			#plt.plot(x, y, 'b-', label='data')
-			#plt.plot(x, fitInit, 'k--', label='guess')
-			#plt.plot(x, out.best_fit, 'r-', label='fit')
-			#plt.title("pump=%.2f, sted=%.2f"%(pa, sa))
-			#plt.legend(loc='best')
-			#plt.show()
-
-			self.stedPowers.append(sa)
-			self.fwhm.append(out.params['l1_fwhm'].value)
+	#--------------------------------------------------------------------------
+	def fit(self, pa):
+		# the batch fit covers all pump amplitudes at once
+		if self.fitResults is None:
+			self.fitAll()
 
-		self.stedPowers, self.fwhm = zip(*sorted(zip(self.stedPowers, self.fwhm)))
-		x = np.array(self.stedPowers)
-		y = np.array(self.fwhm)
+		pumpIdx = np.flatnonzero(self.fitResults['pumpAmplitudes'] == pa)[0]
+		fitted = np.isfinite(self.fitResults['fwhm'][pumpIdx])
 
-		powerLaw = PowerLawModel(prefix='pl_')
-		constant = ConstantModel(prefix='const_')
-		pars = powerLaw.guess(y, x=x)
-		pars.update(constant.make_params())
-		pars['pl_exponent'].set(min=-10.0, max=0.0)
-		pars['const_c'].set(0.0, min=0.0)
-		model = powerLaw + constant
+		self.stedPowers = self.fitResults['stedAmplitudes'][fitted]
+		self.fwhm = self.fitResults['fwhm'][pumpIdx][fitted]
 
-		modEval = model.eval(pars, x=x)
-		out = model.fit(y, pars, x=x)
+		x = self.stedPowers
+		y = self.fwhm
+		modEval = powerLaw(x[np.newaxis], self.fitResults['powerLawGuesses'][[pumpIdx]])[0]
+		bestFit = powerLaw(x[np.newaxis], self.fitResults['powerLaws'][[pumpIdx]])[0]
 
 		plt.plot(x, y, label='data')
 		plt.plot(x, modEval, label='guess')
-		plt.plot(x, out.best_fit, label='fit')
+		plt.plot(x, bestFit, label='fit')
 		plt.xlabel('I_STED', fontsize=22)
 		plt.ylabel('FWHM (PSF)', fontsize=22)
-		plt.title('pa=%.2f, exponent = %.4f'%(pa, out.params['pl_exponent'].value), fontsize=22)
+		plt.title('pa=%.2f, exponent = %.4f'%(pa, self.fitResults['exponents'][pumpIdx]), fontsize=22)
 		plt.legend(loc='best')
 		plt.show()
 
@@ -209,8 +165,16 @@ class Postprocessor(object):
 	#--------------------------------------------------------------------------
 
 
-p = Postprocessor('D:/STED_sim/new_2D/gamma_0.20_sigPumpRE_2.00_sigIonizeRE_10.00_sigRepumpRE_2.00_sigStedRE_0.00')
-p.getAllResultFiles()
+if __name__ == '__main__':
+	p = Postprocessor('D:/STED_sim/new_2D/gamma_0.20_sigPumpRE_2.00_sigIonizeRE_10.00_sigRepumpRE_2.00_sigStedRE_0.00')
+	p.getAllResultFiles()
 
-for pa in sorted(p.data.keys()):
-	p.fit(pa)
+	if '--headless' in sys.argv:
+		fitResults = p.fitAll()
+		for pa, exponent, fwhm in zip(fitResults['pumpAmplitudes'], fitResults['exponents'], fitResults['fwhm']):
+			print "pump=%.3f, exponent=%.4f"%(pa, exponent)
+			for sa, w in zip(fitResults['stedAmplitudes'], fwhm):
+				print "   sted=%.3f, FWHM=%.4g"%(sa, w)
+	else:
+		for pa in sorted(p.data.keys()):
+			p.fit(pa)
@@ -0,0 +1,285 @@
+
+from ElectronicSystems import sitePositions
+from Geometry import crystalCoordinates
+from LaserProfiles import createLaserBeams
+from PointSpreadFunction import PointSpreadFunction, aggregateProfile, printProfile
+from ResultSink import readResults, readSchema
+
+from multiprocessing import cpu_count
+
+import numpy as np
+
+
+# the symmetry operations of a square, i.e. the rotations by multiples of
+# 90 degrees and the mirror axes x, y and the diagonals
+squareSymmetries = [np.array(matrix, dtype=float) for matrix in ([[1, 0], [0, 1]], [[0, -1], [1, 0]], [[-1, 0], [0, -1]], [[0, 1], [-1, 0]],
+																   [[1, 0], [0, -1]], [[-1, 0], [0, 1]], [[0, 1], [1, 0]], [[0, -1], [-1, 0]])]
+
+
+#------------------------------------------------------------------------------
+def positionKeys(positions, tolerance):
+	"""Returns hashable keys of the positions, which are equal for
+	positions closer than tolerance."""
+	return [tuple(key) for key in np.round(np.asarray(positions)/tolerance).astype(np.int64)]
+
+#------------------------------------------------------------------------------
+def transform(positions, operation, center):
+	"""Applies the symmetry operation (2 x 2 matrix) around center to the
+	(number of positions x 2) array of positions."""
+	return center + (np.asarray(positions) - center).dot(operation.T)
+
+#------------------------------------------------------------------------------
+def beamsAreSymmetric(operation, samples=64, radius=5E-7):
+	"""Returns True if the profiles of the pump and the STED beam around the
+	laser position are invariant under the symmetry operation."""
+	offsets = np.random.RandomState(0).uniform(-radius, radius, (samples, 2))
+	transformed = offsets.dot(operation.T)
+
+	for beam in createLaserBeams(0.0, 0.0, 1.0, 1.0):
+		if not np.allclose(beam.profile(offsets[:,0], offsets[:,1]), beam.profile(transformed[:,0], transformed[:,1]), rtol=1E-9, atol=0.0):
+			return False
+
+	return True
+
+#------------------------------------------------------------------------------
+def sitePermutation(positions, numberElectronTraps, operation, center, tolerance):
+	"""
+	Returns the permutation of the electronic systems by the symmetry
+	operation, i.e. the index of the system at the transformed position of
+	every system, or None if the crystal isn't symmetric under it. Electron
+	traps have to be mapped onto electron traps and rare earths onto rare
+	earths. The operation acts on the x and y coordinates only.
+
+	Parameters
+	----------
+	positions : numpy.ndarray
+		(N x 2) or (N x 3) positions of the electron traps followed by the
+		rare earths
+	numberElectronTraps : int
+		Number of electron traps
+	operation : numpy.ndarray
+		2 x 2 matrix of the operation
+	center : array-like
+		Center of the operation
+	tolerance : float
+		Positions closer than tolerance are taken to be equal
+	"""
+	index = dict((key, cnt) for cnt, key in enumerate(positionKeys(positions, tolerance)))
+
+	transformed = np.array(positions, dtype=float)
+	transformed[:, :2] = transform(positions[:, :2], operation, center)
+	permutation = np.array([index.get(key, -1) for key in positionKeys(transformed, tolerance)])
+	isRareEarth = np.arange(permutation.size) >= numberElectronTraps
+	if np.any(permutation < 0) or np.any(isRareEarth != (permutation >= numberElectronTraps)):
+		return None
+
+	return permutation
+
+#------------------------------------------------------------------------------
+def crystalSymmetries(REx, REy, ETx, ETy, tolerance=None, REz=None, ETz=None):
+	"""
+	Returns the symmetry operations of a square, which leave the simulation
+	of every laser position unchanged, as list of (operation, permutation of
+	the electronic systems), see sitePermutation().
+
+	The operations act around the first rare earth, which is the one
+	evaluated in the results, so it is kept in place. An operation is a
+	symmetry, if it maps the rare earths and the electron traps onto
+	themselves and the beam profiles around the laser position are
+	invariant under it. The identity is always the first operation.
+	The operations keep the z coordinates of a three-dimensional crystal.
+
+	Parameters
+	----------
+	REx, REy, ETx, ETy : array-like
+		Coordinates of the rare earths and the electron traps
+	tolerance : float or None
+		Positions closer than tolerance are taken to be equal, defaults to
+		1E-6 of the extent of the crystal
+	REz, ETz : array-like or None
+		z coordinates of a three-dimensional crystal
+	"""
+	positions = sitePositions(REx, REy, ETx, ETy, REz, ETz)
+	numberElectronTraps = positions.shape[0] - np.size(REx)
+	center = positions[numberElectronTraps, :2]
+
+	if tolerance is None:
+		tolerance = 1E-6*max(np.ptp(positions), 1E-12)
+
+	symmetries = list()
+	for operation in squareSymmetries:
+		if not beamsAreSymmetric(operation):
+			continue
+
+		permutation = sitePermutation(positions, numberElectronTraps, operation, center, tolerance)
+		if permutation is not None:
+			symmetries.append((operation, permutation))
+
+	return symmetries
+
+#------------------------------------------------------------------------------
+def rasterOrbits(laserCoord, operations, center, tolerance):
+	"""
+	Returns for every laser position of the raster the index of the laser
+	position, which represents it, and the index of the operation, which
+	transforms the representative into it. The representatives are the
+	first laser positions of their orbits and are represented by themselves
+	with the identity, i.e. operation 0.
+
+	Parameters
+	----------
+	laserCoord : numpy.ndarray
+		(number of laser positions x 2) coordinates of the raster
+	operations : list of numpy.ndarray
+		Symmetry operations, the identity first
+	center : array-like
+		Center of the operations
+	tolerance : float
+		Positions closer than tolerance are taken to be equal
+	"""
+	index = dict((key, cnt) for cnt, key in enumerate(positionKeys(laserCoord, tolerance)))
+	transformed = [[index.get(key, -1) for key in positionKeys(transform(laserCoord, operation, center), tolerance)] for operation in operations]
+
+	representatives = -np.ones(len(laserCoord), dtype=int)
+	representativeOperations = np.zeros(len(laserCoord), dtype=int)
+	for position in range(len(laserCoord)):
+		if representatives[position] >= 0:
+			continue
+
+		# the orbit of a representative is complete, since the
+		# operations form a group
+		for operationIdx in range(len(operations)):
+			image = transformed[operationIdx][position]
+			if image >= 0 and representatives[image] < 0:
+				representatives[image] = position
+				representativeOperations[image] = operationIdx
+
+	return representatives, representativeOperations
+
+
+#==============================================================================
+class RasterPointSpreadFunction(PointSpreadFunction):
+	#--------------------------------------------------------------------------
+	def __init__(self, N, REcoord, ETcoord, pumpAmpl, stedAmpl, laserXpos, laserYpos, cs, eTR, savePath, tileSize=4, processes=None, profile=False):
+		"""
+		Simulates a two-dimensional point spread function on the raster of
+		all combinations of laserXpos and laserYpos.
+
+		Only one laser position of every set of positions, which are
+		equivalent by a symmetry of the crystal and the beams (see
+		crystalSymmetries()), is simulated. For a single rare earth in the
+		center of a square lattice of electron traps and a raster
+		symmetric around it, this is about an eighth of the raster. The
+		results of the other positions are reconstructed from them, with
+		the populationDistribution permuted accordingly, and appended to
+		the ResultSink as well, so the map can be read like any other
+		point spread function.
+
+		The simulated positions are scheduled in tiles of tileSize x
+		tileSize neighbouring raster positions, each simulated by a single
+		SolidStateStedEnsembleSimulator, and at most processes tiles are
+		simulated at once. Positions, whose results are in the directory
+		already, are not simulated again.
+
+		For all other parameters see PointSpreadFunction.
+		"""
+		self.laserXraster = np.asarray(laserXpos, dtype=float)
+		self.laserYraster = np.asarray(laserYpos, dtype=float)
+		xv, yv = np.meshgrid(self.laserXraster, self.laserYraster)
+		self.rasterCoord = np.column_stack((xv.ravel(), yv.ravel()))
+
+		self.symmetries = crystalSymmetries(**crystalCoordinates(REcoord, ETcoord))
+		self.tolerance = 1E-6*max(np.ptp(self.rasterCoord), np.ptp(ETcoord), 1E-12)
+		center = [np.ravel(REcoord[0])[0], np.ravel(REcoord[1])[0]]
+		self.representatives, self.representativeOperations = rasterOrbits(self.rasterCoord, [operation for operation, permutation in self.symmetries],
+																		   center, self.tolerance)
+		self.simulatedIndices = np.flatnonzero(self.representatives == np.arange(self.rasterCoord.shape[0]))
+
+		super(RasterPointSpreadFunction, self).__init__(N, REcoord, ETcoord, pumpAmpl, stedAmpl, self.rasterCoord[self.simulatedIndices], cs, eTR, savePath,
+														ensembleSize=tileSize**2, profile=profile)
+
+		self.tileSize = tileSize
+		self.processes = processes if processes is not None else cpu_count()
+
+	#--------------------------------------------------------------------------
+	def run(self):
+		done = self.scannedResults(self.rasterCoord)
+		tiles = [tile for tile in self.tiles() if not all(idx in done for idx in tile)]
+
+		for start in range(0, len(tiles), self.processes):
+			for tile in tiles[start:start + self.processes]:
+				self.startEnsembleSimulators(self.rasterCoord[tile])
+
+			for p in self.processList:
+				p.join()
+			self.processList = list()
+
+		self.reconstruct()
+
+		if self.profile:
+			self.profileTotals = aggregateProfile(self.resultContainer.directory)
+			printProfile(self.profileTotals)
+
+	#--------------------------------------------------------------------------
+	def tiles(self):
+		"""Returns the raster indices of the simulated laser positions grouped
+		by tiles of tileSize x tileSize raster positions."""
+		row, column = np.divmod(self.simulatedIndices, self.laserXraster.size)
+		tile = (row//self.tileSize)*self.laserXraster.size + column//self.tileSize
+
+		order = np.lexsort((self.simulatedIndices, tile))
+		boundaries = np.flatnonzero(np.diff(tile[order])) + 1
+		return np.split(self.simulatedIndices[order], boundaries)
+
+	#--------------------------------------------------------------------------
+	def reconstruct(self):
+		"""Appends the results of all raster positions, which were not
+		simulated, transformed from the results of their representatives."""
+		directory = self.resultContainer.directory
+		if readSchema(directory) is None:
+			return
+
+		results = dict()
+		for result in readResults(directory):
+			matches = np.flatnonzero((self.rasterCoord[:,0] == result['laserXpos']) & (self.rasterCoord[:,1] == result['laserYpos']))
+			if matches.size:
+				results[matches[0]] = result
+
+		for position in range(self.rasterCoord.shape[0]):
+			if position in results or self.representatives[position] not in results:
+				continue
+
+			result = dict(results[self.representatives[position]])
+			result['laserXpos'], result['laserYpos'] = self.rasterCoord[position]
+
+			# the system i of the representative is at the place of the
+			# system permutation[i] here
+			permutation = self.symmetries[self.representativeOperations[position]][1]
+			populationDistribution = np.empty_like(result['populationDistribution'])
+			populationDistribution[permutation] = result['populationDistribution']
+			result['populationDistribution'] = populationDistribution
+
+			# the rare earths follow the electron traps and are only mapped
+			# onto rare earths
+			numberElectronTraps = permutation.size - np.size(result['reGroundStateAverages'])
+			rareEarthPermutation = permutation[numberElectronTraps:] - numberElectronTraps
+			for name in ('reGroundStateAverages', 'reExcitedStateAverages'):
+				averages = np.empty_like(result[name])
+				averages[rareEarthPermutation] = result[name]
+				result[name] = averages
+
+			self.resultContainer.append(result)
+
+	#--------------------------------------------------------------------------
+	def excitedStateMap(self):
+		"""Returns the (laserYpos x laserXpos) array of the excitedStateAverage
+		of all raster positions, NaN where no result is available."""
+		excitedStateMap = np.nan*np.ones(self.rasterCoord.shape[0])
+
+		for idx, (average, error) in self.scannedResults(self.rasterCoord).items():
+			excitedStateMap[idx] = average
+
+		return excitedStateMap.reshape(self.laserYraster.size, self.laserXraster.size)
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
@@ -0,0 +1,216 @@
+
+from Simulator import KineticMonteCarloSimulator
+
+import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sparselinalg
+
+
+class RateEquationSolver(KineticMonteCarloSimulator):
+	#--------------------------------------------------------------------------
+	def __init__(self, nSimSteps, resultContainer=None, tolerance=None, minSteps=None, checkpointPath=None, checkpointInterval=None, residualTolerance=1E-9, maxIterations=200, importanceSampling=False, profile=False):
+		"""
+		Creates a deterministic solver for the steady state of the mean-field
+		rate equations, which is set up and evaluated just like the
+		SolidStateStedSimulator.
+
+		Instead of sampling single electrons, the probabilities of every
+		electron trap to be populated and of every rare earth to be excited
+		or ionized are evolved with the rates of the KineticMonteCarloSimulator.
+		The occupancies of the neighbours are treated as independent (mean
+		field), so correlations between neighbouring systems are neglected.
+		The steady state is found by implicit pseudo-time steps of increasing
+		length, each one solved with a sparse iterative solver.
+
+		The result dict has the same keys and units as the one of the
+		stochastic simulators: the evolution records and the population
+		distribution are those of a simulation of nSimSteps steps, which
+		is in its steady state from the beginning.
+
+		Parameters
+		----------
+		nSimSteps : int or float
+			Simulated time in units of simulation steps, only used to scale
+			the results
+		resultContainer : multiprocessing.Queue or None
+			Container to save simulation results
+		tolerance, minSteps, checkpointPath, checkpointInterval
+			Not used, the solution has no statistical error and is fast
+		residualTolerance : float
+			Maximum change of any occupancy per simulation step in the
+			steady state
+		maxIterations : int
+			Maximum number of pseudo-time steps
+		importanceSampling, profile : bool
+			Not used
+		"""
+		super(RateEquationSolver, self).__init__(nSimSteps, resultContainer)
+
+		self.residualTolerance = residualTolerance
+		self.maxIterations = maxIterations
+
+	#--------------------------------------------------------------------------
+	def run(self):
+		self.createNeighbours()
+
+		es = self.electronSystems
+		self.setupRates()
+
+		# the equations need the neighbours of all systems at once,
+		# which are only built here for a lattice of electron traps
+		self.neighbours = es.neighbourArrays()
+
+		nET = es.numberElectronTraps
+		nRE = es.rareEarthIndices.size
+
+		# state vector: populations of the electron traps, followed by the
+		# excited and the ionized state probability of the rare earths
+		occupancies = np.zeros(nET + 2*nRE)
+
+		# start in the initial state of the stochastic simulators and
+		# increase the pseudo-time step up to the steady state
+		timeStep = 1.0
+		self.numberOfIterations = 0
+		self.residual = np.inf
+
+		while self.numberOfIterations < self.maxIterations:
+			system, constant = self.linearizedRateEquations(occupancies)
+
+			lhs = sparse.identity(system.shape[0], format='csr')/timeStep - system
+			rhs = occupancies/timeStep + constant
+
+			# Jacobi preconditioned, the diagonal holds the loss rates
+			preconditioner = sparse.diags(1.0/lhs.diagonal())
+			updated, info = sparselinalg.bicgstab(lhs, rhs, x0=occupancies, tol=1E-12, atol=0.0, M=preconditioner)
+			if info != 0:
+				updated = sparselinalg.spsolve(lhs.tocsc(), rhs)
+
+			updated = np.clip(updated, 0.0, 1.0)
+			self.numberOfIterations += 1
+
+			# the residual of the rate equations is the change per step
+			system, constant = self.linearizedRateEquations(updated)
+			self.residual = np.max(np.abs(system.dot(updated) + constant))
+			occupancies = updated
+
+			if self.residual < self.residualTolerance:
+				break
+
+			timeStep *= 10.0
+
+		self.trapPopulation = occupancies[:nET]
+		self.excitedProbability = occupancies[nET:nET + nRE]
+		self.ionizedProbability = occupancies[nET + nRE:]
+		self.groundProbability = 1.0 - self.excitedProbability - self.ionizedProbability
+
+		self.recordSteadyState()
+		self.simulationSteps = self.numberOfSimulationSteps
+
+		# after the steady state was found
+		self.finalize()
+
+	#--------------------------------------------------------------------------
+	def linearizedRateEquations(self, occupancies):
+		"""
+		Returns the sparse matrix and constant vector of the rate equations
+		d(occupancies)/dt = matrix.dot(occupancies) + constant, in which the
+		probabilities of the targets to be free to catch an electron and the
+		numbers of free neighbours are taken from the given occupancies.
+
+		Parameters
+		----------
+		occupancies : numpy.ndarray
+			Trap populations, excited and ionized rare earth probabilities
+		"""
+		es = self.electronSystems
+		nET = es.numberElectronTraps
+		nRE = es.rareEarthIndices.size
+		reCnt = np.arange(nRE)
+
+		excitedRow = nET + reCnt
+		ionizedRow = nET + nRE + reCnt
+
+		# probability of every system to be free to catch an electron
+		freeProbability = np.concatenate((1.0 - occupancies[:nET], occupancies[ionizedRow]))
+
+		# CSR neighbour pairs (target, source) without the system itself
+		neighbourOffsets, neighbourIndices = self.neighbours
+		sources = np.repeat(np.arange(es.N), np.diff(neighbourOffsets))
+		targets = neighbourIndices.astype(np.int64)
+		others = targets != sources
+		sources = sources[others]
+		targets = targets[others]
+
+		# the released electron goes to any free neighbour including the
+		# source itself, or from a trap to the valence band, with equal
+		# probability
+		numberFree = 1.0 + np.bincount(sources, weights=freeProbability[targets], minlength=es.N)
+		numberFree[:nET] += 1.0
+		branching = 1.0/numberFree
+
+		# rates of the ionizations, which release the electrons
+		releaseRate = np.concatenate((self.trapSelectionProbability * es.pIonize,
+									  self.rareEarthProbabilities[:, es.IONIZE]))
+
+		excite  = self.rareEarthProbabilities[:, es.EXCITE]
+		relax   = self.rareEarthProbabilities[:, [es.DECAY, es.DEPLETE]].sum(axis=1)
+		ionize  = self.rareEarthProbabilities[:, es.IONIZE]
+		repump  = self.rareEarthProbabilities[:, es.REPUMP]
+
+		# the electrons are released from the populated traps and from the
+		# excited rare earths, whose rows follow the traps in the same order
+		sourceColumn = sources
+		capture = freeProbability[targets] * branching[sources] * releaseRate[sources]
+
+		# a caught electron populates a trap, or excites a rare earth
+		# and removes it from the ionized state
+		trapTarget = targets < nET
+		reTarget = targets[~trapTarget] - nET
+		rows = np.concatenate((targets[trapTarget], excitedRow[reTarget], ionizedRow[reTarget],
+							   np.arange(nET),
+							   excitedRow, excitedRow, excitedRow, ionizedRow, ionizedRow))
+		columns = np.concatenate((sourceColumn[trapTarget], sourceColumn[~trapTarget], sourceColumn[~trapTarget],
+								  np.arange(nET),
+								  excitedRow, ionizedRow, excitedRow, excitedRow, ionizedRow))
+		values = np.concatenate((capture[trapTarget], capture[~trapTarget], -capture[~trapTarget],
+								 -releaseRate[:nET] * (1.0 - branching[:nET]),
+								 -(excite + relax), -excite, -ionize * (1.0 - branching[nET:]),
+								 ionize * (1.0 - branching[nET:]), -repump))
+
+		matrix = sparse.csr_matrix((values, (rows, columns)), shape=(nET + 2*nRE, nET + 2*nRE))
+
+		# the ground state probability is 1 - excited - ionized
+		constant = np.zeros(nET + 2*nRE)
+		constant[excitedRow] = excite
+
+		return matrix, constant
+
+	#--------------------------------------------------------------------------
+	def estimateStateAverages(self):
+		# the steady state has neither a burn-in nor a statistical error
+		self.groundStateAverage = self.recordInterval * self.groundProbability[0]
+		self.excitedStateAverage = self.recordInterval * self.excitedProbability[0]
+		self.rareEarthGroundStateAverages = self.recordInterval * self.groundProbability
+		self.rareEarthExcitedStateAverages = self.recordInterval * self.excitedProbability
+		self.groundStateError = 0.0
+		self.excitedStateError = 0.0
+		self.burnInSteps = 0.0
+
+	#--------------------------------------------------------------------------
+	def recordSteadyState(self):
+		"""Fills the evolution records and the population distribution like
+		a stochastic simulation in the steady state would do."""
+		self.recordInterval = max(int(0.05*self.numberOfSimulationSteps), 1)
+
+		for recordTime in xrange(0, self.numberOfSimulationSteps, self.recordInterval):
+			# the first record covers a single step
+			duration = self.recordInterval if recordTime else 1
+
+			self.evolutionRecorder.record(recordTime, duration*self.groundProbability, duration*self.excitedProbability)
+
+		# the stochastic simulators sample the population every second step
+		population = np.concatenate((self.trapPopulation, 1.0 - self.ionizedProbability))
+		self.recordElectronTrapPopulationDistribution(population * np.ceil(self.numberOfSimulationSteps/2.0))
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
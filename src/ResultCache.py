@@ -0,0 +1,170 @@
+
+import hashlib
+import os
+import pickle
+
+from Checkpoint import writeFileAtomically
+from Lattice import RegularLattice
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def canonicalKey(**inputs):
+	"""
+	Returns a hash of all given inputs, which doesn't depend on their order
+	or on the type of the containers. Numbers are rounded to 12 significant
+	digits, so that e.g. the same amplitude of two different linspace grids
+	gives the same key.
+
+	Parameters
+	----------
+	**inputs
+		Strings, None or anything numpy can convert to a float array
+	"""
+	digest = hashlib.sha1()
+	for name in sorted(inputs.keys()):
+		value = inputs[name]
+		digest.update(name + '=')
+
+		if value is None or isinstance(value, str):
+			digest.update(repr(value))
+		else:
+			array = np.asarray(value, dtype=float)
+			digest.update(repr(array.shape))
+			digest.update(','.join('%.12g'%v for v in array.ravel()))
+
+		digest.update(';')
+
+	return digest.hexdigest()
+
+#------------------------------------------------------------------------------
+def simulationKey(parameters, laserXpos, laserYpos):
+	"""Returns the cache key of the simulation of a single laser position with
+	the parameters of a task of the SweepScheduler."""
+	inputs = dict(simulatorClass=parameters['simulatorClass'].__name__,
+				  N=parameters['N'], tolerance=parameters['tolerance'],
+				  REx=parameters['REx'], REy=parameters['REy'],
+				  ETx=parameters['ETx'], ETy=parameters['ETy'],
+				  pumpAmpl=parameters['pumpAmpl'], stedAmpl=parameters['stedAmpl'],
+				  laserXpos=laserXpos, laserYpos=laserYpos,
+				  cs=parameters['cs'], eTR=parameters['eTR'],
+				  seed=parameters.get('seed'))
+
+	# only added if set, so the keys of former results stay valid
+	if parameters.get('importanceSampling'):
+		inputs['importanceSampling'] = 'yes'
+
+	# profiled results carry the profile_* keys, so they are kept apart
+	if parameters.get('profile'):
+		inputs['profile'] = 'yes'
+
+	# the crystals of former results were two-dimensional
+	if parameters.get('ETz') is not None:
+		inputs.update(REz=parameters['REz'], ETz=parameters['ETz'])
+
+	# a lattice of electron traps is identified by its description
+	if isinstance(parameters['ETx'], RegularLattice):
+		inputs.update(ETx=parameters['ETx'].description(), ETy='RegularLattice', REz=parameters.get('REz'))
+
+	return canonicalKey(**inputs)
+
+
+#==============================================================================
+class ResultCache(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, directory, maxSize=None, minSteps=None):
+		"""
+		Content-addressed cache of the result dicts of single laser positions.
+		Every result is pickled to its own file named by the hash of all
+		inputs of the simulation (see simulationKey()), so the cache can be
+		shared between studies.
+
+		Parameters
+		----------
+		directory : str
+			Directory of the cache, created if necessary
+		maxSize : float or None
+			Maximum size of the cache in bytes. The least recently used
+			results are removed, when it is exceeded.
+		minSteps : int or None
+			Cached results of fewer simulation steps, e.g. of simulations
+			which stopped early, are ignored
+		"""
+		self.directory = directory
+		self.maxSize = maxSize
+		self.minSteps = minSteps
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		# the size of all results is kept up to date by put(), the
+		# directory is only scanned again if it exceeds maxSize
+		self.size = sum(size for mtime, size, name in self.entries()) if maxSize is not None else None
+
+	#--------------------------------------------------------------------------
+	def fileName(self, key):
+		return os.path.join(self.directory, key + '.pkl')
+
+	#--------------------------------------------------------------------------
+	def get(self, key):
+		"""Returns the cached result dict of key, or None."""
+		path = self.fileName(key)
+		if not os.path.exists(path):
+			return None
+
+		with open(path, 'rb') as f:
+			result = pickle.load(f)
+
+		if self.minSteps is not None and result.get('simulationSteps', 0) < self.minSteps:
+			return None
+
+		# mark as recently used for the eviction
+		os.utime(path, None)
+		return result
+
+	#--------------------------------------------------------------------------
+	def put(self, key, result):
+		"""Adds a result dict to the cache and evicts old results if the cache
+		is too large."""
+		path = self.fileName(key)
+		if self.size is not None and os.path.exists(path):
+			self.size -= os.path.getsize(path)
+
+		data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+		writeFileAtomically(path, data)
+		if self.size is not None:
+			self.size += len(data)
+
+		self.evict()
+
+	#--------------------------------------------------------------------------
+	def evict(self):
+		"""Removes the least recently used results until the cache is not
+		larger than maxSize."""
+		if self.maxSize is None or self.size <= self.maxSize:
+			return
+
+		# other caches may have added or removed results in the meantime
+		entries = self.entries()
+		self.size = sum(entry[1] for entry in entries)
+		for mtime, fileSize, name in sorted(entries):
+			if self.size <= self.maxSize:
+				break
+
+			os.remove(os.path.join(self.directory, name))
+			self.size -= fileSize
+
+	#--------------------------------------------------------------------------
+	def entries(self):
+		"""Returns (modification time, size, file name) of all results."""
+		entries = list()
+		for name in os.listdir(self.directory):
+			if name.endswith('.pkl'):
+				stat = os.stat(os.path.join(self.directory, name))
+				entries.append((stat.st_mtime, stat.st_size, name))
+
+		return entries
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
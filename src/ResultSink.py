@@ -0,0 +1,280 @@
+
+import json
+import os
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def resultDirectoryName(savePath, pumpAmpl, stedAmpl):
+	"""Returns the directory of the point spread function for the
+	given pump and STED amplitudes."""
+	return "%sPSF_pump_%.3f_sted_%.3f/"%(savePath, pumpAmpl, stedAmpl)
+
+
+#==============================================================================
+class ResultSink(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, directory, lock=None):
+		"""
+		Append-only columnar store of the result dicts of a point spread
+		function. Every key of the result dicts is a column, whose values
+		are appended to the binary file <key>.dat, while the number of
+		values of every row is appended to <key>.len. The columns and their
+		data types are described in schema.json, which is written with the
+		first result.
+
+		The number of complete rows is written to the file rows after all
+		columns of a row have been written. Readers only read that number of
+		rows, so the store can be read while results are still appended,
+		and rows of an interrupted append are overwritten by the next one.
+
+		The sink can be used as resultContainer of the simulators. If more
+		than one process appends to the same directory, all of them need to
+		share the same lock.
+
+		Parameters
+		----------
+		directory : str
+			Directory of the store, created if necessary
+		lock : multiprocessing.Lock or None
+			Lock shared by all processes appending to the store
+		"""
+		self.directory = directory
+		self.lock = lock
+
+	#--------------------------------------------------------------------------
+	def put(self, result):
+		"""Appends a result dict, so that the sink can replace a Queue."""
+		self.append(result)
+
+	#--------------------------------------------------------------------------
+	def append(self, result):
+		"""
+		Appends a single result dict as a new row. Keys, which are not in
+		the schema, are ignored.
+
+		Parameters
+		----------
+		result : dict
+			Result dict as created by the finalize() of the simulators
+		"""
+		if self.lock is not None:
+			self.lock.acquire()
+
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+
+			schema = readSchema(self.directory)
+			if schema is None:
+				schema = createSchema(result)
+				with open(os.path.join(self.directory, 'schema.json'), 'w') as f:
+					json.dump(schema, f, indent=1)
+
+			rows = numberOfRows(self.directory)
+
+			for column in schema:
+				value = np.ascontiguousarray(result[column['name']], dtype=column['dtype'])
+				self._appendColumn(column, value, rows)
+
+			self._writeNumberOfRows(rows + 1)
+
+		finally:
+			if self.lock is not None:
+				self.lock.release()
+
+	#--------------------------------------------------------------------------
+	def truncate(self, rows):
+		"""Discards all rows after the given number of rows, e.g. the results
+		of a task, which were written but not marked as completed."""
+		if self.lock is not None:
+			self.lock.acquire()
+
+		try:
+			if numberOfRows(self.directory) > rows:
+				# readers of the sink notice the rows, which may be written
+				# again, by the generation, see generation()
+				with openForAppend(os.path.join(self.directory, 'generation')) as f:
+					np.array([generation(self.directory) + 1], dtype=np.int64).tofile(f)
+
+				self._writeNumberOfRows(rows)
+
+		finally:
+			if self.lock is not None:
+				self.lock.release()
+
+	#--------------------------------------------------------------------------
+	def _appendColumn(self, column, value, rows):
+		lengthPath, dataPath = columnFileNames(self.directory, column['name'])
+
+		# after complete appends the data file ends with the last row, only
+		# discarded or partly written rows need the lengths summed up. The
+		# data is cut before the lengths, so this holds after a crash as well.
+		if os.path.exists(lengthPath) and os.path.getsize(lengthPath) == rows*8 and os.path.exists(dataPath):
+			size = os.path.getsize(dataPath)
+		else:
+			with openForAppend(lengthPath) as f:
+				size = int(np.fromfile(f, dtype=np.int64, count=rows).sum()) * np.dtype(column['dtype']).itemsize
+
+			with openForAppend(dataPath) as f:
+				f.truncate(size)
+
+		with openForAppend(lengthPath) as f:
+			f.truncate(rows*8)
+			f.seek(rows*8)
+			np.array([value.size], dtype=np.int64).tofile(f)
+
+		with openForAppend(dataPath) as f:
+			f.seek(size)
+			value.tofile(f)
+
+	#--------------------------------------------------------------------------
+	def _writeNumberOfRows(self, rows):
+		with openForAppend(os.path.join(self.directory, 'rows')) as f:
+			np.array([rows], dtype=np.int64).tofile(f)
+			f.flush()
+			os.fsync(f.fileno())
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def openForAppend(path):
+	"""Opens a binary file for reading and writing at its beginning,
+	it is created if necessary."""
+	return open(path, 'r+b' if os.path.exists(path) else 'w+b')
+
+#------------------------------------------------------------------------------
+def columnFileNames(directory, name):
+	"""Returns the paths of the length and the data file of a column."""
+	return os.path.join(directory, name + '.len'), os.path.join(directory, name + '.dat')
+
+#------------------------------------------------------------------------------
+def createSchema(result):
+	"""Returns the description of the columns for the given result dict,
+	scalars have no shape and arrays keep all but their first dimension."""
+	schema = list()
+	for name in sorted(result.keys()):
+		value = np.asarray(result[name])
+		if value.dtype == object:
+			raise TypeError("result %s can't be stored in a column"%name)
+
+		schema.append(dict(name=name, dtype=value.dtype.str, ndim=value.ndim, shape=list(value.shape[1:])))
+
+	return schema
+
+#------------------------------------------------------------------------------
+def readSchema(directory):
+	"""Returns the column descriptions of the store in directory, or None if
+	nothing was written yet."""
+	path = os.path.join(directory, 'schema.json')
+	if not os.path.exists(path):
+		return None
+
+	with open(path, 'r') as f:
+		return json.load(f)
+
+#------------------------------------------------------------------------------
+def numberOfRows(directory):
+	"""Returns the number of complete rows of the store in directory."""
+	path = os.path.join(directory, 'rows')
+	if not os.path.exists(path):
+		return 0
+
+	rows = np.fromfile(path, dtype=np.int64, count=1)
+	return int(rows[0]) if rows.size else 0
+
+#------------------------------------------------------------------------------
+def generation(directory):
+	"""Returns the number of truncations of the store in directory, which
+	discarded rows."""
+	path = os.path.join(directory, 'generation')
+	if not os.path.exists(path):
+		return 0
+
+	generation = np.fromfile(path, dtype=np.int64, count=1)
+	return int(generation[0]) if generation.size else 0
+
+#------------------------------------------------------------------------------
+def isResultDirectory(path):
+	"""Returns True if path is the directory of a ResultSink."""
+	return os.path.isdir(path) and os.path.exists(os.path.join(path, 'schema.json'))
+
+#------------------------------------------------------------------------------
+def readColumn(directory, name):
+	"""
+	Returns the values of a single column of all complete rows. Columns
+	with values of the same shape in every row are returned as a single
+	array with the rows along the first axis, otherwise a list of arrays
+	is returned.
+
+	Parameters
+	----------
+	directory : str
+		Directory of the store
+	name : str
+		Key of the result dicts
+	"""
+	rows = numberOfRows(directory)
+	column = [c for c in readSchema(directory) if c['name'] == name][0]
+	lengthPath, dataPath = columnFileNames(directory, name)
+
+	if not rows:
+		return list()
+
+	lengths = np.fromfile(lengthPath, dtype=np.int64, count=rows)
+	values = np.fromfile(dataPath, dtype=column['dtype'], count=int(lengths.sum()))
+
+	if column['ndim'] == 0:
+		return values
+
+	trailingShape = tuple(column['shape'])
+	if np.all(lengths == lengths[0]):
+		return values.reshape((rows, -1) + trailingShape)
+
+	return [v.reshape((-1,) + trailingShape) for v in np.split(values, np.cumsum(lengths)[:-1])]
+
+#------------------------------------------------------------------------------
+def readResults(directory):
+	"""Returns the list of result dicts of all complete rows of the store in
+	directory, just like the list of the former pickled result files."""
+	schema = readSchema(directory)
+	if schema is None:
+		return list()
+
+	results = [dict() for row in range(numberOfRows(directory))]
+	for column in schema:
+		values = readColumn(directory, column['name'])
+		for result, value in zip(results, values):
+			result[str(column['name'])] = value
+
+	return results
+
+#------------------------------------------------------------------------------
+def memmapValue(directory, name, row):
+	"""
+	Returns the value of a single column of a single row as read-only
+	memory map, so that only the accessed parts are read from disk.
+
+	Parameters
+	----------
+	directory : str
+		Directory of the store
+	name : str
+		Key of the result dicts
+	row : int
+		Index of the row
+	"""
+	column = [c for c in readSchema(directory) if c['name'] == name][0]
+	lengthPath, dataPath = columnFileNames(directory, name)
+
+	lengths = np.fromfile(lengthPath, dtype=np.int64, count=row + 1)
+	offset = int(lengths[:row].sum()) * np.dtype(column['dtype']).itemsize
+	value = np.memmap(dataPath, dtype=column['dtype'], mode='r', offset=offset, shape=(int(lengths[row]),))
+
+	if column['ndim'] == 0:
+		return value[0]
+
+	return value.reshape((-1,) + tuple(column['shape']))
@@ -0,0 +1,231 @@
+
+import glob
+import json
+import os
+import pickle
+import shutil
+
+from ResultSink import ResultSink, generation, isResultDirectory, memmapValue, numberOfRows, readColumn, readSchema
+
+import numpy as np
+
+
+# [gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE]
+numberCrossSections = 5
+
+
+#==============================================================================
+class ResultStore(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, directory, update=True):
+		"""
+		Index of the scalar results of all point spread functions in a
+		results directory, keyed by crossSections, pumpAmplitude,
+		stedAmplitude, laserXpos and laserYpos.
+
+		The index is kept as a structured array in index.npy next to the
+		list of its sources in index.json, so opening the directory only
+		needs the number of rows of every ResultSink directory to find
+		new results. Bulky arrays like populationDistribution are not
+		indexed, but memory-mapped from the sinks on demand.
+
+		Pickled .pys files of former simulations are converted to ResultSink
+		directories once.
+
+		Parameters
+		----------
+		directory : str
+			Directory containing the point spread functions
+		update : bool
+			Add new results to the index when opening
+		"""
+		self.directory = directory
+		self.sources = list()
+		self.index = None
+
+		self.load()
+		if update:
+			self.update()
+
+	#--------------------------------------------------------------------------
+	def load(self):
+		"""Reads the index written by the last update, if any."""
+		sourcesPath, indexPath = self.indexFileNames()
+		if os.path.exists(sourcesPath) and os.path.exists(indexPath):
+			with open(sourcesPath, 'r') as f:
+				self.sources = json.load(f)
+			index = np.load(indexPath)
+
+			# drop the entries of an update, which was interrupted before
+			# its sources were written
+			rows = np.array([source['rows'] for source in self.sources] + [0])
+			known = np.minimum(index['source'], len(self.sources))
+			self.index = index[index['row'] < rows[known]]
+
+	#--------------------------------------------------------------------------
+	def update(self):
+		"""Adds the rows appended to the ResultSink directories since the last
+		update to the index and saves it. The rows of a truncated sink are
+		read again."""
+		for path in glob.glob(os.path.join(self.directory, '*.pys')):
+			convertPickledResults(path)
+
+		known = dict((source['path'], cnt) for cnt, source in enumerate(self.sources))
+		changed = list()
+		dropped = False
+		for path in sorted(glob.glob(os.path.join(self.directory, 'PSF_*'))):
+			if not isResultDirectory(path) or path.endswith('.tmp'):
+				continue
+
+			name = os.path.basename(os.path.normpath(path))
+			rows = numberOfRows(path)
+			sinkGeneration = generation(path)
+			if name not in known:
+				known[name] = len(self.sources)
+				self.sources.append(dict(path=name, rows=0, generation=sinkGeneration))
+
+			# the rows of a truncated sink may have been written again
+			source = self.sources[known[name]]
+			if source.get('generation', 0) != sinkGeneration:
+				self.dropEntries(known[name], 0)
+				source['generation'] = sinkGeneration
+				dropped = True
+			elif rows < source['rows']:
+				self.dropEntries(known[name], rows)
+				dropped = True
+
+			if rows > source['rows']:
+				changed.append((known[name], rows))
+
+		if not changed:
+			if dropped:
+				self.save()
+			return
+
+		dtype = indexDtype([readSchema(self.sourceDirectory(cnt)) for cnt in range(len(self.sources))])
+		if self.index is None or self.index.dtype != dtype:
+			# the columns changed, index all sources from scratch
+			self.index = np.zeros(0, dtype=dtype)
+			changed = [(cnt, numberOfRows(self.sourceDirectory(cnt))) for cnt in range(len(self.sources))]
+			for source in self.sources:
+				source['rows'] = 0
+
+		entries = [self.index]
+		for cnt, rows in changed:
+			entries.append(self.readEntries(cnt, self.sources[cnt]['rows'], rows, dtype))
+			self.sources[cnt]['rows'] = rows
+
+		self.index = np.concatenate(entries)
+		self.save()
+
+	#--------------------------------------------------------------------------
+	def dropEntries(self, source, start):
+		"""Removes the index entries of the rows from start on of a source."""
+		if self.index is not None:
+			self.index = self.index[(self.index['source'] != source) | (self.index['row'] < start)]
+
+		self.sources[source]['rows'] = min(self.sources[source]['rows'], start)
+
+	#--------------------------------------------------------------------------
+	def readEntries(self, source, start, stop, dtype):
+		"""Returns the index entries of the rows start to stop of a source."""
+		directory = self.sourceDirectory(source)
+		entries = np.zeros(stop - start, dtype=dtype)
+		entries['source'] = source
+		entries['row'] = np.arange(start, stop)
+
+		columns = [column['name'] for column in readSchema(directory)]
+		for name in dtype.names:
+			if name in ('source', 'row'):
+				continue
+
+			if name in columns:
+				entries[name] = np.asarray(readColumn(directory, name))[start:stop]
+			else:
+				entries[name] = np.nan
+
+		return entries
+
+	#--------------------------------------------------------------------------
+	def save(self):
+		sourcesPath, indexPath = self.indexFileNames()
+
+		# the index is written before its sources, see load()
+		with open(indexPath, 'wb') as f:
+			np.save(f, self.index)
+		with open(sourcesPath, 'w') as f:
+			json.dump(self.sources, f, indent=1)
+
+	#--------------------------------------------------------------------------
+	def indexFileNames(self):
+		return os.path.join(self.directory, 'index.json'), os.path.join(self.directory, 'index.npy')
+
+	#--------------------------------------------------------------------------
+	def sourceDirectory(self, source):
+		return os.path.join(self.directory, self.sources[source]['path'])
+
+	#--------------------------------------------------------------------------
+	def select(self, **keys):
+		"""
+		Returns the index entries, whose fields equal all given values,
+		sorted by laserXpos and laserYpos.
+
+		Example: store.select(pumpAmplitude=0.05, stedAmplitude=1.0)
+		"""
+		mask = np.ones(self.index.size, dtype=bool)
+		for name, value in keys.items():
+			field = self.index[name]
+			mask &= np.all(field.reshape(field.shape[0], -1) == np.ravel(value), axis=1)
+
+		entries = self.index[mask]
+		return entries[np.lexsort((entries['laserYpos'], entries['laserXpos']))]
+
+	#--------------------------------------------------------------------------
+	def array(self, entry, name):
+		"""
+		Returns a bulky result of a single index entry, e.g.
+		populationDistribution, as read-only memory map.
+
+		Parameters
+		----------
+		entry : numpy.void
+			Entry of the index
+		name : str
+			Key of the result dicts
+		"""
+		return memmapValue(self.sourceDirectory(entry['source']), name, entry['row'])
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def indexDtype(schemas):
+	"""Returns the data type of the index, which holds the source and row of
+	every result, the cross-sections and all scalar results."""
+	scalars = sorted(set(c['name'] for s in schemas for c in s if c['ndim'] == 0))
+
+	fields = [('source', np.int32), ('row', np.int64), ('crossSections', np.float64, (numberCrossSections,))]
+	fields += [(str(name), np.float64) for name in scalars]
+
+	return np.dtype(fields)
+
+#------------------------------------------------------------------------------
+def convertPickledResults(path):
+	"""Converts a pickled list of result dicts to a ResultSink directory of the
+	same name without extension, unless the directory exists already."""
+	directory = os.path.splitext(path)[0]
+	if isResultDirectory(directory):
+		return directory
+
+	with open(path, 'rb') as f:
+		results = pickle.load(f)
+
+	# the directory appears only after all results are converted
+	shutil.rmtree(directory + '.tmp', ignore_errors=True)
+	sink = ResultSink(directory + '.tmp')
+	for result in results:
+		sink.append(result)
+
+	os.rename(sink.directory, directory)
+	return directory
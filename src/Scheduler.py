@@ -0,0 +1,360 @@
+
+from multiprocessing import Pool, cpu_count
+
+from Checkpoint import SweepManifest, arrayDigest
+from Geometry import createGeometry, crystalCoordinates, openGeometry
+from Lattice import RegularLattice
+from PointSpreadFunction import aggregateProfile, printProfile
+from ResultCache import simulationKey
+from ResultSink import ResultSink, numberOfRows, resultDirectoryName
+from Simulator import SolidStateStedSimulator, SolidStateStedEnsembleSimulator
+from TransitionTable import createTransitionTable
+
+import numpy as np
+import os
+import timeit
+
+
+#------------------------------------------------------------------------------
+def simulateLaserPositions(task):
+	"""
+	Runs the simulation of a single task within a worker of the pool and
+	returns the key of its point spread function and the index of the task
+	together with the list of result dicts (one per laser position).
+
+	Parameters
+	----------
+	task : tuple
+		(psfKey, task index, simulator parameters), see
+		SweepScheduler.createTasks()
+	"""
+	psfKey, taskIdx, parameters = task
+
+	# the coordinates are taken from the shared geometry instead of being
+	# sent with every task
+	if parameters.get('geometry') is not None:
+		parameters.update(openGeometry(parameters['geometry']).coordinates())
+
+	simulatorClass = parameters.pop('simulatorClass')
+	sim = simulatorClass(nSimSteps=parameters.pop('N'), tolerance=parameters.pop('tolerance'),
+						 checkpointPath=parameters.pop('checkpointPath'), importanceSampling=parameters.pop('importanceSampling'),
+						 profile=parameters.pop('profile'))
+
+	sim.setupSimulation(**parameters)
+	sim.run()
+
+	return psfKey, taskIdx, sim.results
+
+
+#==============================================================================
+class SweepScheduler(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, N, REcoord, ETcoord, pumpAmpl, stedAmpl, laserCoord, cs, eTR, savePath, processes=None, ensembleSize=None, simulatorClass=SolidStateStedSimulator, tolerance=None, resume=True, cache=None, seed=None, precompute=True, importanceSampling=False, profile=False):
+		"""
+		Schedules the simulations of all point spread functions of a
+		pump x STED amplitude sweep on a bounded pool of worker processes.
+
+		The whole sweep is flattened into a single queue of tasks (one per
+		laser position, or one per chunk of ensembleSize laser positions),
+		so that the workers are kept busy across the point spread functions.
+		The results are appended to the ResultSink of their point spread
+		function as soon as a task is done, so only the parent process
+		writes to the sinks.
+
+		If resume is set, the completed tasks are recorded in the manifest
+		file manifest.json in savePath and the simulators save checkpoints
+		to savePath/checkpoints/. A restarted sweep skips the completed
+		tasks and resumes the others from their last checkpoint.
+
+		If a ResultCache is given, tasks whose laser positions are all
+		cached are not simulated, and all new results are added to it.
+
+		If precompute is set, the transition probabilities of all scan
+		points are calculated at once before the simulations start and
+		saved as TransitionTable to savePath/transitions/, where the
+		simulators look them up. Likewise the positions and neighbours of
+		the crystal are saved as Geometry to savePath/geometry/, which all
+		workers share instead of building private copies.
+
+		Parameters
+		----------
+		N : int or float
+			Number of iteration steps for every simulation, or the
+			maximum number of steps if a tolerance is given
+		REcoord : array-like
+			Coordinates of the rare earths as [x, y], or [x, y, z] in a
+			three-dimensional crystal
+		ETcoord : array-like or Lattice.RegularLattice
+			(number of electron traps x 2) array of electron trap
+			coordinates, or (number of electron traps x 3) in a
+			three-dimensional crystal, or the lattice of the electron
+			traps, which needs no shared geometry
+		pumpAmpl : array-like
+			All pump amplitudes of the sweep
+		stedAmpl : array-like
+			All STED amplitudes of the sweep
+		laserCoord : array-like
+			(number of laser positions x 2) array of laser coordinates
+		cs : array-like
+			Cross-sections of the rare earth
+		eTR : float
+			Electron travel range
+		savePath : str
+			Directory to save the point spread functions to
+		processes : int or None
+			Number of worker processes, defaults to the number of cores
+		ensembleSize : int or None
+			If given, chunks of at most ensembleSize laser positions
+			are simulated together by a SolidStateStedEnsembleSimulator
+		simulatorClass : class
+			Simulator for single laser positions, e.g. the
+			KineticMonteCarloSimulator or the RateEquationSolver. Not used
+			for ensembles.
+		tolerance : float or None
+			Standard error of the rare earth state probabilities, at which
+			the simulations stop early, see SolidStateStedSimulator
+		resume : bool
+			Keep track of the sweep to resume it after an interruption
+		cache : ResultCache or None
+			Cache of the results of former simulations
+		seed : int or None
+			Root seed of the sweep. Every laser position, or ensemble, of
+			every point spread function gets its own reproducible random
+			stream derived from it, see SolidStateStedSimulator.
+		precompute : bool
+			Precompute the transition probabilities and the geometry of
+			the whole sweep
+		importanceSampling : bool
+			Select the electron traps in proportion to their ionization
+			probability, see SolidStateStedSimulator
+		profile : bool
+			Measure the time of the phases of the simulations and count
+			their events, see SolidStateStedSimulator. The totals of every
+			point spread function are saved to profile.json in its
+			directory, when it is completed.
+		"""
+		self.N = N
+		self.REcoord = REcoord
+		self.ETcoord = ETcoord
+		self.pumpAmpl = np.atleast_1d(pumpAmpl)
+		self.stedAmpl = np.atleast_1d(stedAmpl)
+		self.laserCoord = np.asarray(laserCoord)
+		self.crossSections = cs
+		self.electronTravelRange = eTR
+		self.savePath = savePath
+		self.processes = processes if processes is not None else cpu_count()
+		self.ensembleSize = ensembleSize
+		self.simulatorClass = simulatorClass
+		self.tolerance = tolerance
+		self.resume = resume
+		self.cache = cache
+		self.seed = seed
+		self.precompute = precompute
+		self.importanceSampling = importanceSampling
+		self.profile = profile
+		self.checkpointPath = os.path.join(savePath, 'checkpoints')
+		self.transitionTablePath = os.path.join(savePath, 'transitions')
+		self.geometryPath = os.path.join(savePath, 'geometry')
+
+	#--------------------------------------------------------------------------
+	def createTasks(self):
+		"""Returns the list of all tasks of the sweep, ordered by point spread
+		function, and the number of tasks of every point spread function."""
+		if self.ensembleSize is None:
+			simulatorClass = self.simulatorClass
+			laserPositions = [(x, y) for x, y in self.laserCoord]
+		else:
+			simulatorClass = SolidStateStedEnsembleSimulator
+			numberEnsembles = int(np.ceil(len(self.laserCoord)/float(self.ensembleSize)))
+			laserPositions = [(chunk[:,0], chunk[:,1]) for chunk in np.array_split(self.laserCoord, numberEnsembles)]
+
+		tasks = list()
+		tasksPerPSF = dict()
+		for pa in self.pumpAmpl:
+			for sa in self.stedAmpl:
+				psfKey = (pa, sa)
+				tasksPerPSF[psfKey] = len(laserPositions)
+
+				for taskIdx, (laserXpos, laserYpos) in enumerate(laserPositions):
+					checkpointPath = self.checkpointFileName(psfKey, taskIdx) if self.resume else None
+					parameters = dict(N=self.N, simulatorClass=simulatorClass, tolerance=self.tolerance, checkpointPath=checkpointPath,
+									  importanceSampling=self.importanceSampling, profile=self.profile,
+									  pumpAmpl=pa, stedAmpl=sa,
+									  laserXpos=laserXpos, laserYpos=laserYpos,
+									  cs=self.crossSections, eTR=self.electronTravelRange, seed=self.seed)
+					parameters.update(crystalCoordinates(self.REcoord, self.ETcoord))
+					tasks.append((psfKey, taskIdx, parameters))
+
+		return tasks, tasksPerPSF
+
+	#--------------------------------------------------------------------------
+	def sweepParameters(self):
+		"""Returns the parameters shared by all point spread functions, which
+		have to match to resume a sweep."""
+		parameters = dict(N=self.N, REcoord=list(np.ravel(self.REcoord)), ETcoord=arrayDigest(self.ETcoord),
+						  laserCoord=arrayDigest(self.laserCoord), crossSections=list(self.crossSections),
+						  electronTravelRange=self.electronTravelRange, ensembleSize=self.ensembleSize,
+						  simulatorClass=self.simulatorClass.__name__, tolerance=self.tolerance, seed=self.seed,
+						  importanceSampling=self.importanceSampling)
+
+		# the results of a profiled sweep have more columns, the parameter
+		# is only added if set, so former sweeps can be resumed
+		if self.profile:
+			parameters['profile'] = True
+
+		return parameters
+
+	#--------------------------------------------------------------------------
+	def psfName(self, psfKey):
+		return os.path.basename(os.path.normpath(resultDirectoryName(self.savePath, *psfKey)))
+
+	#--------------------------------------------------------------------------
+	def checkpointFileName(self, psfKey, taskIdx):
+		return os.path.join(self.checkpointPath, '%s_task_%d.ckpt'%(self.psfName(psfKey), taskIdx))
+
+	#--------------------------------------------------------------------------
+	def skipCompletedTasks(self, tasks, remainingTasks):
+		"""Removes the completed tasks of the manifest from the tasks and
+		discards the results of all other tasks from the sinks."""
+		if not os.path.isdir(self.checkpointPath):
+			os.makedirs(self.checkpointPath)
+
+		self.manifest = SweepManifest(os.path.join(self.savePath, 'manifest.json'), self.sweepParameters())
+
+		for psfKey in remainingTasks.keys():
+			pa, sa = psfKey
+			ResultSink(resultDirectoryName(self.savePath, pa, sa)).truncate(self.manifest.numberOfRows(self.psfName(psfKey)))
+			remainingTasks[psfKey] -= len(self.manifest.completedTasks(self.psfName(psfKey)))
+
+		return [task for task in tasks if task[1] not in self.manifest.completedTasks(self.psfName(task[0]))]
+
+	#--------------------------------------------------------------------------
+	def run(self):
+		tasks, remainingTasks = self.createTasks()
+		if self.resume:
+			tasks = self.skipCompletedTasks(tasks, remainingTasks)
+
+		self.start_time = timeit.default_timer()
+		self.remainingTasks = remainingTasks
+
+		# the parameters are kept to add the new results to the cache
+		self.taskParameters = dict(((psfKey, taskIdx), parameters) for psfKey, taskIdx, parameters in tasks)
+		if self.cache is not None:
+			tasks = self.skipCachedTasks(tasks)
+
+		if self.precompute and tasks:
+			self.precomputeSweep(tasks)
+
+		pool = Pool(processes=self.processes)
+		try:
+			for psfKey, taskIdx, results in pool.imap_unordered(simulateLaserPositions, [self.workerTask(task) for task in tasks]):
+				if self.cache is not None:
+					self.cacheResults(psfKey, taskIdx, results)
+
+				self.taskDone(psfKey, taskIdx, results)
+
+			pool.close()
+
+		except:
+			pool.terminate()
+			raise
+
+		finally:
+			pool.join()
+
+	#--------------------------------------------------------------------------
+	def precomputeSweep(self, tasks):
+		"""Saves the transition probabilities and the geometry of the sweep,
+		which are shared by the simulators of the given tasks."""
+		coordinates = crystalCoordinates(self.REcoord, self.ETcoord)
+		createTransitionTable(self.transitionTablePath, pumpAmpl=self.pumpAmpl, stedAmpl=self.stedAmpl,
+							  laserXpos=self.laserCoord[:,0], laserYpos=self.laserCoord[:,1], cs=self.crossSections, **coordinates)
+
+		# a lattice of electron traps computes its neighbours itself
+		geometryPath = None
+		if not isinstance(self.ETcoord, RegularLattice):
+			createGeometry(self.geometryPath, eTR=self.electronTravelRange, **coordinates)
+			geometryPath = self.geometryPath
+
+		for psfKey, taskIdx, parameters in tasks:
+			parameters['transitionTable'] = self.transitionTablePath
+			parameters['geometry'] = geometryPath
+
+	#--------------------------------------------------------------------------
+	def workerTask(self, task):
+		"""Returns the task sent to a worker, which doesn't contain the
+		coordinates, if the workers take them from the shared geometry."""
+		psfKey, taskIdx, parameters = task
+		if parameters.get('geometry') is None:
+			return task
+
+		coordinates = ('REx', 'REy', 'ETx', 'ETy', 'REz', 'ETz')
+		return psfKey, taskIdx, dict((name, value) for name, value in parameters.items() if name not in coordinates)
+
+	#--------------------------------------------------------------------------
+	def taskDone(self, psfKey, taskIdx, results):
+		"""Saves the results of a task, which was simulated or taken from the
+		cache, and reports completed point spread functions."""
+		self.saveResults(psfKey, results)
+		if self.resume:
+			self.completeTask(psfKey, taskIdx)
+
+		self.remainingTasks[psfKey] -= 1
+
+		if not self.remainingTasks[psfKey]:
+			stop_time = timeit.default_timer()
+			print "elapsed time: %.1f s"%(stop_time - self.start_time)
+			print "pump=%.2f, sted=%.1f"%psfKey
+			if self.profile:
+				printProfile(aggregateProfile(resultDirectoryName(self.savePath, *psfKey)))
+			print ""
+
+	#--------------------------------------------------------------------------
+	def taskKeys(self, parameters):
+		"""Returns the cache keys of all laser positions of a task."""
+		laserXpos, laserYpos = np.broadcast_arrays(np.atleast_1d(parameters['laserXpos']), np.atleast_1d(parameters['laserYpos']))
+		return [simulationKey(parameters, x, y) for x, y in zip(laserXpos, laserYpos)]
+
+	#--------------------------------------------------------------------------
+	def skipCachedTasks(self, tasks):
+		"""Completes all tasks, whose results are cached, and returns the
+		others. An ensemble is only skipped if all of its laser positions
+		are cached."""
+		remaining = list()
+		for psfKey, taskIdx, parameters in tasks:
+			results = [self.cache.get(key) for key in self.taskKeys(parameters)]
+
+			if any(result is None for result in results):
+				remaining.append((psfKey, taskIdx, parameters))
+			else:
+				self.taskDone(psfKey, taskIdx, results)
+
+		return remaining
+
+	#--------------------------------------------------------------------------
+	def cacheResults(self, psfKey, taskIdx, results):
+		parameters = self.taskParameters[(psfKey, taskIdx)]
+		for result in results:
+			self.cache.put(simulationKey(parameters, result['laserXpos'], result['laserYpos']), result)
+
+	#--------------------------------------------------------------------------
+	def saveResults(self, psfKey, results):
+		pa, sa = psfKey
+		sink = ResultSink(resultDirectoryName(self.savePath, pa, sa))
+		for result in results:
+			sink.append(result)
+
+	#--------------------------------------------------------------------------
+	def completeTask(self, psfKey, taskIdx):
+		"""Marks a task as completed in the manifest, after its results were
+		saved, and removes its checkpoint."""
+		pa, sa = psfKey
+		rows = numberOfRows(resultDirectoryName(self.savePath, pa, sa))
+		self.manifest.complete(self.psfName(psfKey), taskIdx, rows)
+
+		checkpointPath = self.checkpointFileName(psfKey, taskIdx)
+		if os.path.exists(checkpointPath):
+			os.remove(checkpointPath)
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
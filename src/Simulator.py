@@ -1,8 +1,13 @@
 
-from ElectronicSystems import ElectronicSystem
+from ElectronicSystems import ElectronicSystem, ElectronicSystemEnsemble
+from Geometry import openGeometry
+from Lattice import RegularLattice
 #from Crystal import ConductionBand, ValenceBand
-from LaserProfiles import PumpBeam, StedBeam
-from Utility import EvolutionRecorder
+from LaserProfiles import createLaserBeams
+from Checkpoint import readCheckpoint, writeCheckpoint
+from TransitionTable import openTransitionTable
+from TrapSelection import ImportanceTrapSelection, UniformTrapSelection
+from Utility import ConvergenceMonitor, NullProfiler, PhaseProfiler, RandomStream, RateTree, StateEvolutionRecorder, streamSeed
 
 
 import numpy as np
@@ -11,25 +16,67 @@ import sys
 from multiprocessing import Process
 
 class SolidStateStedSimulator(Process):
+	# the ground and excited states are counted once per simulation step
+	evolutionDtype = np.int64
+
+	# all phases and events of the simulation loop, which are in every
+	# profiled result, even if they didn't occur
+	profilePhases = ('trapSelection', 'actOnElectronTraps', 'actOnRareEarths', 'handleRecombination', 'recordREstates',
+					 'recordElectronTrapPopulationDistribution', 'observeREstates', 'saveCheckpoint')
+	profileEvents = ('ionizations', 'recombinations', 'valenceBandDecays')
+
 	#--------------------------------------------------------------------------
-	def __init__(self, nSimSteps, resultContainer):
+	def __init__(self, nSimSteps, resultContainer=None, tolerance=None, minSteps=None, checkpointPath=None, checkpointInterval=None, importanceSampling=False, profile=False):
 		"""
 		Creates a simulator object for STED microscopy in solids.
 
 		Parameters
 		----------
 		nSimSteps : int or float
-			Number of iteration steps for the simulation
-		resultContainer : multiprocessing.Queue
-			Container to save simulation results
+			Number of iteration steps for the simulation, or the maximum
+			number of steps if a tolerance is given
+		resultContainer : multiprocessing.Queue or None
+			Container to save simulation results. The results are
+			kept in the results attribute in any case.
+		tolerance : float or None
+			If given, the simulation stops as soon as the standard errors
+			of the ground and excited state probability of the rare earth
+			are below tolerance. The averages are then taken after the
+			detected burn-in instead of over the second half.
+		minSteps : int or None
+			Minimum number of steps before the simulation may stop early,
+			defaults to 10% of nSimSteps
+		checkpointPath : str or None
+			If given, the state of the simulation is saved to this file
+			periodically and a simulation is resumed from it, if it exists
+		checkpointInterval : int or None
+			Number of steps between two checkpoints, defaults to 5% of
+			nSimSteps
+		importanceSampling : bool
+			Select the electron traps acted on in every step in proportion
+			to their ionization probability instead of uniformly. The
+			ionization rate of every trap stays the same, see
+			ImportanceTrapSelection.
+		profile : bool
+			Measure the wall time of the phases of the simulation steps and
+			count the ionizations, recombinations and decays to the valence
+			band. They are added to the result as profile_time_<phase> and
+			profile_count_<event>, see PhaseProfiler.
 		"""
 		super(SolidStateStedSimulator, self).__init__()
 
 		self.numberOfSimulationSteps = int(nSimSteps + 1)
 		self.resultContainer = resultContainer
+		self.results = list()
+		self.tolerance = tolerance
+		self.minSteps = minSteps if minSteps is not None else int(0.1*nSimSteps)
+		self.checkpointPath = checkpointPath
+		self.checkpointInterval = checkpointInterval if checkpointInterval is not None else max(int(0.05*nSimSteps), 1)
+		self.importanceSampling = importanceSampling
+		self.profiler = PhaseProfiler(self.profilePhases, self.profileEvents) if profile else NullProfiler()
 
 	#--------------------------------------------------------------------------
-	def setupSimulation(self, REx, REy, ETx, ETy, pumpAmpl=0.05, stedAmpl=0.5, laserXpos=0.0, laserYpos=0.0, cs=[1,1,1,1,1], eTR=25E-9):
+	def setupSimulation(self, REx, REy, ETx, ETy, pumpAmpl=0.05, stedAmpl=0.5, laserXpos=0.0, laserYpos=0.0, cs=[1,1,1,1,1], eTR=25E-9, seed=None, transitionTable=None, geometry=None, REz=None, ETz=None):
 		"""
 		Configures all necessary parameters and creates the objects needed for the simulator.
 
@@ -39,10 +86,12 @@ class SolidStateStedSimulator(Process):
 			Represents the x-coordinates of the rare earths
 		REy : array-like
 			Represents the y-coordinates of the rare earths
-		ETx : array-like
-			Represents the x-coordinates of the electron traps
-		ETy : array-like
-			Represents the y-coordinates of the electron traps
+		ETx : array-like or Lattice.RegularLattice
+			Represents the x-coordinates of the electron traps, or their
+			lattice, see ElectronicSystem()
+		ETy : array-like or None
+			Represents the y-coordinates of the electron traps, None for
+			a lattice
 		pumpAmpl : float
 			Amplitude for the excitation laser beam
 		stedAmpl : float
@@ -52,17 +101,39 @@ class SolidStateStedSimulator(Process):
 			[gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE]
 		eTR : float
 			Electron travel range
+		seed : int or None
+			Root seed of the study. The simulator draws its random numbers
+			from its own stream derived from the seed, the amplitudes and
+			the laser position, so the simulation can be reproduced. A
+			seed from the operating system is used if None.
+		transitionTable : str or None
+			Directory of a TransitionTable holding the transition
+			probabilities of this simulation, which are calculated
+			otherwise
+		geometry : str or None
+			Directory of a Geometry of the crystal shared by all workers,
+			whose positions and neighbours are used instead of private
+			copies. The coordinates should be the ones of the geometry.
+		REz : array-like or None
+			Represents the z-coordinates of the rare earths in a
+			three-dimensional crystal, the focal plane is at z = 0
+		ETz : array-like or None
+			Represents the z-coordinates of the electron traps in a
+			three-dimensional crystal
 		"""
-		self.rareEarthXCoordinates = np.array(REx)
-		self.rareEarthYCoordinates = np.array(REy)
-		self.electronTrapXCoordinates = np.array(ETx)
-		self.electronTrapYCoordinates = np.array(ETy)
+		self.rareEarthXCoordinates = np.asarray(REx)
+		self.rareEarthYCoordinates = np.asarray(REy)
+		self.rareEarthZCoordinates = None if REz is None else np.asarray(REz)
+		self.electronTrapXCoordinates = ETx if isinstance(ETx, RegularLattice) else np.asarray(ETx)
+		self.electronTrapYCoordinates = None if ETy is None else np.asarray(ETy)
+		self.electronTrapZCoordinates = None if ETz is None else np.asarray(ETz)
 		self.pumpAmplitude = pumpAmpl
 		self.stedAmplitude = stedAmpl
 		self.laserXpos = laserXpos
 		self.laserYpos = laserYpos
 		self.crossSections = cs
 		self.electronTravelRange = eTR
+		self.seed = seed
 
 		self.electronicSystemsPopulationDistribution = np.zeros(REx.size + ETx.size)
 
@@ -70,8 +141,7 @@ class SolidStateStedSimulator(Process):
 		#self.vb = ValenceBand()
 
 		# set up pump and sted beam
-		self.pumpBeam = PumpBeam(x=self.laserXpos, y=self.laserYpos, amplitude=self.pumpAmplitude, wavelength=470E-9, numAperture=1.3)
-		self.stedBeam = StedBeam(x=self.laserXpos, y=self.laserYpos, amplitude=self.stedAmplitude, wavelength=600E-9, numAperture=1.3)
+		self.pumpBeam, self.stedBeam = createLaserBeams(self.laserXpos, self.laserYpos, self.pumpAmplitude, self.stedAmplitude)
 
 		# set up electronic systems
 		self.electronSystems = ElectronicSystem(RExPos   = self.rareEarthXCoordinates,
@@ -79,7 +149,49 @@ class SolidStateStedSimulator(Process):
 			                                    ETxPos   = self.electronTrapXCoordinates,
 			                                    ETyPos   = self.electronTrapYCoordinates,
 			                                    pumpBeam = self.pumpBeam,
-			                                    stedBeam = self.stedBeam)
+			                                    stedBeam = self.stedBeam,
+			                                    REzPos   = self.rareEarthZCoordinates,
+			                                    ETzPos   = self.electronTrapZCoordinates)
+
+		self.shareGeometry(geometry)
+		self.setupTransitionProbabilities(transitionTable)
+
+		# set up a single evolution recorder for all rare earths in the system
+		self.evolutionRecorder = StateEvolutionRecorder(self.electronSystems.rareEarthIndices.shape, self.evolutionDtype)
+
+		self.random = RandomStream(streamSeed(seed, pumpAmpl, stedAmpl, laserXpos, laserYpos))
+
+	#--------------------------------------------------------------------------
+	def shareGeometry(self, geometry=None):
+		"""Lets the electronic systems use the positions and neighbours of a
+		Geometry shared by all workers, if one is given."""
+		self.geometry = openGeometry(geometry) if geometry is not None else None
+		if self.geometry is None:
+			return
+
+		if self.geometry.electronTravelRange != self.electronTravelRange:
+			raise ValueError("%s was created for an electron travel range of %g"%(geometry, self.geometry.electronTravelRange))
+
+		self.electronSystems.shareGeometry(self.geometry.positions, self.geometry.neighbourOffsets, self.geometry.neighbourIndices)
+
+	#--------------------------------------------------------------------------
+	def createNeighbours(self):
+		"""Creates the neighbours of the electronic systems, unless they are
+		taken from the shared geometry, and the free-slot index."""
+		if self.geometry is None:
+			self.electronSystems.createNeighbours(self.electronTravelRange)
+		else:
+			self.electronSystems.buildFreeSlotIndex()
+
+	#--------------------------------------------------------------------------
+	def setupTransitionProbabilities(self, transitionTable=None):
+		"""Sets up the transition probabilities of the electronic systems,
+		either looked up in a precomputed TransitionTable or calculated."""
+		if transitionTable is not None:
+			table = openTransitionTable(transitionTable)
+			self.electronSystems.setTransitionProbabilities(*table.lookup(self.pumpAmplitude, self.stedAmplitude,
+																		  self.laserXpos, self.laserYpos, self.crossSections))
+			return
 
 		self.electronSystems.setupTransitionProbabilities(gammaRE     = self.crossSections[0],
 														  sigPumpRE   = self.crossSections[1],
@@ -87,20 +199,9 @@ class SolidStateStedSimulator(Process):
 														  sigRepumpRE = self.crossSections[3],
 														  sigStedRE   = self.crossSections[4])
 
-		# set up evolution recorder for every rare earth in the system
-		self.evolutionRecoders = list()
-		self.evolutionRecorderIdx = dict()
-		for reCnt, reIdx in zip(range(self.electronSystems.rareEarthIndices.size), self.electronSystems.rareEarthIndices):
-			self.evolutionRecorderIdx[reIdx] = reCnt
-			rePos = self.electronSystems.getPosition(reIdx)
-			evRec = EvolutionRecorder('REpos=[%.2g, %.2g, %.2g]'%(rePos[0], rePos[1], rePos[2]), 'sim step', 'N')
-			self.evolutionRecoders.append(evRec)
-
-		np.random.seed()
-
 	#--------------------------------------------------------------------------
 	def run(self):
-		self.electronSystems.createNeighbours(self.electronTravelRange)
+		self.createNeighbours()
 
 		rareEarthIndices = self.electronSystems.rareEarthIndices
 		electronTrapIndices = self.electronSystems.electronTrapIndices
@@ -108,94 +209,176 @@ class SolidStateStedSimulator(Process):
 		# randomly choose ~1% of the available electron traps
 		# to be handeled in a single simulation step
 		numRandElectronicSystems = int(0.01 * electronTrapIndices.size + 1)
-
-		# prepare array for random indices to loop over
-		self.randIndices = np.zeros(numRandElectronicSystems + rareEarthIndices.size, dtype=np.int32)
+		self.trapSelection = self.createTrapSelection(numRandElectronicSystems)
 
 		# some constants to check during simulation
 		progressUpdate = int(0.01*self.numberOfSimulationSteps)
 		progressEvolutionRecord = int(0.05*self.numberOfSimulationSteps)
 
-		for simStep in xrange(self.numberOfSimulationSteps):
+		self.recordInterval = progressEvolutionRecord
+		self.convergence = ConvergenceMonitor(shape=(2,))
+
+		self.nextStep = 0
+		self.restoreCheckpoint()
+
+		profiler = self.profiler
+		profiler.start()
+
+		# a checkpoint may have been written after the last step
+		simStep = self.nextStep - 1
+		for simStep in xrange(self.nextStep, self.numberOfSimulationSteps):
 			#if not simStep % progressUpdate:
 			#	sys.stdout.write("\r%.0f %% "%(float(simStep)/float(self.numberOfSimulationSteps)*100.0))
 			#	if int(float(simStep)/float(self.numberOfSimulationSteps)*100.0) == 99:
 			#		print ""
 
-			# build up list of random indices for electronic systems
-			# to act on and always include all rare earths.
-			self.randIndices[:numRandElectronicSystems] = np.random.choice(electronTrapIndices, numRandElectronicSystems, replace=False)
-			self.randIndices[numRandElectronicSystems:] = rareEarthIndices
-			np.random.shuffle(self.randIndices)
-
-			for index in self.randIndices:
-				randomNumber = np.random.rand()
-
-				if index in rareEarthIndices:
-					result = self.electronSystems.actOnRareEarth(index, randomNumber)
-
-					if result == 1:
-						# RE got ionized, electron is absorbed by CB, now recombine to somewhere
-						#self.handleRecombination(self.electronSystems.getPosition(index))
-						self.handleRecombination(index)
-
-					elif result == 2:
-						# RE got repumped, catch electron from VB
-						#self.vb.donateElectron()
-						#self.vb.evolutionDonatedElectrons.record(simStep, self.vb.donatedElectronCount)
-						pass
-
-				else:
-					result = self.electronSystems.actOnElectronTrap(index, randomNumber)
-
-					if result == 1:
-						# ET got ionized, add electron to CB and recombine to somewhere
-						#self.handleRecombination(self.electronSystems.getPosition(index))
-						self.handleRecombination(index)
+			# randomly choose electron traps to act on and always include all
+			# rare earths. All of them are acted on at once, each one with its
+			# own random number.
+			trapIndices, trapRandomNumbers = self.trapSelection.select(self.random)
+			profiler.phase('trapSelection')
+			trapResults = self.electronSystems.actOnElectronTraps(trapIndices, trapRandomNumbers)
+			profiler.phase('actOnElectronTraps')
+			rareEarthResults = self.electronSystems.actOnRareEarths(rareEarthIndices, self.random.rand(rareEarthIndices.size))
+			profiler.phase('actOnRareEarths')
+
+			# ionized ET and RE released an electron to the CB, now recombine
+			# to somewhere. This is resolved afterwards in random order.
+			# Repumped RE (result 2) caught an electron from the VB.
+			self.ionizedIndices = np.concatenate((trapIndices[trapResults == 1], rareEarthIndices[rareEarthResults == 1]))
+			self.random.shuffle(self.ionizedIndices)
+
+			targets = [self.handleRecombination(index) for index in self.ionizedIndices]
+
+			if profiler.enabled:
+				decays = targets.count(None)
+				profiler.count('ionizations', len(targets))
+				profiler.count('recombinations', len(targets) - decays)
+				profiler.count('valenceBandDecays', decays)
+			profiler.phase('handleRecombination')
 
 			# record ground/excited state evolution (internal)
 			self.electronSystems.recordREstates()
 
 			# record ground/excited state evolution (binned for result)
 			if not simStep % progressEvolutionRecord:
-				for REidx in self.electronSystems.rareEarthIndices:
-					self.evolutionRecoders[self.evolutionRecorderIdx[REidx]].record(simStep,
-																					self.electronSystems.rareEarthGroundStateCounter(REidx),
-																					self.electronSystems.rareEarthExcitedStateCounter(REidx))
-
+				self.evolutionRecorder.record(simStep, self.electronSystems.groundStateCounter, self.electronSystems.excitedStateCounter)
 				self.electronSystems.resetRareEarthEvolutionCounters()
+			profiler.phase('recordREstates')
 
 			if not simStep % 2:
 				self.recordElectronTrapPopulationDistribution(self.electronSystems.population)
+			profiler.phase('recordElectronTrapPopulationDistribution')
+
+			if self.observeREstates():
+				break
+			profiler.phase('observeREstates')
+
+			if self.checkpointPath is not None and not (simStep + 1) % self.checkpointInterval and simStep + 1 < self.numberOfSimulationSteps:
+				self.nextStep = simStep + 1
+				self.saveCheckpoint()
+			profiler.phase('saveCheckpoint')
+
+		self.simulationSteps = simStep + 1
 
 		# after last simulation step
 		self.finalize()
 
+	#--------------------------------------------------------------------------
+	def createTrapSelection(self, numberSelected):
+		"""Returns the selection of the electron traps acted on in every step,
+		numberSelected traps per step on average."""
+		es = self.electronSystems
+		if not self.importanceSampling:
+			return UniformTrapSelection(es.electronTrapIndices, numberSelected)
+
+		selectionProbability = float(numberSelected)/es.electronTrapIndices.size
+		return ImportanceTrapSelection(es.electronTrapIndices, es.pIonize, selectionProbability)
+
+	#--------------------------------------------------------------------------
+	def checkpointAttributes(self):
+		"""Returns the names of all attributes, which change during run()."""
+		return ['electronSystems', 'evolutionRecorder', 'electronicSystemsPopulationDistribution', 'convergence', 'nextStep', 'random']
+
+	#--------------------------------------------------------------------------
+	def saveCheckpoint(self):
+		"""Saves the state of the simulation including the random stream to
+		the checkpoint file."""
+		state = dict((name, getattr(self, name)) for name in self.checkpointAttributes())
+		writeCheckpoint(self.checkpointPath, state)
+
+	#--------------------------------------------------------------------------
+	def restoreCheckpoint(self):
+		"""Restores the state of the simulation from the checkpoint file, if
+		there is one. Returns True if the state was restored."""
+		if self.checkpointPath is None:
+			return False
+
+		state = readCheckpoint(self.checkpointPath)
+		if state is None:
+			return False
+
+		for name, value in state.items():
+			setattr(self, name, value)
+
+		# the checkpoint holds private copies of the shared geometry
+		if self.geometry is not None:
+			self.electronSystems.shareGeometry(self.geometry.positions, self.geometry.neighbourOffsets, self.geometry.neighbourIndices)
+
+		return True
+
+	#--------------------------------------------------------------------------
+	def observeREstates(self, duration=1.0):
+		"""Adds the ground and excited state occupancy of the first rare
+		earth, which is the one evaluated in the result, to the convergence
+		monitor and returns True if the simulation has converged."""
+		es = self.electronSystems
+		state = es.rareEarthState[0]
+
+		batchCompleted = self.convergence.add((state == es.GROUND, state == es.EXCITED), duration)
+		return batchCompleted and self.tolerance is not None and self.convergence.converged(self.tolerance, self.minSteps)
+
 	#--------------------------------------------------------------------------
 	def handleRecombination(self, index):
 		# now go through the conduction band's collected electrons and
 		# find the ones which can recombine to either an electron trap
-		# or to a rare earth.
-		self.possibleRecombinationSlots = np.intersect1d(self.electronSystems.potentialRecombinationIndices,
-														 self.electronSystems.getNeighbours(index))
-
+		# or to a rare earth. Returns the index of the system the electron
+		# recombined to, or None if it decayed to the valence band.
 		if not self.electronSystems.isRareEarth(index):
-			probDecayToValenceBand = 1.0/(self.possibleRecombinationSlots.size + 1) # + 1 for the VB, to which the electron can decay.
-			randomNumber = np.random.rand()
+			probDecayToValenceBand = 1.0/(self.electronSystems.numberFreeNeighbours(index) + 1) # + 1 for the VB, to which the electron can decay.
+			randomNumber = self.random.rand()
 			if randomNumber <= probDecayToValenceBand:
-				return
+				return None
+
+		self.possibleRecombinationSlots = self.electronSystems.getFreeNeighbours(index)
+		target = self.random.choice(self.possibleRecombinationSlots)
+		self.electronSystems.recombine(target)
 
-		self.electronSystems.recombine(np.random.choice(self.possibleRecombinationSlots))
+		return target
 
 	#--------------------------------------------------------------------------
 	def recordElectronTrapPopulationDistribution(self, distribution):
 		self.electronicSystemsPopulationDistribution += distribution
 
+	#--------------------------------------------------------------------------
+	def estimateStateAverages(self):
+		"""Estimates the ground and excited state counts of every rare earth
+		per record interval and the standard errors of the first one."""
+		self.rareEarthGroundStateAverages, self.rareEarthExcitedStateAverages = self.evolutionRecorder.averages()
+
+		if self.tolerance is None:
+			self.groundStateAverage = self.rareEarthGroundStateAverages[0]
+			self.excitedStateAverage = self.rareEarthExcitedStateAverages[0]
+		else:
+			self.groundStateAverage, self.excitedStateAverage = self.recordInterval * self.convergence.mean
+
+		self.groundStateError, self.excitedStateError = self.recordInterval * self.convergence.standardError
+		self.burnInSteps = self.convergence.burnIn
+
 	#--------------------------------------------------------------------------
 	def finalize(self):
 		# generate the values which are needed for further processing
-		self.groundStateAverage = np.average(np.array_split(self.evolutionRecoders[0]._g, 2)[1])
-		self.excitedStateAverage = np.average(np.array_split(self.evolutionRecoders[0]._e, 2)[1])
+		self.estimateStateAverages()
 
 		# collect single results in a dictionary
 		result = dict()
@@ -205,15 +388,524 @@ class SolidStateStedSimulator(Process):
 		result["laserYpos"] = self.laserYpos
 		result["groundStateAverage"] = self.groundStateAverage
 		result["excitedStateAverage"] = self.excitedStateAverage
-		result["rePopulationEvolution_time"] = self.evolutionRecoders[0]._t
-		result["rePopulationEvolution_groundState"] = self.evolutionRecoders[0]._g
-		result["rePopulationEvolution_excitedState"] = self.evolutionRecoders[0]._e
+		result["rePopulationEvolution_time"] = self.evolutionRecorder.times
+		result["rePopulationEvolution_groundState"] = self.evolutionRecorder.groundStates[:, 0]
+		result["rePopulationEvolution_excitedState"] = self.evolutionRecorder.excitedStates[:, 0]
+		result["reGroundStateAverages"] = self.rareEarthGroundStateAverages
+		result["reExcitedStateAverages"] = self.rareEarthExcitedStateAverages
 		result["pumpAmplitude"] = self.pumpAmplitude
 		result["stedAmplitude"] = self.stedAmplitude
 		result["crossSections"] = self.crossSections
 		result["electronTravelRange"] = self.electronTravelRange
-		result["electronTrapXCoordinates"] = self.electronTrapXCoordinates
-		result["electronTrapYCoordinates"] = self.electronTrapYCoordinates
+		result.update(self.trapCoordinates())
 		result["populationDistribution"] = self.electronicSystemsPopulationDistribution
+		result.update(self.depthCoordinates())
+		result["simulationSteps"] = self.simulationSteps
+		result["burnInSteps"] = self.burnInSteps
+		result["groundStateError"] = self.groundStateError
+		result["excitedStateError"] = self.excitedStateError
+		result.update(self.profiler.results())
+
+		self.saveResult(result)
+
+	#--------------------------------------------------------------------------
+	def trapCoordinates(self):
+		"""Returns the x and y coordinates of the electron traps for the
+		result, which are computed for a lattice of electron traps."""
+		lattice = self.electronSystems.lattice
+		if lattice is None:
+			return dict(electronTrapXCoordinates=self.electronTrapXCoordinates, electronTrapYCoordinates=self.electronTrapYCoordinates)
+
+		return dict(electronTrapXCoordinates=lattice.x, electronTrapYCoordinates=lattice.y)
+
+	#--------------------------------------------------------------------------
+	def depthCoordinates(self):
+		"""Returns the z coordinates of the rare earths and the electron traps
+		for the result of a three-dimensional crystal, nothing otherwise, so
+		the results of two-dimensional crystals keep their columns."""
+		lattice = self.electronSystems.lattice
+		if self.rareEarthZCoordinates is None and self.electronTrapZCoordinates is None and (lattice is None or lattice.dimensions < 3):
+			return dict()
+
+		es = self.electronSystems
+		return dict(reZpos=es.z[es.numberElectronTraps:], electronTrapZCoordinates=es.z[:es.numberElectronTraps])
+
+	#--------------------------------------------------------------------------
+	def saveResult(self, result):
+		self.results.append(result)
+
+		if self.resultContainer is not None:
+			self.resultContainer.put(result)
+
+
+class KineticMonteCarloSimulator(SolidStateStedSimulator):
+	# the ground and excited states are integrated over the simulated time
+	evolutionDtype = float
+
+	profilePhases = ('sampleEvent', 'advanceTime', 'performEvent', 'saveCheckpoint')
+	profileEvents = ('events', 'ionizations', 'recombinations', 'valenceBandDecays')
+
+	#--------------------------------------------------------------------------
+	def __init__(self, nSimSteps, resultContainer=None, tolerance=None, minSteps=None, checkpointPath=None, checkpointInterval=None, importanceSampling=False, profile=False):
+		"""
+		Creates an event-driven (Gillespie) simulator, which is set up and
+		evaluated just like the SolidStateStedSimulator.
+
+		Instead of acting on ~1% of the electron traps and all rare earths in
+		every step, the next event and the waiting time to it are sampled from
+		the total rate of all possible events. The rate of an event is its
+		probability per simulation step in the fixed-step scheme, so the time
+		is measured in simulation steps and the results are time-averaged
+		occupancies in the same units. Steps without any event are skipped.
+
+		Parameters
+		----------
+		nSimSteps : int or float
+			Simulated time in units of simulation steps
+		resultContainer : multiprocessing.Queue or None
+			Container to save simulation results
+		tolerance : float or None
+			See SolidStateStedSimulator
+		minSteps, checkpointPath, checkpointInterval
+			See SolidStateStedSimulator
+		importanceSampling : bool
+			Not used, the events of the traps are sampled according to
+			their rates anyway
+		profile : bool
+			See SolidStateStedSimulator, the phases are the sampling of
+			the events, performing them and advancing the time
+		"""
+		super(KineticMonteCarloSimulator, self).__init__(nSimSteps, resultContainer, tolerance, minSteps, checkpointPath, checkpointInterval, profile=profile)
 
-		self.resultContainer.put(result)
+	#--------------------------------------------------------------------------
+	def run(self):
+		self.createNeighbours()
+
+		es = self.electronSystems
+
+		self.setupRates()
+		self.rates = RateTree([self.siteRate(idx) for idx in range(es.N)])
+
+		# the population is integrated over time lazily on every change
+		self.lastPopulationChange = np.zeros(es.N)
+		self.populationIntegral = np.zeros(es.N)
+
+		self.recordInterval = max(int(0.05*self.numberOfSimulationSteps), 1)
+		self.endTime = float(self.numberOfSimulationSteps - 1)
+		self.numberOfEvents = 0
+
+		self.convergence = ConvergenceMonitor(shape=(2,))
+		self.converged = False
+
+		self.nextStep = 0
+
+		# like in the fixed-step scheme the first record covers one step
+		self.time = 0.0
+		self.nextRecordTime = 0.0
+		self.accumulateREstates(1.0)
+
+		self.nextCheckpointTime = float(self.checkpointInterval)
+		if self.restoreCheckpoint():
+			es = self.electronSystems
+
+		profiler = self.profiler
+		profiler.start()
+
+		while True:
+			totalRate = self.rates.total
+			waitingTime = self.random.exponential(1.0/totalRate) if totalRate > 0.0 else np.inf
+			profiler.phase('sampleEvent')
+
+			if self.time + waitingTime > self.endTime:
+				self.advanceTime(self.endTime)
+				break
+
+			self.advanceTime(self.time + waitingTime)
+			profiler.phase('advanceTime')
+			if self.converged:
+				break
+
+			self.performEvent(self.rates.sample(self.random.rand()*totalRate))
+			self.numberOfEvents += 1
+			profiler.phase('performEvent')
+
+			if self.checkpointPath is not None and self.time >= self.nextCheckpointTime:
+				self.nextCheckpointTime += self.checkpointInterval
+				self.saveCheckpoint()
+			profiler.phase('saveCheckpoint')
+
+		profiler.count('events', self.numberOfEvents)
+
+		self.simulationSteps = int(self.time) + 1
+
+		# the fixed-step scheme samples the population every second step
+		for idx in range(es.N):
+			self.integratePopulation(idx)
+		self.recordElectronTrapPopulationDistribution(self.populationIntegral/2.0)
+
+		# after the simulated time
+		self.finalize()
+
+	#--------------------------------------------------------------------------
+	def checkpointAttributes(self):
+		return super(KineticMonteCarloSimulator, self).checkpointAttributes() + ['rates', 'time', 'nextRecordTime',
+																				  'nextCheckpointTime', 'lastPopulationChange',
+																				  'populationIntegral', 'numberOfEvents', 'converged']
+
+	#--------------------------------------------------------------------------
+	def setupRates(self):
+		"""Derives the rates per simulation step from the transition
+		probabilities of the fixed-step scheme."""
+		es = self.electronSystems
+
+		# an electron trap is acted on with the probability to be among the
+		# randomly chosen ~1% of all traps in a fixed step
+		numRandElectronicSystems = int(0.01 * es.electronTrapIndices.size + 1)
+		self.trapSelectionProbability = float(numRandElectronicSystems)/max(es.electronTrapIndices.size, 1)
+
+		# rates of the rare earths depending on their state, the transition
+		# probabilities are the differences of the cumulative thresholds
+		self.rareEarthProbabilities = np.diff(es.rareEarthThresholds, axis=1, prepend=0.0)
+		self.rareEarthRates = np.zeros((es.rareEarthIndices.size, 4))
+		self.rareEarthRates[:, es.GROUND]  = self.rareEarthProbabilities[:, es.EXCITE]
+		self.rareEarthRates[:, es.EXCITED] = self.rareEarthProbabilities[:, [es.DECAY, es.IONIZE, es.DEPLETE]].sum(axis=1)
+		self.rareEarthRates[:, es.IONIZED] = self.rareEarthProbabilities[:, es.REPUMP]
+
+	#--------------------------------------------------------------------------
+	def siteRate(self, idx):
+		"""Returns the rate of all possible events of the electronic system idx
+		in its current state."""
+		es = self.electronSystems
+		if es.isRareEarth(idx):
+			reCnt = idx - es.numberElectronTraps
+			return self.rareEarthRates[reCnt, es.rareEarthState[reCnt]]
+
+		return self.trapSelectionProbability * es.pIonize[idx] * es.populated[idx]
+
+	#--------------------------------------------------------------------------
+	def performEvent(self, idx):
+		"""Performs an event on the electronic system idx, which is chosen
+		among its possible transitions according to their rates."""
+		es = self.electronSystems
+		self.integratePopulation(idx)
+
+		if not es.isRareEarth(idx):
+			result = es.ionizeET(idx)
+
+		else:
+			reCnt = idx - es.numberElectronTraps
+			state = es.rareEarthState[reCnt]
+
+			if state == es.GROUND:
+				result = es.excite(idx)
+
+			elif state == es.EXCITED:
+				if self.random.rand()*self.rareEarthRates[reCnt, state] < self.rareEarthProbabilities[reCnt, es.IONIZE]:
+					result = es.ionizeRE(idx)
+				else:
+					result = es.decay(idx)
+
+			else:
+				result = es.restore(idx)
+
+		self.rates.update(idx, self.siteRate(idx))
+
+		if result == 1:
+			# the released electron recombines immediately
+			target = self.handleRecombination(idx)
+
+			self.profiler.count('ionizations')
+			self.profiler.count('valenceBandDecays' if target is None else 'recombinations')
+
+			if target is not None:
+				# the target was not populated up to now
+				self.lastPopulationChange[target] = self.time
+				self.rates.update(target, self.siteRate(target))
+
+	#--------------------------------------------------------------------------
+	def integratePopulation(self, idx):
+		"""Adds the population of idx since its last change to the integral."""
+		self.populationIntegral[idx] += self.electronSystems.populated[idx] * (self.time - self.lastPopulationChange[idx])
+		self.lastPopulationChange[idx] = self.time
+
+	#--------------------------------------------------------------------------
+	def advanceTime(self, time):
+		"""Advances the simulated time, while the state doesn't change, and
+		records the ground/excited state evolution on the way."""
+		es = self.electronSystems
+		while self.nextRecordTime <= time:
+			self.accumulateREstates(self.nextRecordTime - self.time)
+			self.time = self.nextRecordTime
+
+			self.evolutionRecorder.record(int(self.time), es.groundStateCounter, es.excitedStateCounter)
+			es.resetRareEarthEvolutionCounters()
+			self.nextRecordTime += self.recordInterval
+
+		self.accumulateREstates(time - self.time)
+		self.time = time
+
+	#--------------------------------------------------------------------------
+	def accumulateREstates(self, duration):
+		"""Time-continuous version of ElectronicSystem.recordREstates()."""
+		es = self.electronSystems
+		es.groundStateCounter  = es.groundStateCounter  + duration*(es.rareEarthState == es.GROUND)
+		es.excitedStateCounter = es.excitedStateCounter + duration*(es.rareEarthState == es.EXCITED)
+
+		if duration > 0.0 and self.observeREstates(duration):
+			self.converged = True
+
+
+class SolidStateStedEnsembleSimulator(SolidStateStedSimulator):
+	#--------------------------------------------------------------------------
+	def __init__(self, nSimSteps, resultContainer=None, tolerance=None, minSteps=None, checkpointPath=None, checkpointInterval=None, importanceSampling=False, profile=False):
+		"""
+		Creates a simulator object, which advances the simulations of several
+		laser positions on the same crystal together. The result of every
+		laser position is put to the resultContainer separately, just like
+		the SolidStateStedSimulator does.
+
+		Parameters
+		----------
+		nSimSteps : int or float
+			Number of iteration steps for the simulation
+		resultContainer : multiprocessing.Queue or None
+			Container to save simulation results
+		tolerance : float or None
+			See SolidStateStedSimulator, the simulation stops when all
+			laser positions have converged
+		minSteps, checkpointPath, checkpointInterval, importanceSampling, profile
+			See SolidStateStedSimulator. The events are counted for every
+			laser position, while the time is split equally between them.
+		"""
+		super(SolidStateStedEnsembleSimulator, self).__init__(nSimSteps, resultContainer, tolerance, minSteps, checkpointPath, checkpointInterval, importanceSampling, profile)
+
+	#--------------------------------------------------------------------------
+	def setupSimulation(self, REx, REy, ETx, ETy, pumpAmpl=0.05, stedAmpl=0.5, laserXpos=[0.0], laserYpos=[0.0], cs=[1,1,1,1,1], eTR=25E-9, seed=None, transitionTable=None, geometry=None, REz=None, ETz=None):
+		"""
+		Configures all necessary parameters and creates the objects needed for the simulator.
+
+		Parameters
+		----------
+		laserXpos : array-like
+			x-coordinates of all laser positions to simulate
+		laserYpos : array-like
+			y-coordinates of all laser positions to simulate
+
+		For all other parameters see SolidStateStedSimulator.setupSimulation().
+		"""
+		self.rareEarthXCoordinates = np.asarray(REx)
+		self.rareEarthYCoordinates = np.asarray(REy)
+		self.rareEarthZCoordinates = None if REz is None else np.asarray(REz)
+		self.electronTrapXCoordinates = ETx if isinstance(ETx, RegularLattice) else np.asarray(ETx)
+		self.electronTrapYCoordinates = None if ETy is None else np.asarray(ETy)
+		self.electronTrapZCoordinates = None if ETz is None else np.asarray(ETz)
+		self.pumpAmplitude = pumpAmpl
+		self.stedAmplitude = stedAmpl
+		self.laserXpos, self.laserYpos = np.broadcast_arrays(np.array(laserXpos, dtype=float), np.array(laserYpos, dtype=float))
+		self.crossSections = cs
+		self.electronTravelRange = eTR
+		self.seed = seed
+
+		self.electronicSystemsPopulationDistribution = np.zeros((self.laserXpos.size, REx.size + ETx.size))
+
+		# set up pump and sted beam for all laser positions at once
+		self.pumpBeam, self.stedBeam = createLaserBeams(self.laserXpos, self.laserYpos, self.pumpAmplitude, self.stedAmplitude)
+
+		# set up electronic systems
+		self.electronSystems = ElectronicSystemEnsemble(RExPos   = self.rareEarthXCoordinates,
+														REyPos   = self.rareEarthYCoordinates,
+														ETxPos   = self.electronTrapXCoordinates,
+														ETyPos   = self.electronTrapYCoordinates,
+														pumpBeam = self.pumpBeam,
+														stedBeam = self.stedBeam,
+														REzPos   = self.rareEarthZCoordinates,
+														ETzPos   = self.electronTrapZCoordinates)
+
+		self.shareGeometry(geometry)
+		self.setupTransitionProbabilities(transitionTable)
+
+		# set up a single evolution recorder for all rare earths at all laser positions
+		self.evolutionRecorder = StateEvolutionRecorder(self.electronSystems.rareEarthStates.shape, self.evolutionDtype)
+
+		# a single stream for all laser positions of the ensemble
+		self.random = RandomStream(streamSeed(seed, pumpAmpl, stedAmpl, self.laserXpos, self.laserYpos))
+
+	#--------------------------------------------------------------------------
+	def run(self):
+		self.createNeighbours()
+
+		numberLaserPositions = self.electronSystems.numberLaserPositions
+		electronTrapIndices = self.electronSystems.electronTrapIndices
+		rareEarthIndices = self.electronSystems.rareEarthIndices
+
+		# randomly choose ~1% of the available electron traps
+		# to be handeled in a single simulation step
+		numRandElectronicSystems = int(0.01 * electronTrapIndices.size + 1)
+		self.trapSelection = self.createTrapSelection(numRandElectronicSystems)
+		rareEarthLaserPositions = np.repeat(np.arange(numberLaserPositions), rareEarthIndices.size)
+		rareEarthIndicesAll = np.tile(rareEarthIndices, numberLaserPositions)
+
+		progressEvolutionRecord = int(0.05*self.numberOfSimulationSteps)
+
+		self.recordInterval = progressEvolutionRecord
+		self.convergence = ConvergenceMonitor(shape=(numberLaserPositions, 2))
+
+		self.nextStep = 0
+		self.restoreCheckpoint()
+
+		profiler = self.profiler
+		profiler.start()
+
+		# a checkpoint may have been written after the last step
+		simStep = self.nextStep - 1
+		for simStep in xrange(self.nextStep, self.numberOfSimulationSteps):
+			# independently for every laser position, randomly choose electron
+			# traps to act on and always include all rare earths
+			laserPositions, trapIndices, trapRandomNumbers = self.selectTraps()
+			profiler.phase('trapSelection')
+			trapResults = self.electronSystems.actOnElectronTraps(laserPositions, trapIndices, trapRandomNumbers)
+			profiler.phase('actOnElectronTraps')
+			rareEarthResults = self.electronSystems.actOnRareEarths(self.random.rand(numberLaserPositions, rareEarthIndices.size)).ravel()
+			profiler.phase('actOnRareEarths')
+
+			# resolve the recombinations afterwards in random order,
+			# the laser positions don't influence each other
+			ionizedTraps = trapResults == 1
+			ionizedRareEarths = rareEarthResults == 1
+			self.ionizedPositions = np.concatenate((laserPositions[ionizedTraps], rareEarthLaserPositions[ionizedRareEarths]))
+			self.ionizedIndices = np.concatenate((trapIndices[ionizedTraps], rareEarthIndicesAll[ionizedRareEarths]))
+			order = self.random.permutation(self.ionizedIndices.size)
+
+			targets = [self.handleRecombination(laserPosition, index) for laserPosition, index in zip(self.ionizedPositions[order], self.ionizedIndices[order])]
+
+			# the events are counted for every laser position
+			if profiler.enabled:
+				decayed = np.array([target is None for target in targets], dtype=bool)
+				ionizations = np.bincount(self.ionizedPositions, minlength=numberLaserPositions)
+				decays = np.bincount(self.ionizedPositions[order][decayed], minlength=numberLaserPositions)
+				profiler.count('ionizations', ionizations)
+				profiler.count('recombinations', ionizations - decays)
+				profiler.count('valenceBandDecays', decays)
+			profiler.phase('handleRecombination')
+
+			# record ground/excited state evolution (internal)
+			self.electronSystems.recordREstates()
+
+			# record ground/excited state evolution (binned for result)
+			if not simStep % progressEvolutionRecord:
+				self.evolutionRecorder.record(simStep, self.electronSystems.groundStateCounters, self.electronSystems.excitedStateCounters)
+				self.electronSystems.resetRareEarthEvolutionCounters()
+			profiler.phase('recordREstates')
+
+			if not simStep % 2:
+				self.recordElectronTrapPopulationDistribution(self.electronSystems.population)
+			profiler.phase('recordElectronTrapPopulationDistribution')
+
+			if self.observeREstates():
+				break
+			profiler.phase('observeREstates')
+
+			if self.checkpointPath is not None and not (simStep + 1) % self.checkpointInterval and simStep + 1 < self.numberOfSimulationSteps:
+				self.nextStep = simStep + 1
+				self.saveCheckpoint()
+			profiler.phase('saveCheckpoint')
+
+		self.simulationSteps = simStep + 1
+
+		# after last simulation step
+		self.finalize()
+
+	#--------------------------------------------------------------------------
+	def createTrapSelection(self, numberSelected):
+		# see SolidStateStedSimulator.createTrapSelection(), the importance
+		# of the traps depends on the laser position
+		es = self.electronSystems
+		if not self.importanceSampling:
+			return UniformTrapSelection(es.electronTrapIndices, numberSelected)
+
+		selectionProbability = float(numberSelected)/es.electronTrapIndices.size
+		return [ImportanceTrapSelection(es.electronTrapIndices, pIonize, selectionProbability) for pIonize in es.pIonize]
+
+	#--------------------------------------------------------------------------
+	def selectTraps(self):
+		"""Returns the laser positions, the indices and the random numbers of
+		the electron traps acted on in a step at all laser positions."""
+		numberLaserPositions = self.electronSystems.numberLaserPositions
+		if not self.importanceSampling:
+			trapIndices, trapRandomNumbers = self.trapSelection.select(self.random, numberLaserPositions)
+			return np.repeat(np.arange(numberLaserPositions), self.trapSelection.numberSelected), trapIndices, trapRandomNumbers
+
+		selections = [trapSelection.select(self.random) for trapSelection in self.trapSelection]
+		laserPositions = np.repeat(np.arange(numberLaserPositions), [trapIndices.size for trapIndices, trapRandomNumbers in selections])
+		return laserPositions, np.concatenate([s[0] for s in selections]), np.concatenate([s[1] for s in selections])
+
+	#--------------------------------------------------------------------------
+	def observeREstates(self, duration=1.0):
+		# see SolidStateStedSimulator.observeREstates(), for every laser position
+		es = self.electronSystems
+		states = es.rareEarthStates[:, 0]
+
+		batchCompleted = self.convergence.add(np.column_stack((states == es.GROUND, states == es.EXCITED)), duration)
+		return batchCompleted and self.tolerance is not None and self.convergence.converged(self.tolerance, self.minSteps)
+
+	#--------------------------------------------------------------------------
+	def handleRecombination(self, laserPosition, index):
+		# see SolidStateStedSimulator.handleRecombination(), but only the
+		# electronic systems of the given laser position are considered
+		self.possibleRecombinationSlots = self.electronSystems.getFreeNeighbours(laserPosition, index)
+
+		if index < self.electronSystems.numberElectronTraps:
+			probDecayToValenceBand = 1.0/(self.possibleRecombinationSlots.size + 1) # + 1 for the VB, to which the electron can decay.
+			randomNumber = self.random.rand()
+			if randomNumber <= probDecayToValenceBand:
+				return None
+
+		target = self.random.choice(self.possibleRecombinationSlots)
+		self.electronSystems.recombine(laserPosition, target)
+
+		return target
+
+	#--------------------------------------------------------------------------
+	def finalize(self):
+		# generate and collect the results for every single laser position
+		mean = self.recordInterval * self.convergence.mean
+		standardError = self.recordInterval * self.convergence.standardError
+
+		recorder = self.evolutionRecorder
+		groundStateAverages, excitedStateAverages = recorder.averages()
+		trapCoordinates = self.trapCoordinates()
+
+		for laserPosition in range(self.laserXpos.size):
+
+			result = dict()
+			result["reXpos"] = self.rareEarthXCoordinates
+			result["reYpos"] = self.rareEarthYCoordinates
+			result["laserXpos"] = self.laserXpos[laserPosition]
+			result["laserYpos"] = self.laserYpos[laserPosition]
+			if self.tolerance is None:
+				result["groundStateAverage"] = groundStateAverages[laserPosition, 0]
+				result["excitedStateAverage"] = excitedStateAverages[laserPosition, 0]
+			else:
+				result["groundStateAverage"], result["excitedStateAverage"] = mean[laserPosition]
+			result["rePopulationEvolution_time"] = recorder.times
+			result["rePopulationEvolution_groundState"] = recorder.groundStates[:, laserPosition, 0]
+			result["rePopulationEvolution_excitedState"] = recorder.excitedStates[:, laserPosition, 0]
+			result["reGroundStateAverages"] = groundStateAverages[laserPosition]
+			result["reExcitedStateAverages"] = excitedStateAverages[laserPosition]
+			result["pumpAmplitude"] = self.pumpAmplitude
+			result["stedAmplitude"] = self.stedAmplitude
+			result["crossSections"] = self.crossSections
+			result["electronTravelRange"] = self.electronTravelRange
+			result.update(trapCoordinates)
+			result["populationDistribution"] = self.electronicSystemsPopulationDistribution[laserPosition]
+			result.update(self.depthCoordinates())
+			result["simulationSteps"] = self.simulationSteps
+			result["burnInSteps"] = self.convergence.burnIn
+			result["groundStateError"], result["excitedStateError"] = standardError[laserPosition]
+
+			# the events were counted for every laser position, while the
+			# time is shared equally by all of them
+			for name, value in self.profiler.results().items():
+				result[name] = value[laserPosition] if np.ndim(value) else value/self.laserXpos.size
+
+			self.saveResult(result)
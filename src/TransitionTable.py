@@ -0,0 +1,191 @@
+
+import json
+import os
+import shutil
+
+from ElectronicSystems import rareEarthTransitionThresholds
+from LaserProfiles import createLaserBeams
+from Lattice import trapCoordinates
+from Utility import openReadOnly
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+def openTransitionTable(directory):
+	"""Returns the TransitionTable in directory. Every worker opens a table
+	only once for all of its simulations, unless the table was replaced."""
+	return openReadOnly(TransitionTable, directory, 'table.json')
+
+#------------------------------------------------------------------------------
+def createTransitionTable(directory, REx, REy, ETx, ETy, pumpAmpl, stedAmpl, laserXpos, laserYpos, cs, chunkSize=2**22, REz=None, ETz=None):
+	"""
+	Precomputes the transition probabilities of all scan points (pump
+	amplitude x STED amplitude x laser position) of a sweep and saves them
+	as a TransitionTable to directory, replacing an existing one.
+
+	The beam profiles are evaluated only once for every laser position and
+	site with amplitude 1, since the amplitudes just scale them. For every
+	scan point, the table holds the normalization of the ionization
+	probability of the electron traps and the cumulative thresholds of
+	the rare earths.
+
+	Parameters
+	----------
+	directory : str
+		Directory of the table
+	REx, REy, ETx, ETy : array-like
+		Coordinates of the rare earths and the electron traps, ETx may
+		be a RegularLattice of the electron traps
+	pumpAmpl, stedAmpl : array-like
+		All pump and STED amplitudes of the sweep
+	laserXpos, laserYpos : array-like
+		Coordinates of all laser positions of the sweep
+	cs : array-like
+		Cross-sections of the rare earth in the order
+		[gammaRE, sigPumpRE, sigIonizeRE, sigRepumpRE, sigStedRE]
+	chunkSize : int
+		Maximum number of laser positions x sites evaluated at once
+	REz, ETz : array-like or None
+		z coordinates of a three-dimensional crystal, whose sites are
+		illuminated by the axial beam profiles
+	"""
+	ETx, ETy, ETz = trapCoordinates(ETx, ETy, ETz)
+	REx, REy, ETx, ETy = [np.ravel(np.asarray(c, dtype=float)) for c in (REx, REy, ETx, ETy)]
+	REz, ETz = [None if c is None else np.ravel(np.asarray(c, dtype=float)) for c in (REz, ETz)]
+	pumpAmpl = np.atleast_1d(np.asarray(pumpAmpl, dtype=float))
+	stedAmpl = np.atleast_1d(np.asarray(stedAmpl, dtype=float))
+	laserXpos, laserYpos = np.broadcast_arrays(np.ravel(np.asarray(laserXpos, dtype=float)), np.ravel(np.asarray(laserYpos, dtype=float)))
+
+	# the table appears only after it is complete
+	temporaryDirectory = os.path.normpath(directory) + '.tmp'
+	shutil.rmtree(temporaryDirectory, ignore_errors=True)
+	os.makedirs(temporaryDirectory)
+
+	def createArray(name, shape):
+		return np.lib.format.open_memmap(os.path.join(temporaryDirectory, name + '.npy'), mode='w+', dtype=np.float64, shape=shape)
+
+	numberLaserPositions = laserXpos.size
+	profiles = dict()
+	for name, sites in (('ET', ETx.size), ('RE', REx.size)):
+		profiles['pump' + name] = createArray('pumpProfile' + name, (numberLaserPositions, sites))
+		profiles['sted' + name] = createArray('stedProfile' + name, (numberLaserPositions, sites))
+
+	ionizeNormalization = createArray('ionizeNormalization', (pumpAmpl.size, stedAmpl.size, numberLaserPositions))
+	rareEarthThresholds = createArray('rareEarthThresholds', (pumpAmpl.size, stedAmpl.size, numberLaserPositions, REx.size, 5))
+
+	positionsPerChunk = max(chunkSize // max(ETx.size + REx.size, 1), 1)
+	for start in range(0, numberLaserPositions, positionsPerChunk):
+		chunk = slice(start, start + positionsPerChunk)
+		pumpBeam, stedBeam = createLaserBeams(laserXpos[chunk, np.newaxis], laserYpos[chunk, np.newaxis], 1.0, 1.0)
+
+		pumpET = profiles['pumpET'][chunk] = pumpBeam.profile(ETx, ETy, ETz)
+		stedET = profiles['stedET'][chunk] = stedBeam.profile(ETx, ETy, ETz)
+		pumpRE = profiles['pumpRE'][chunk] = pumpBeam.profile(REx, REy, REz)
+		stedRE = profiles['stedRE'][chunk] = stedBeam.profile(REx, REy, REz)
+
+		for i, pa in enumerate(pumpAmpl):
+			for j, sa in enumerate(stedAmpl):
+				ionizeNormalization[i, j, chunk] = np.max(pa*pumpET + sa*stedET, axis=-1)
+				rareEarthThresholds[i, j, chunk] = rareEarthTransitionThresholds(pa*pumpRE, sa*stedRE, *cs)
+
+	for array in profiles.values() + [ionizeNormalization, rareEarthThresholds]:
+		array.flush()
+	del profiles, ionizeNormalization, rareEarthThresholds
+
+	np.save(os.path.join(temporaryDirectory, 'laserXpos.npy'), laserXpos)
+	np.save(os.path.join(temporaryDirectory, 'laserYpos.npy'), laserYpos)
+	with open(os.path.join(temporaryDirectory, 'table.json'), 'w') as f:
+		json.dump(dict(pumpAmplitudes=list(pumpAmpl), stedAmplitudes=list(stedAmpl), crossSections=list(map(float, cs))), f, indent=1)
+
+	shutil.rmtree(directory, ignore_errors=True)
+	os.rename(temporaryDirectory, directory)
+
+
+#==============================================================================
+class TransitionTable(object):
+	arrayNames = ('laserXpos', 'laserYpos', 'pumpProfileET', 'stedProfileET', 'pumpProfileRE', 'stedProfileRE',
+				  'ionizeNormalization', 'rareEarthThresholds')
+
+	#--------------------------------------------------------------------------
+	def __init__(self, directory):
+		"""
+		Transition probabilities of all scan points of a sweep, created by
+		createTransitionTable(). All arrays are memory-mapped read-only,
+		so the workers of a sweep share a single copy of the table and a
+		simulator only reads the rows of its own laser positions.
+
+		Parameters
+		----------
+		directory : str
+			Directory of the table
+		"""
+		self.directory = directory
+
+		with open(os.path.join(directory, 'table.json'), 'r') as f:
+			description = json.load(f)
+
+		self.pumpAmplitudes = np.array(description['pumpAmplitudes'])
+		self.stedAmplitudes = np.array(description['stedAmplitudes'])
+		self.crossSections = description['crossSections']
+
+		for name in self.arrayNames:
+			setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+
+	#--------------------------------------------------------------------------
+	def laserPositionIndices(self, laserXpos, laserYpos):
+		"""Returns the rows of the given laser positions, which may be scalars
+		or arrays. Raises a KeyError for positions not in the table."""
+		laserXpos, laserYpos = np.broadcast_arrays(np.asarray(laserXpos, dtype=float), np.asarray(laserYpos, dtype=float))
+
+		indices = np.zeros(laserXpos.shape, dtype=np.int64)
+		for cnt, (x, y) in enumerate(zip(laserXpos.ravel(), laserYpos.ravel())):
+			matches = np.nonzero((self.laserXpos == x) & (self.laserYpos == y))[0]
+			if not matches.size:
+				raise KeyError('laser position [%g, %g] not in %s'%(x, y, self.directory))
+
+			indices.flat[cnt] = matches[0]
+
+		return indices[()] if indices.ndim == 0 else indices
+
+	#--------------------------------------------------------------------------
+	def amplitudeIndex(self, amplitudes, amplitude):
+		matches = np.nonzero(amplitudes == amplitude)[0]
+		if not matches.size:
+			raise KeyError('amplitude %g not in %s'%(amplitude, self.directory))
+
+		return matches[0]
+
+	#--------------------------------------------------------------------------
+	def lookup(self, pumpAmpl, stedAmpl, laserXpos, laserYpos, cs):
+		"""
+		Returns the ionization probability of the electron traps and the
+		cumulative thresholds of the rare earths, exactly as calculated by
+		ElectronicSystem.setupTransitionProbabilities(). For arrays of laser
+		positions, the probabilities of all of them are stacked along the
+		first axis, like for the ElectronicSystemEnsemble.
+
+		Parameters
+		----------
+		pumpAmpl, stedAmpl : float
+			Amplitudes of the pump and the STED beam
+		laserXpos, laserYpos : float or array-like
+			Laser position(s)
+		cs : array-like
+			Cross-sections of the rare earth, they have to match the
+			cross-sections of the table
+		"""
+		if list(map(float, cs)) != self.crossSections:
+			raise ValueError('%s was created for the cross-sections %s'%(self.directory, self.crossSections))
+
+		i = self.amplitudeIndex(self.pumpAmplitudes, pumpAmpl)
+		j = self.amplitudeIndex(self.stedAmplitudes, stedAmpl)
+		rows = self.laserPositionIndices(laserXpos, laserYpos)
+
+		pIonize = pumpAmpl*self.pumpProfileET[rows] + stedAmpl*self.stedProfileET[rows]
+		pIonize /= self.ionizeNormalization[i, j, rows][..., np.newaxis]
+
+		return pIonize, np.array(self.rareEarthThresholds[i, j, rows])
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
@@ -0,0 +1,120 @@
+
+from Utility import randomSubsets
+
+import numpy as np
+
+
+#==============================================================================
+class UniformTrapSelection(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, electronTrapIndices, numberSelected):
+		"""
+		Selects the electron traps, which are acted on in a simulation step,
+		uniformly: numberSelected distinct traps are drawn in O(k log k)
+		without permuting all traps, see randomSubsets().
+
+		Parameters
+		----------
+		electronTrapIndices : array of int
+			Indices of all electron traps
+		numberSelected : int
+			Number of traps acted on per step
+		"""
+		self.electronTrapIndices = electronTrapIndices
+		self.numberSelected = numberSelected
+
+	#--------------------------------------------------------------------------
+	def select(self, random, count=1):
+		"""
+		Returns the indices of the selected traps and the random numbers to
+		act on them with ElectronicSystem.actOnElectronTraps(). A trap
+		ionizes, if its random number is not larger than its pIonize.
+
+		Parameters
+		----------
+		random : RandomStream
+			Random numbers of the simulator
+		count : int
+			Number of independent selections, e.g. one per laser position
+			of an ensemble. The selections are concatenated.
+		"""
+		subsets = randomSubsets(self.electronTrapIndices.size, self.numberSelected, count, random)
+		indices = self.electronTrapIndices[subsets.ravel()]
+		return indices, random.rand(indices.size)
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
+
+#==============================================================================
+class ImportanceTrapSelection(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, electronTrapIndices, pIonize, selectionProbability, numberBuckets=64):
+		"""
+		Selects the electron traps, which are acted on in a simulation step,
+		in proportion to their ionization probability, so that traps far
+		from the beams, which can hardly ionize, are not selected at all.
+
+		In the uniform selection, every trap is selected with the probability
+		selectionProbability and then ionizes with pIonize, i.e. with the
+		rate r = selectionProbability*pIonize per step. Here the traps are
+		sorted into buckets of rates in (u/2, u] with u a power of two. Every
+		trap of a bucket is selected independently with the probability u
+		and ionizes with r/u, so the rate of every trap is exactly the same
+		and at least half of the selected traps ionize, if populated.
+
+		The traps selected from a bucket are drawn in O(k) by drawing their
+		number first, so a step takes O(k log k + numberBuckets).
+
+		Parameters
+		----------
+		electronTrapIndices : array of int
+			Indices of all electron traps
+		pIonize : array
+			Ionization probability of every electron trap
+		selectionProbability : float
+			Probability of a trap to be selected by the uniform selection
+		numberBuckets : int
+			Number of buckets, the last one takes all smaller rates
+		"""
+		rates = selectionProbability*np.asarray(pIonize, dtype=float)
+		candidates = np.nonzero(rates > 0.0)[0]
+
+		buckets = np.minimum(np.floor(-np.log2(rates[candidates])), numberBuckets - 1).astype(np.int64)
+		order = np.argsort(buckets, kind='mergesort')
+		buckets = buckets[order]
+
+		self.members = electronTrapIndices[candidates[order]]
+		self.bucketOffsets = np.searchsorted(buckets, np.arange(numberBuckets + 1))
+		self.bucketSizes = np.diff(self.bucketOffsets)
+		self.bucketProbabilities = 2.0**-np.arange(numberBuckets)
+
+		# a selected trap ionizes, if its random number u/selectionProbability*U
+		# is not larger than pIonize, i.e. with the probability r/u
+		self.thresholdScale = self.bucketProbabilities[buckets]/selectionProbability
+
+	#--------------------------------------------------------------------------
+	def select(self, random):
+		"""Returns the indices of the selected traps and the random numbers to
+		act on them, see UniformTrapSelection.select()."""
+		counts = random.binomial(self.bucketSizes, self.bucketProbabilities)
+		buckets = np.repeat(np.arange(counts.size), counts)
+		offsets = self.bucketOffsets[buckets]
+		sizes = self.bucketSizes[buckets]
+
+		# draw the members of all buckets at once and redraw duplicates like
+		# randomSubsets(), the buckets are sorted, so sorting the members
+		# keeps them in their buckets
+		selected = offsets + (random.rand(buckets.size)*sizes).astype(np.int64)
+		selected.sort()
+		duplicates = np.nonzero(selected[1:] == selected[:-1])[0] + 1
+
+		while duplicates.size:
+			selected[duplicates] = offsets[duplicates] + (random.rand(duplicates.size)*sizes[duplicates]).astype(np.int64)
+			selected.sort()
+			duplicates = np.nonzero(selected[1:] == selected[:-1])[0] + 1
+
+		return self.members[selected], random.rand(selected.size)*self.thresholdScale[selected]
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
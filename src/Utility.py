@@ -3,6 +3,11 @@ import matplotlib as mpl
 mpl.rcParams['font.size'] = 16
 
 import matplotlib.pyplot as plt
+import numpy as np
+
+import hashlib
+import os
+import timeit
 
 class EvolutionRecorder(object):
 	#--------------------------------------------------------------------------
@@ -33,3 +38,562 @@ class EvolutionRecorder(object):
 		plt.ylabel(self._ylabel)
 		plt.legend(loc='best')
 		plt.show()
+
+#==============================================================================
+class StateEvolutionRecorder(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, shape, dtype=np.int64, capacity=32):
+		"""
+		Records the ground and excited state counts of all rare earths at
+		once, i.e. what an EvolutionRecorder per rare earth would record,
+		into arrays, which grow by doubling. A record is a single array
+		operation, independent of the number of rare earths.
+
+		Parameters
+		----------
+		shape : tuple of int
+			Shape of the counts of a record, e.g. (rare earths,) or
+			(laser positions, rare earths)
+		dtype : numpy.dtype
+			Data type of the counts
+		capacity : int
+			Number of records allocated at first
+		"""
+		self.numberRecords = 0
+		self._t = np.zeros(capacity, dtype=np.int64)
+		self._g = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+		self._e = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+
+	#--------------------------------------------------------------------------
+	def record(self, t, g, e):
+		"""Appends the time t and the arrays of the ground and excited state
+		counts g and e of all rare earths."""
+		if self.numberRecords == self._t.size:
+			self._t, self._g, self._e = [np.concatenate((a, np.zeros_like(a))) for a in (self._t, self._g, self._e)]
+
+		self._t[self.numberRecords] = t
+		self._g[self.numberRecords] = g
+		self._e[self.numberRecords] = e
+		self.numberRecords += 1
+
+	#--------------------------------------------------------------------------
+	@property
+	def times(self):
+		"""Returns the array of the times of all records."""
+		return self._t[:self.numberRecords]
+
+	#--------------------------------------------------------------------------
+	@property
+	def groundStates(self):
+		"""Returns the (records x shape) array of the ground state counts."""
+		return self._g[:self.numberRecords]
+
+	#--------------------------------------------------------------------------
+	@property
+	def excitedStates(self):
+		"""Returns the (records x shape) array of the excited state counts."""
+		return self._e[:self.numberRecords]
+
+	#--------------------------------------------------------------------------
+	def averages(self):
+		"""Returns the ground and excited state counts of every rare earth
+		averaged over the second half of the records, i.e. after the
+		burn-in."""
+		return [np.average(np.array_split(counts, 2)[1], axis=0) for counts in (self.groundStates, self.excitedStates)]
+
+#------------------------------------------------------------------------------
+def randomSubsets(n, k, count, random=np.random):
+	"""Draws count independent random subsets of k distinct integers out of
+	range(n) and returns them as a (count x k) array. Each row is sorted.
+
+	Instead of permuting range(n) for every subset, k integers are drawn per
+	row and duplicates are redrawn until all rows are distinct, which is
+	cheap for k << n. The integers are drawn from random, e.g. a
+	RandomStream, which defaults to the global numpy generator."""
+	subsets = np.sort(random.randint(0, n, (count, k)), axis=1)
+	duplicates = subsets[:, 1:] == subsets[:, :-1]
+
+	while np.any(duplicates):
+		subsets[:, 1:][duplicates] = random.randint(0, n, np.count_nonzero(duplicates))
+		subsets.sort(axis=1)
+		duplicates = subsets[:, 1:] == subsets[:, :-1]
+
+	return subsets
+
+# read-only tables opened by this process, see openReadOnly()
+_openTables = dict()
+
+#------------------------------------------------------------------------------
+def openReadOnly(tableClass, directory, descriptionFile):
+	"""
+	Returns tableClass(directory) for read-only tables like the
+	TransitionTable, which are opened only once per process for all
+	simulations of a worker. A table is opened again after it was replaced,
+	i.e. after its description file changed.
+
+	Parameters
+	----------
+	tableClass : class
+		Class of the table, its constructor takes the directory
+	directory : str
+		Directory of the table
+	descriptionFile : str
+		File within the directory, which is written last
+	"""
+	timestamp = os.path.getmtime(os.path.join(directory, descriptionFile))
+	key = (tableClass.__name__, os.path.abspath(directory))
+
+	if key not in _openTables or _openTables[key][0] != timestamp:
+		_openTables[key] = (timestamp, tableClass(directory))
+
+	return _openTables[key][1]
+
+#------------------------------------------------------------------------------
+def streamSeed(rootSeed, *keys):
+	"""
+	Derives the seed of an independent random stream from a root seed and
+	the keys of the stream, e.g. the amplitudes and the laser position of a
+	simulation. The same root seed and keys always give the same stream,
+	while the streams of different keys are unrelated. Returns None, i.e.
+	a seed from the operating system, if rootSeed is None.
+
+	Parameters
+	----------
+	rootSeed : int or None
+		Seed of the whole study
+	*keys
+		Numbers or arrays identifying the stream
+	"""
+	if rootSeed is None:
+		return None
+
+	digest = hashlib.sha1('%d'%rootSeed)
+	for key in keys:
+		digest.update(';' + ','.join('%.12g'%v for v in np.ravel(key)))
+
+	return np.frombuffer(digest.digest(), dtype=np.uint32).copy()
+
+#==============================================================================
+class RandomStream(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, seed=None, blockSize=2**16):
+		"""
+		Random number generator of a single simulator. Uniform random numbers
+		are drawn from the underlying numpy RandomState in blocks of
+		blockSize and handed out one by one or as arrays, which saves the
+		overhead of calling numpy for every single number in the hot loops.
+		Other distributions are derived from the uniform numbers.
+
+		The stream, including its unused numbers, is pickled with the
+		simulator, so a simulation resumed from a checkpoint continues with
+		the same numbers.
+
+		Parameters
+		----------
+		seed : int, array-like or None
+			Seed of the RandomState, see streamSeed()
+		blockSize : int
+			Number of random numbers drawn at once
+		"""
+		self.generator = np.random.RandomState(seed)
+		self.blockSize = blockSize
+		self._block = np.zeros(0)
+		self._position = 0
+
+	#--------------------------------------------------------------------------
+	def _refill(self, size):
+		# the unused numbers are kept, so the sequence doesn't depend on the
+		# block size
+		self._block = np.concatenate((self._block[self._position:], self.generator.random_sample(max(self.blockSize, size))))
+		self._position = 0
+
+	#--------------------------------------------------------------------------
+	def rand(self, *shape):
+		"""Returns a single uniform random number in [0, 1) or an array of
+		the given shape, just like numpy.random.rand()."""
+		if not shape:
+			if self._position >= self._block.size:
+				self._refill(1)
+
+			self._position += 1
+			return self._block.item(self._position - 1)
+
+		size = 1
+		for length in shape:
+			size *= length
+
+		if self._position + size > self._block.size:
+			self._refill(size)
+
+		self._position += size
+		values = self._block[self._position - size:self._position]
+		return values if len(shape) == 1 else values.reshape(shape)
+
+	#--------------------------------------------------------------------------
+	def randint(self, low, high=None, size=None):
+		"""Returns uniform random integers in [low, high), or in [0, low) if
+		high is not given, like numpy.random.randint()."""
+		if high is None:
+			low, high = 0, low
+
+		if size is None:
+			return low + int(self.rand()*(high - low))
+
+		shape = size if isinstance(size, tuple) else (size,)
+		return low + (self.rand(*shape)*(high - low)).astype(int)
+
+	#--------------------------------------------------------------------------
+	def binomial(self, n, p):
+		"""Returns binomially distributed random numbers, they are drawn
+		directly from the generator for arrays n and p at once."""
+		return self.generator.binomial(n, p)
+
+	#--------------------------------------------------------------------------
+	def exponential(self, scale=1.0):
+		"""Returns an exponentially distributed random number."""
+		return -scale*np.log(1.0 - self.rand())
+
+	#--------------------------------------------------------------------------
+	def permutation(self, n):
+		"""Returns a random permutation of range(n)."""
+		return self.rand(n).argsort()
+
+	#--------------------------------------------------------------------------
+	def shuffle(self, array):
+		"""Shuffles array in place."""
+		array[:] = array.take(self.permutation(len(array)))
+
+	#--------------------------------------------------------------------------
+	def choice(self, array):
+		"""Returns a random element of array."""
+		return array[self.randint(len(array))]
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
+
+#==============================================================================
+class RateTree(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, rates):
+		"""
+		Partial-sum (binary indexed) tree over non-negative rates. Both
+		updating a single rate and sampling an index with a probability
+		proportional to its rate take O(log n).
+
+		Parameters
+		----------
+		rates : array-like
+			Initial rates
+		"""
+		self._rates = [float(r) for r in rates]
+		self._size = len(self._rates)
+		self._updates = 0
+
+		self._topStep = 1
+		while 2*self._topStep <= self._size:
+			self._topStep *= 2
+
+		self.rebuild()
+
+	#--------------------------------------------------------------------------
+	def rebuild(self):
+		"""Rebuilds the partial sums from the single rates in O(n), which
+		removes the rounding errors accumulated by the updates."""
+		self._tree = [0.0] + list(self._rates)
+		for i in range(1, self._size + 1):
+			j = i + (i & -i)
+			if j <= self._size:
+				self._tree[j] += self._tree[i]
+
+		self._updates = 0
+
+	#--------------------------------------------------------------------------
+	@property
+	def total(self):
+		"""Returns the sum of all rates."""
+		total = 0.0
+		i = self._size
+		while i > 0:
+			total += self._tree[i]
+			i -= i & -i
+
+		return max(total, 0.0)
+
+	#--------------------------------------------------------------------------
+	def rate(self, index):
+		return self._rates[index]
+
+	#--------------------------------------------------------------------------
+	def update(self, index, rate):
+		"""Sets the rate with the given index."""
+		delta = rate - self._rates[index]
+		if delta == 0.0:
+			return
+
+		self._rates[index] = rate
+		i = index + 1
+		while i <= self._size:
+			self._tree[i] += delta
+			i += i & -i
+
+		self._updates += 1
+		if self._updates > self._size:
+			self.rebuild()
+
+	#--------------------------------------------------------------------------
+	def sample(self, value):
+		"""Returns the index i for which the sum of all rates up to i
+		exceeds value for the first time, with 0 <= value < total."""
+		index = 0
+		step = self._topStep
+		while step:
+			if index + step <= self._size and self._tree[index + step] <= value:
+				index += step
+				value -= self._tree[index]
+			step //= 2
+
+		# rounding errors might hit a vanishing rate at the boundary
+		while index < self._size - 1 and self._rates[index] == 0.0:
+			index += 1
+
+		return min(index, self._size - 1)
+
+
+#==============================================================================
+class ConvergenceMonitor(object):
+	#--------------------------------------------------------------------------
+	def __init__(self, shape=(), batchLength=100.0, maxBatches=64, minBatches=16):
+		"""
+		Online estimation of the mean of time series of observables, e.g.
+		the ground and excited state occupancy of a rare earth, and of the
+		standard error of the mean.
+
+		The samples are averaged in batches, whose means are much less
+		correlated than the single samples. When maxBatches batches are
+		collected, neighbouring batches are merged, which doubles the batch
+		length, so the memory stays bounded while the batches grow beyond
+		the correlation time. The initial transient (burn-in) is detected
+		with the MSER rule and excluded from the estimates.
+
+		Parameters
+		----------
+		shape : tuple
+			Shape of the observables of a single sample
+		batchLength : float
+			Initial duration of a batch
+		maxBatches : int
+			Maximum number of batches, an even number
+		minBatches : int
+			Minimum number of batches after the burn-in to estimate the
+			standard error of the mean
+		"""
+		self._batchLength = float(batchLength)
+		self._maxBatches = maxBatches
+		self._minBatches = minBatches
+		self._batches = list()
+		self._sum = np.zeros(shape)
+		self._duration = 0.0
+		self._estimates = None
+
+		self.totalDuration = 0.0
+
+	#--------------------------------------------------------------------------
+	def add(self, values, duration=1.0):
+		"""
+		Adds the observables, which were constant for the given duration.
+		Returns True if a batch was completed.
+
+		Parameters
+		----------
+		values : array-like
+			Observables of the given shape
+		duration : float
+			Duration (weight) of the sample
+		"""
+		values = np.asarray(values, dtype=float)
+		self.totalDuration += duration
+		completed = False
+
+		while self._duration + duration >= self._batchLength:
+			part = self._batchLength - self._duration
+			self._batches.append((self._sum + part*values)/self._batchLength)
+			self._sum = np.zeros_like(self._sum)
+			self._duration = 0.0
+			duration -= part
+			completed = True
+
+			if len(self._batches) >= self._maxBatches:
+				batches = np.array(self._batches)
+				self._batches = list(0.5*(batches[0::2] + batches[1::2]))
+				self._batchLength *= 2.0
+
+		self._sum += duration*values
+		self._duration += duration
+
+		if completed or len(self._batches) < 2:
+			self._estimates = None
+
+		return completed
+
+	#--------------------------------------------------------------------------
+	def estimate(self):
+		"""Returns the number of batches of the burn-in, the mean and the
+		standard error of the mean of the batches after the burn-in."""
+		if self._estimates is not None:
+			return self._estimates
+
+		numberBatches = len(self._batches)
+		if numberBatches < 2:
+			total = self._sum + self._batchLength*sum(self._batches)
+			self._estimates = (0, total/max(self.totalDuration, 1.0), np.inf*np.ones_like(self._sum))
+			return self._estimates
+
+		batches = np.array(self._batches)
+		flatBatches = batches.reshape(numberBatches, -1)
+
+		# MSER: the truncation within the first half, which minimizes the
+		# squared deviations of the remaining batches divided by their
+		# number squared
+		tailSum = np.cumsum(flatBatches[::-1], axis=0)[::-1]
+		tailSquareSum = np.cumsum(flatBatches[::-1]**2, axis=0)[::-1]
+		remaining = np.arange(numberBatches, 0, -1)[:, np.newaxis].astype(float)
+		deviations = (tailSquareSum - tailSum**2/remaining).sum(axis=1)/remaining[:,0]**2
+		truncation = np.argmin(deviations[:numberBatches//2 + 1])
+
+		tail = batches[truncation:]
+		mean = tail.mean(axis=0)
+		if len(tail) < 2:
+			standardError = np.inf*np.ones_like(mean)
+		else:
+			standardError = tail.std(axis=0, ddof=1)/np.sqrt(len(tail))
+
+		self._estimates = (truncation, mean, standardError)
+		return self._estimates
+
+	#--------------------------------------------------------------------------
+	@property
+	def mean(self):
+		return self.estimate()[1]
+
+	#--------------------------------------------------------------------------
+	@property
+	def standardError(self):
+		return self.estimate()[2]
+
+	#--------------------------------------------------------------------------
+	@property
+	def burnIn(self):
+		"""Returns the duration of the detected burn-in."""
+		return self.estimate()[0] * self._batchLength
+
+	#--------------------------------------------------------------------------
+	def converged(self, tolerance, minDuration=0.0):
+		"""
+		Returns True if enough batches are collected after the burn-in
+		and the standard errors of all observables are below tolerance.
+
+		The observables along the last axis are taken to belong to the same
+		system. If none of them fluctuated, the correlation time of the
+		system may exceed the observed duration, so it is not converged.
+
+		Parameters
+		----------
+		tolerance : float
+			Maximum standard error of the mean
+		minDuration : float
+			Minimum duration of all samples
+		"""
+		if self.totalDuration < minDuration:
+			return False
+
+		truncation, mean, standardError = self.estimate()
+		if len(self._batches) - truncation < self._minBatches:
+			return False
+
+		fluctuated = np.any(np.atleast_1d(standardError) > 0.0, axis=-1)
+		return np.all(standardError < tolerance) and np.all(fluctuated)
+
+
+#==============================================================================
+class PhaseProfiler(object):
+	enabled = True
+
+	#--------------------------------------------------------------------------
+	def __init__(self, phases=(), events=()):
+		"""
+		Collects the wall time spent in the phases of the simulation steps
+		and the numbers of events, e.g. ionizations. The time since the last
+		call of start() or phase() is added to the given phase, so a phase is
+		marked at its end.
+
+		The simulators use a NullProfiler instead, unless profiling is
+		requested, whose methods do nothing.
+
+		Parameters
+		----------
+		phases, events : sequence of str
+			Names of all phases and events, which start at 0, so that the
+			results of every simulation have the same keys
+		"""
+		self.times = dict((name, 0.0) for name in phases)
+		self.counts = dict((name, 0) for name in events)
+		self._last = timeit.default_timer()
+
+	#--------------------------------------------------------------------------
+	def start(self):
+		"""Starts timing the first phase."""
+		self._last = timeit.default_timer()
+
+	#--------------------------------------------------------------------------
+	def phase(self, name):
+		"""Adds the time since the end of the last phase to the phase name."""
+		now = timeit.default_timer()
+		self.times[name] = self.times.get(name, 0.0) + now - self._last
+		self._last = now
+
+	#--------------------------------------------------------------------------
+	def count(self, name, number=1):
+		"""Adds number to the counter of the event name. The number may be an
+		array, e.g. of the events at every laser position."""
+		self.counts[name] = self.counts.get(name, 0) + number
+
+	#--------------------------------------------------------------------------
+	def results(self):
+		"""Returns the times and counts as a dict with the keys
+		profile_time_<phase> and profile_count_<event>."""
+		results = dict()
+		for name, value in self.times.items():
+			results['profile_time_' + name] = value
+		for name, value in self.counts.items():
+			results['profile_count_' + name] = value
+
+		return results
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
+
+
+#==============================================================================
+class NullProfiler(object):
+	enabled = False
+
+	#--------------------------------------------------------------------------
+	def start(self):
+		"""Does nothing, like all methods, see PhaseProfiler."""
+		pass
+
+	#--------------------------------------------------------------------------
+	def phase(self, name):
+		pass
+
+	#--------------------------------------------------------------------------
+	def count(self, name, number=1):
+		pass
+
+	#--------------------------------------------------------------------------
+	def results(self):
+		return dict()
+
+	#--------------------------------------------------------------------------
+	#--------------------------------------------------------------------------
@@ -1,16 +1,21 @@
 
 
-import timeit
 import numpy as np
 import os
 from multiprocessing import freeze_support
 
-from PointSpreadFunction import PointSpreadFunction
+from Lattice import RegularLattice
+from ResultCache import ResultCache
+from Scheduler import SweepScheduler
 
 #--------------------------------------------------------------------------
 # configuration part
 #--------------------------------------------------------------------------
 numberSimulationSteps = 5E5
+simulationTolerance   = None	# e.g. 1E-3 to stop each simulation early
+randomSeed            = None	# e.g. 1234 to reproduce a study exactly
+importanceSampling    = False	# select traps in proportion to their ionization probability
+profileSimulations    = False	# measure the time of the simulation phases and count the events
 numberElectronTraps   = 50
 
 laserXposition = np.linspace(-2.5E-7, 2.5E-7, 63)
@@ -18,8 +23,9 @@ laserYposition = np.zeros(laserXposition.size)
 
 rareEarthCoordinates = np.array([0.0, 0.0])
 
-electronTrapXposition = np.linspace(-5E-7, 5E-7, numberElectronTraps)
-electronTrapYposition = np.linspace(-5E-7, 5E-7, numberElectronTraps)
+# square lattice of electron traps from -500 nm to 500 nm, whose positions
+# and neighbours are computed instead of stored
+electronTrapLattice = RegularLattice(origin=[-5E-7, -5E-7], spacing=1E-6/(numberElectronTraps - 1), shape=(numberElectronTraps, numberElectronTraps))
 
 pumpAmplitude		  = np.linspace(0.05, 0.1, 1)
 stedAmplitude		  = np.linspace(1.0, 20.0, 20)
@@ -40,14 +46,13 @@ path = "%sgamma_%.2f_sigPumpRE_%.2f_sigIonizeRE_%.2f_sigRepumpRE_%.2f_sigStedRE_
 #--------------------------------------------------------------------------
 # some internals
 #--------------------------------------------------------------------------
-if os.path.exists(path):
-	pass #raise ValueError('Path exists. Simulation already done.')
-else:
+# a rerun in an existing path skips the completed PSFs and resumes
+# the others, see SweepScheduler
+if not os.path.exists(path):
 	os.makedirs(path)
 
 
 laserCoordinates = np.vstack((laserXposition, laserYposition)).T
-electronTrapCoordinates = np.array([[x,y] for x in electronTrapXposition for y in electronTrapYposition])
 
 #--------------------------------------------------------------------------
 # now simulate
@@ -56,16 +61,10 @@ electronTrapCoordinates = np.array([[x,y] for x in electronTrapXposition for y i
 if __name__ == '__main__':
 	freeze_support()
 
-	for pa in pumpAmplitude:
-		for sa in stedAmplitude:
+	# results of former studies with the same inputs are reused
+	resultCache = ResultCache(rootPath + "cache/", maxSize=10E9)
 
-			start_time = timeit.default_timer()
-
-			psf = PointSpreadFunction(numberSimulationSteps, rareEarthCoordinates, electronTrapCoordinates, pa, sa, laserCoordinates, crossSections, electronTravelRange, path)
-			psf.start()
-			psf.join()
-
-			stop_time = timeit.default_timer()
-			print "total runtime: %.1f s"%(stop_time - start_time)
-			print "pump=%.2f, sted=%.1f"%(pa, sa)
-			print ""
+	# all PSFs of the sweep share one pool of worker processes
+	# sized to the machine
+	scheduler = SweepScheduler(numberSimulationSteps, rareEarthCoordinates, electronTrapLattice, pumpAmplitude, stedAmplitude, laserCoordinates, crossSections, electronTravelRange, path, tolerance=simulationTolerance, cache=resultCache, seed=randomSeed, importanceSampling=importanceSampling, profile=profileSimulations)
+	scheduler.run()